@@ -0,0 +1,73 @@
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.utils import timezone
+from rest_framework.permissions import SAFE_METHODS
+
+from .models import ArchivedProposal, ExchangeProposal, FacetCount, ProposalParticipant
+
+COLUMNS = 'id, ad_sender_id, ad_receiver_id, comment, status, created_at, updated_at'
+
+# одна партия — один оператор: выбрать (пропуская занятые строки), удалить участников и само предложение,
+# вставить в архив. Блокируются только строки партии и только до конца её транзакции
+MOVE_SQL = f'''
+WITH batch AS (
+    SELECT id FROM {ExchangeProposal._meta.db_table}
+    WHERE status <> 'pending' AND updated_at < %s
+    ORDER BY updated_at, id
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+), participants AS (
+    DELETE FROM {ProposalParticipant._meta.db_table} WHERE proposal_id IN (SELECT id FROM batch)
+), moved AS (
+    DELETE FROM {ExchangeProposal._meta.db_table} WHERE id IN (SELECT id FROM batch)
+    RETURNING {COLUMNS}
+)
+INSERT INTO {ArchivedProposal._meta.db_table} ({COLUMNS}, archived_at)
+SELECT {COLUMNS}, now() FROM moved
+RETURNING status
+'''
+
+
+def archive_batch(before, size):
+    """Переносит в архив до size решённых предложений, решённых раньше before; возвращает Counter статусов."""
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(MOVE_SQL, [before, size])
+            moved = Counter(status for status, in cursor.fetchall())
+        # счётчики фасетов описывают рабочую таблицу
+        FacetCount.objects.apply({('status', status): -count for status, count in moved.items()})
+    return moved
+
+
+def archive_proposals(older_than_days, batch_size, max_batches=None, pause=0):
+    before = timezone.now() - timedelta(days=older_than_days)
+    total = Counter()
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        moved = archive_batch(before, batch_size)
+        total += moved
+        batches += 1
+        if sum(moved.values()) < batch_size:
+            break
+        if pause:
+            # даём репликации и автовакууму догнать
+            time.sleep(pause)
+    return total, batches
+
+
+class ArchiveMixin:
+    # ?archived=1 на чтении отдаёт архив вместо рабочей таблицы той же формы
+    archive_param = 'archived'
+    archive_queryset = ArchivedProposal.objects.with_ads().order_by('-created_at', '-id')
+
+    def archive_requested(self):
+        request = self.request
+        return request.method in SAFE_METHODS and request.query_params.get(self.archive_param) == '1'
+
+    def get_queryset(self):
+        if self.archive_requested():
+            return self.archive_queryset.all()
+        return super().get_queryset()
@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.urls import include, path
+
+from .views import AdCardsView, AdDetailView, AdListView, AdViewSet, ExchangeProposalViewSet
+
+# под ASGI горячие чтения идут в асинхронные view, остальное — в ROOT_URLCONF как есть;
+# имена те же, поэтому reverse и метрики по маршрутам не меняются
+urlpatterns = [
+    path('', AdListView.as_async_view(), name='ad_list'),
+    path('ads/cards/', AdCardsView.as_async_view(), name='ad_cards'),
+    path('ad/<int:pk>/', AdDetailView.as_async_view(), name='ad_detail'),
+    path('api/ads/', AdViewSet.as_async_view('list'), name='ad-list'),
+    path('api/ads/<int:pk>/', AdViewSet.as_async_view('retrieve'), name='ad-detail'),
+    path('api/proposals/my/', ExchangeProposalViewSet.as_async_view('my_proposals'), name='proposal-my-proposals'),
+    path('', include(settings.ROOT_URLCONF)),
+]
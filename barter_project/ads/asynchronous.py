@@ -0,0 +1,92 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.urls import resolve
+from rest_framework.exceptions import APIException
+
+
+async def fallback(request):
+    # запрос, который async-путь не покрывает, обслуживает прежняя синхронная view из ROOT_URLCONF
+    match = resolve(request.path_info, urlconf=settings.ROOT_URLCONF)
+    request.resolver_match = match
+    return await sync_to_async(match.func)(request, *match.args, **match.kwargs)
+
+
+class AsyncGetMixin:
+    """GET без перехода в поток на каждый запрос: ORM через aget/aiterator, пользователь через auser.
+
+    as_async_view() подключается в ADS_ASGI_URLCONF; другие методы и параметры вне async_query_params
+    отдаются синхронной view, так что ответы под ASGI и WSGI совпадают.
+    """
+
+    async_query_params = ()
+
+    @classmethod
+    def as_async_view(cls, **initkwargs):
+        async def view(request, *args, **kwargs):
+            self = cls(**initkwargs)
+            self.setup(request, *args, **kwargs)
+            if not self.async_supported(request):
+                return await fallback(request)
+            # ленивый пользователь из AuthenticationMiddleware полез бы в сессию синхронно
+            request.user = await request.auser()
+            return await self.adispatch(request, *args, **kwargs)
+
+        view.view_class = cls
+        view.view_initkwargs = initkwargs
+        return view
+
+    def async_supported(self, request):
+        return request.method == 'GET' and all(name in self.async_query_params for name in request.GET)
+
+    async def adispatch(self, request, *args, **kwargs):
+        response = await self.aget(request, *args, **kwargs)
+        # рендер без ввода-вывода: пользователь, сессия и сообщения уже загружены
+        return response.render() if hasattr(response, 'render') else response
+
+
+class AsyncViewSetMixin(AsyncGetMixin):
+    # действие -> параметры запроса, с которыми оно обслуживается асинхронно (обработчик a<действие>)
+    async_actions = {}
+
+    @classmethod
+    def as_async_view(cls, action, **initkwargs):
+        return super().as_async_view(action_map={'get': action}, **initkwargs)
+
+    def async_supported(self, request):
+        params = self.async_actions.get(self.action_map['get'])
+        return (
+            params is not None and request.method == 'GET'
+            # браузерный API строит формы синхронно
+            and 'text/html' not in request.headers.get('Accept', '')
+            and all(name in params for name in request.GET)
+            and all(hasattr(authenticator, 'aauthenticate') for authenticator in self.get_authenticators())
+        )
+
+    async def adispatch(self, request, *args, **kwargs):
+        # APIView.dispatch, только аутентификация и обработчик ожидаются
+        self.args, self.kwargs = args, kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+        try:
+            await self.aperform_authentication(request)
+            self.initial(request, *args, **kwargs)
+            response = await getattr(self, f'a{self.action}')(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response.render() if hasattr(self.response, 'render') else self.response
+
+    async def aperform_authentication(self, request):
+        # Request._authenticate с aauthenticate; после него request.user уже не вызывает синхронных аутентификаторов
+        for authenticator in request.authenticators:
+            try:
+                user_auth = await authenticator.aauthenticate(request)
+            except APIException:
+                request._not_authenticated()
+                raise
+            if user_auth is not None:
+                request._authenticator = authenticator
+                request.user, request.auth = user_auth
+                return
+        request._not_authenticated()
@@ -0,0 +1,105 @@
+import copy
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from drf_spectacular.contrib.rest_framework_simplejwt import SimpleJWTScheme
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from .cache import bump_version, get_version
+
+USER_VERSION_KEY = 'ads:auth:version:{}'
+USER_KEY = 'ads:auth:user:{}:{}'
+# второй уровень — словарь в памяти процесса; при переполнении просто сбрасывается
+LOCAL_MAX_SIZE = 10000
+
+_local = {}
+
+
+def user_version(user_id):
+    return get_version(USER_VERSION_KEY.format(user_id))
+
+
+def invalidate_user(user_id):
+    bump_version(USER_VERSION_KEY.format(user_id))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication без SELECT пользователя на каждый запрос.
+
+    Пользователь кэшируется по (id, версия) на ADS_AUTH_CACHE_TTL: в памяти процесса и в общем кэше.
+    Версию поднимает любое сохранение или удаление пользователя (деактивация, смена пароля), поэтому
+    после них следующий запрос снова идёт в БД; изменения через .update() живут не дольше TTL.
+    """
+
+    def get_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        if user_id is None:
+            return super().get_user(validated_token)
+        key, user = self.cached_user(user_id)
+        if user is None:
+            user = super().get_user(validated_token)
+            self.remember(key, user)
+        return self.checked_user(user, validated_token)
+
+    async def aauthenticate(self, request):
+        # то же, что authenticate(), но промах кэша читает пользователя через async ORM
+        header = self.get_header(request)
+        if header is None:
+            return None
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+        validated_token = self.get_validated_token(raw_token)
+        return await self.aget_user(validated_token), validated_token
+
+    async def aget_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        if user_id is None:
+            # без id JWTAuthentication.get_user падает раньше обращения к БД
+            return super().get_user(validated_token)
+        key, user = self.cached_user(user_id)
+        if user is None:
+            try:
+                user = await self.user_model.objects.aget(**{api_settings.USER_ID_FIELD: user_id})
+            except self.user_model.DoesNotExist:
+                raise AuthenticationFailed('Пользователь не найден', code='user_not_found')
+            self.remember(key, user)
+        return self.checked_user(user, validated_token)
+
+    def cached_user(self, user_id):
+        key = USER_KEY.format(user_id, user_version(user_id))
+        entry = _local.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            return key, entry[0]
+        user = cache.get(key)
+        if user is not None:
+            self.remember_locally(key, user)
+        return key, user
+
+    def remember(self, key, user):
+        cache.set(key, user, settings.ADS_AUTH_CACHE_TTL)
+        self.remember_locally(key, user)
+
+    def remember_locally(self, key, user):
+        if len(_local) >= LOCAL_MAX_SIZE:
+            _local.clear()
+        _local[key] = (user, time.monotonic() + settings.ADS_AUTH_CACHE_TTL)
+
+    def checked_user(self, user, validated_token):
+        # те же проверки, что у JWTAuthentication: токен мог быть выпущен до смены пароля
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed('Пользователь неактивен', code='user_inactive')
+        if api_settings.CHECK_REVOKE_TOKEN and (
+                validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password)):
+            raise AuthenticationFailed('Пароль пользователя изменён', code='password_changed')
+        # у каждого запроса своя копия: кэш связей и атрибуты, выставленные view, не протекают в соседние
+        return copy.copy(user)
+
+
+class CachedJWTScheme(SimpleJWTScheme):
+    # drf-spectacular сопоставляет схему аутентификации по точному классу
+    target_class = CachedJWTAuthentication
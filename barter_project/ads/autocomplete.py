@@ -0,0 +1,197 @@
+import logging
+import threading
+import time
+from bisect import bisect_left, insort
+from datetime import timedelta
+from heapq import nsmallest
+
+from django.conf import settings
+from django.db import connection
+
+from .models import Ad
+from .search import WORD_RE
+
+# изменения догружаются по updated_at с нахлёстом: строка могла закоммититься позже, чем её updated_at
+REFRESH_OVERLAP = timedelta(seconds=30)
+# удаления в других процессах догрузкой не видны, поэтому время от времени индекс строится заново
+REBUILD_SECONDS = 3600
+# лучшие подсказки для префиксов не длиннее этого запоминаются: под «к» подходит заметная часть индекса
+MEMO_PREFIX_LENGTH = 2
+# подсказок в ответе не больше (см. autocomplete во views)
+MEMO_LIMIT = 50
+# после последнего символа любой строки: верхняя граница диапазона ключей с префиксом
+PREFIX_END = '\U0010ffff'
+
+logger = logging.getLogger('ads.autocomplete')
+
+
+def normalize(title):
+    return ' '.join(WORD_RE.findall(title.lower()))
+
+
+def suffixes(norm):
+    # хвост названия с начала каждого слова: «кни» находит «детский книга Nike»
+    return [norm[match.start():] for match in WORD_RE.finditer(norm)]
+
+
+class TitleIndex:
+    """Подсказки названий в памяти процесса: выше те, под которыми больше объявлений.
+
+    Префикс ищется bisect'ом по отсортированному списку (хвост, название). Изменения своего процесса
+    приходят сигналами после коммита, чужие — догрузкой по updated_at не чаще ADS_AUTOCOMPLETE_REFRESH_SECONDS.
+    Построение и догрузка идут в фоновом потоке и подменяют индекс целиком под коротким локом: запрос
+    никогда не ждёт SQL, а до первого построения (его запускает старт сервера, warm) подсказок просто нет.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.worker = None
+        self.built = None
+        self.refreshed = None
+        # изменения из сигналов, пришедшие, пока строится новый индекс: применяются к нему после подмены
+        self.journal = None
+        self.clear()
+
+    def clear(self):
+        self.keys = []
+        # нормализованное название -> [как показывать, число объявлений]
+        self.titles = {}
+        self.ads = {}
+        self.watermark = None
+        self.memo = {}
+
+    def put(self, ad_id, title):
+        norm = normalize(title)
+        old = self.ads.get(ad_id)
+        if old == norm:
+            return
+        self.memo.clear()
+        if old is not None:
+            self.release(old)
+        self.ads[ad_id] = norm
+        entry = self.titles.get(norm)
+        if entry is not None:
+            entry[1] += 1
+            return
+        self.titles[norm] = [title.strip(), 1]
+        for suffix in suffixes(norm):
+            insort(self.keys, (suffix, norm))
+
+    def discard(self, ad_id):
+        norm = self.ads.pop(ad_id, None)
+        if norm is not None:
+            self.memo.clear()
+            self.release(norm)
+
+    def release(self, norm):
+        entry = self.titles[norm]
+        entry[1] -= 1
+        if entry[1]:
+            return
+        del self.titles[norm]
+        for suffix in suffixes(norm):
+            del self.keys[bisect_left(self.keys, (suffix, norm))]
+
+    def apply(self, changes):
+        for ad_id, title in changes:
+            if title is None:
+                self.discard(ad_id)
+            else:
+                self.put(ad_id, title)
+
+    def rebuild(self):
+        with self.lock:
+            self.journal = []
+        # при первой загрузке insort на каждое название дорог: собираем без сортировки и сортируем разом
+        keys, titles, ads, watermark = [], {}, {}, None
+        for ad_id, title, updated_at in Ad.objects.values_list('pk', 'title', 'updated_at').iterator(chunk_size=5000):
+            norm = normalize(title)
+            ads[ad_id] = norm
+            entry = titles.setdefault(norm, [title.strip(), 0])
+            if not entry[1]:
+                keys += [(suffix, norm) for suffix in suffixes(norm)]
+            entry[1] += 1
+            watermark = max(watermark or updated_at, updated_at)
+        keys.sort()
+        with self.lock:
+            self.clear()
+            self.keys, self.titles, self.ads, self.watermark = keys, titles, ads, watermark
+            self.apply(self.journal)
+            self.journal = None
+            self.built = time.monotonic()
+
+    def load_changes(self):
+        # выборка без лока, применение — под ним
+        with self.lock:
+            watermark = self.watermark
+        queryset = Ad.objects.all()
+        if watermark is not None:
+            queryset = queryset.filter(updated_at__gte=watermark - REFRESH_OVERLAP)
+        rows = list(queryset.values_list('pk', 'title', 'updated_at'))
+        with self.lock:
+            self.apply((ad_id, title) for ad_id, title, _ in rows)
+            for *_, updated_at in rows:
+                self.watermark = max(self.watermark or updated_at, updated_at)
+
+    def refresh(self):
+        """Строит индекс заново раз в REBUILD_SECONDS, иначе догружает изменения; синхронно, в вызывающем потоке."""
+        started = time.monotonic()
+        if self.built is None or started - self.built > REBUILD_SECONDS:
+            self.rebuild()
+        else:
+            self.load_changes()
+        self.refreshed = started
+
+    def run(self):
+        try:
+            self.refresh()
+        except Exception:
+            logger.exception('Индекс подсказок не обновился')
+        finally:
+            # поток не из пула запросов: закрыть его соединение больше некому
+            connection.close()
+
+    def warm(self):
+        # запускает построение в фоне, если оно ещё не идёт: при старте сервера и из запросов
+        with self.lock:
+            if self.worker is not None and self.worker.is_alive():
+                return
+            self.worker = threading.Thread(target=self.run, name='title-index', daemon=True)
+            self.worker.start()
+
+    def ensure_fresh(self):
+        if self.refreshed is None or time.monotonic() - self.refreshed >= settings.ADS_AUTOCOMPLETE_REFRESH_SECONDS:
+            self.warm()
+
+    def suggest(self, prefix, limit):
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        self.ensure_fresh()
+        with self.lock:
+            best = self.memo.get(prefix)
+            if best is None:
+                start = bisect_left(self.keys, (prefix,))
+                end = bisect_left(self.keys, (prefix + PREFIX_END,), start)
+                matched = {norm for _, norm in self.keys[start:end]}
+                best = nsmallest(MEMO_LIMIT, matched, key=lambda norm: (-self.titles[norm][1], norm))
+                if len(prefix) <= MEMO_PREFIX_LENGTH:
+                    self.memo[prefix] = best
+            return [{'title': self.titles[norm][0], 'count': self.titles[norm][1]} for norm in best[:limit]]
+
+    def invalidate(self):
+        # следующее обновление построит индекс заново
+        with self.lock:
+            self.clear()
+            self.built = self.refreshed = None
+
+    def changed(self, ad_id, title=None):
+        # из сигналов: пока индекса нет и он не строится, обновлять нечего
+        with self.lock:
+            if self.journal is not None:
+                self.journal.append((ad_id, title))
+            if self.built is not None:
+                self.apply([(ad_id, title)])
+
+
+title_index = TitleIndex()
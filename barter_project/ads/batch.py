@@ -0,0 +1,97 @@
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+
+from . import cache
+from .jobs import enqueue
+from .models import Ad, ExchangeProposal, FacetCount, ProposalEvent, ProposalParticipant, facet_totals
+from .serializer import ProposalBatchItemSerializer
+
+ERRORS = {
+    'not_found': 'Предложение не найдено',
+    'forbidden': 'Вы не получатель этого предложения',
+    'conflict': 'Предложение уже обработано',
+}
+
+
+def change_statuses(user, actions):
+    """Права на все id проверяются одной выборкой, статусы меняются set-based UPDATE; результат — по элементу."""
+    proposals = {
+        pk: ((sender, receiver), owner)
+        for pk, sender, receiver, owner in ExchangeProposal.objects.filter(
+            pk__in={item['id'] for item in actions}
+        ).values_list('pk', 'ad_sender_id', 'ad_receiver_id', 'ad_receiver__user_id')
+    }
+
+    results, allowed = [dict(item) for item in actions], []
+    for result in results:
+        proposal = proposals.get(result['id'])
+        if proposal is None:
+            result['error'] = 'not_found'
+        elif proposal[1] != user.pk:
+            result['error'] = 'forbidden'
+        else:
+            allowed.append(result)
+
+    if allowed:
+        statuses = ExchangeProposal.objects.change_statuses(
+            [(result['id'], result['action']) for result in allowed],
+            {pk: ads for pk, (ads, owner) in proposals.items()},
+        )
+        for result, status in zip(allowed, statuses):
+            if status == 'conflict':
+                result['error'] = status
+            else:
+                result['status'] = status
+
+    for result in results:
+        if 'error' in result:
+            result['detail'] = ERRORS[result['error']]
+    return results
+
+
+def create_proposals(user, items):
+    """Создаёт предложения пачкой: объявления проверяются одной выборкой, вставка — bulk_create."""
+    results, valid = [], []
+    # один экземпляр на всю пачку, как при импорте объявлений
+    serializer = ProposalBatchItemSerializer()
+    for index, item in enumerate(items):
+        result = {'index': index}
+        results.append(result)
+        try:
+            valid.append((result, serializer.run_validation(item)))
+        except ValidationError as error:
+            result['errors'] = error.detail
+
+    owners = dict(Ad.objects.filter(
+        pk__in={data[name] for result, data in valid for name in ('ad_sender_id', 'ad_receiver_id')}
+    ).values_list('pk', 'user_id'))
+
+    created = []
+    for result, data in valid:
+        if owners.get(data['ad_sender_id']) != user.pk:
+            result['errors'] = {'ad_sender_id': ['Можно отправлять предложения только от своих объявлений']}
+        elif data['ad_receiver_id'] not in owners:
+            result['errors'] = {'ad_receiver_id': ['Объявление не найдено']}
+        else:
+            created.append((result, ExchangeProposal(**data)))
+    if not created:
+        return results
+
+    proposals = [proposal for result, proposal in created]
+    # bulk_create обходит save и сигналы: участников, события, фасеты, кэш и задачу поиска циклов делаем сами
+    with transaction.atomic():
+        ExchangeProposal.objects.bulk_create(proposals)
+        ProposalParticipant.objects.bulk_create([
+            ProposalParticipant(user_id=user_id, proposal=proposal, created_at=proposal.created_at)
+            for proposal in proposals
+            for user_id in {owners[proposal.ad_sender_id], owners[proposal.ad_receiver_id]}
+        ])
+        ProposalEvent.objects.record([proposal.pk for proposal in proposals])
+        FacetCount.objects.apply(facet_totals(proposals))
+        enqueue('discover_cycles', proposal_ids=[proposal.pk for proposal in proposals])
+    cache.bump_ads(*{ad for proposal in proposals for ad in (proposal.ad_sender_id, proposal.ad_receiver_id)},
+                   listing=False)
+
+    for result, proposal in created:
+        result.update(id=proposal.pk, status=proposal.status)
+    return results
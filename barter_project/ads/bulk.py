@@ -0,0 +1,118 @@
+import codecs
+import csv
+import json
+from itertools import islice
+
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+
+from . import cache
+from .models import Ad, FacetCount, facet_totals
+from .rows import row_serializer
+from .serializer import AdSerializer
+
+MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def detect_type(requested, content_type='', name=''):
+    if requested:
+        return requested if requested in MEDIA_TYPES else None
+    for kind, media_type in MEDIA_TYPES.items():
+        if content_type.startswith(media_type) or name.endswith(f'.{kind}'):
+            return kind
+    return 'ndjson' if name.endswith('.jsonl') else None
+
+
+def read_ndjson(lines):
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield number, None, {'non_field_errors': [f'Некорректный JSON: {error}']}
+            continue
+        if isinstance(row, dict):
+            yield number, row, None
+        else:
+            yield number, None, {'non_field_errors': ['Ожидался JSON-объект']}
+
+
+def read_csv(lines):
+    reader = csv.DictReader(codecs.iterdecode(lines, 'utf-8-sig'))
+    for row in reader:
+        # пустые ячейки CSV — это отсутствующие значения, а не пустые строки
+        yield reader.line_num, {key: value for key, value in row.items() if key and value != ''}, None
+
+
+def read_rows(lines, kind):
+    """Построчно разбирает поток байтовых строк, не читая его целиком: (номер строки, dict, ошибка)."""
+    return read_ndjson(lines) if kind == 'ndjson' else read_csv(lines)
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def import_ads(user, rows, chunk_size, max_errors=1000):
+    """Проверяет строки через AdSerializer и вставляет годные пачками bulk_create; ошибки — по номерам строк."""
+    report = {'created': 0, 'failed': 0, 'errors': []}
+    # один экземпляр на весь импорт: построение полей ModelSerializer дороже самой проверки строки
+    serializer = AdSerializer()
+    for chunk in chunked(rows, chunk_size):
+        ads = []
+        for line, row, errors in chunk:
+            if errors is None:
+                try:
+                    ads.append(Ad(user=user, **serializer.run_validation(row)))
+                    continue
+                except ValidationError as error:
+                    errors = error.detail
+            report['failed'] += 1
+            if len(report['errors']) < max_errors:
+                report['errors'].append({'line': line, 'errors': errors})
+
+        # bulk_create обходит save и сигналы: счётчики фасетов и версию кэша обновляем сами
+        with transaction.atomic():
+            Ad.objects.bulk_create(ads)
+            FacetCount.objects.apply(facet_totals(ads))
+        report['created'] += len(ads)
+
+    if report['created']:
+        cache.bump_ads()
+    return report
+
+
+class Echo:
+    # csv.writer пишет в «файл», а нам нужна строка для отдачи генератором
+    def write(self, value):
+        return value
+
+
+def flatten(data, headers):
+    # ячейки по заголовкам, а не по ключам: вложенный null (фото без превью) не сдвигает колонки
+    for header in headers:
+        value = data
+        for key in header.split('.'):
+            value = value[key] if value is not None else None
+        yield value
+
+
+def export_ads(queryset, kind, chunk_size):
+    """Генератор строк экспорта: серверный курсор по chunk_size строк, память не растёт с объёмом выборки."""
+    rows = row_serializer(AdSerializer)
+    values = queryset.values(*rows.columns).iterator(chunk_size=chunk_size)
+    if kind == 'ndjson':
+        for row in values:
+            yield json.dumps(rows.to_representation(row), ensure_ascii=False) + '\n'
+        return
+
+    writer = csv.writer(Echo())
+    yield writer.writerow(rows.headers)
+    for row in values:
+        yield writer.writerow(list(flatten(rows.to_representation(row), rows.headers)))
@@ -0,0 +1,155 @@
+import hashlib
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+
+from .routers import pin_primary
+
+GLOBAL_VERSION_KEY = 'ads:version'
+AD_VERSION_KEY = 'ads:version:{}'
+RESPONSE_KEY = 'ads:response:{}:{}'
+# заголовки, которые сохраняются вместе с телом: валидаторы для 304 и Vary/Allow, без которых попадание
+# отличалось бы от промаха и нижестоящий кэш смешал бы JSON и browsable API
+STORED_HEADERS = ('ETag', 'Last-Modified', 'Vary', 'Allow')
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _initial_version():
+    # если счётчик вытеснили из кэша, новый старт всё равно больше любого прежнего значения
+    return time.time_ns() // 1000
+
+
+def get_version(key):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _initial_version(), None)
+        version = cache.get(key, 0)
+    return version
+
+
+def bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, _initial_version(), None)
+
+
+def global_version():
+    return get_version(GLOBAL_VERSION_KEY)
+
+
+def ad_version(ad_id):
+    return get_version(AD_VERSION_KEY.format(ad_id))
+
+
+def bump_ads(*ad_ids, listing=True):
+    """Сбрасывает кэш ответов по объявлениям после коммита текущей транзакции (вне транзакции — сразу).
+
+    Сброс до коммита не годится: параллельный GET успел бы прочитать старые строки и положить их
+    под уже новую версию — и они жили бы в кэше до истечения таймаута.
+    """
+    def bump():
+        for ad_id in ad_ids:
+            bump_version(AD_VERSION_KEY.format(ad_id))
+        if listing:
+            bump_version(GLOBAL_VERSION_KEY)
+
+    transaction.on_commit(bump)
+
+
+def record(outcome):
+    with _stats_lock:
+        _stats[outcome] += 1
+
+
+def cache_stats():
+    with _stats_lock:
+        return {'hits': _stats['hit'], 'misses': _stats['miss']}
+
+
+class AnonymousResponseCacheMixin:
+    # кэшируем только анонимные GET с параметрами из cache_query_params;
+    # любой другой параметр (format, mine, ...) отключает кэш для запроса
+    cache_query_params = ()
+    cache_content_types = ('application/json',)
+
+    def get_cache_version(self, request, *args, **kwargs):
+        if 'pk' in kwargs:
+            return ad_version(kwargs['pk'])
+        return global_version()
+
+    def get_response_cache_key(self, request, *args, **kwargs):
+        if request.method != 'GET' or request.user.is_authenticated or 'HTTP_AUTHORIZATION' in request.META:
+            return None
+        if any(name not in self.cache_query_params for name in request.GET):
+            return None
+
+        params = sorted(
+            (name, value.strip()) for name in request.GET for value in request.GET.getlist(name)
+            if value.strip() and not (name == 'page' and value.strip() == '1')
+        )
+        # схема и хост — часть ключа: в закэшированных списках абсолютные ссылки next/previous
+        raw = repr((request.build_absolute_uri(request.path), params, request.META.get('HTTP_ACCEPT', '')))
+        digest = hashlib.md5(raw.encode()).hexdigest()
+        return RESPONSE_KEY.format(self.get_cache_version(request, *args, **kwargs), digest)
+
+    def dispatch(self, request, *args, **kwargs):
+        key = self.get_response_cache_key(request, *args, **kwargs)
+        if key is None:
+            return super().dispatch(request, *args, **kwargs)
+        response = self.cached_response(request, key)
+        if response is None:
+            # промах читает с primary: отставшая реплика положила бы под уже новую версию старые строки,
+            # и они жили бы в кэше до таймаута; попадания в БД не ходят вовсе
+            pin_primary()
+            response = self.store_response(key, super().dispatch(request, *args, **kwargs))
+        return response
+
+    async def adispatch(self, request, *args, **kwargs):
+        # кэш читается синхронно: для LocMemCache это дешевле перехода в поток,
+        # а async-методы остальных бэкендов Django всё равно уходят в поток
+        key = self.get_response_cache_key(request, *args, **kwargs)
+        if key is None:
+            return await super().adispatch(request, *args, **kwargs)
+        response = self.cached_response(request, key)
+        if response is None:
+            pin_primary()
+            response = self.store_response(key, await super().adispatch(request, *args, **kwargs))
+        return response
+
+    def cached_response(self, request, key):
+        cached = cache.get(key)
+        if cached is None:
+            record('miss')
+            return None
+        record('hit')
+        content, content_type, headers = cached
+        response = HttpResponse(content, content_type=content_type)
+        for header, value in headers.items():
+            response[header] = value
+        response['X-Cache'] = 'HIT'
+        # закэшированная копия тоже отвечает 304 на совпавший ETag
+        return get_conditional_response(
+            request, etag=headers.get('ETag'), response=response,
+            last_modified=parse_http_date_safe(headers.get('Last-Modified', '')),
+        )
+
+    def store_response(self, key, response):
+        if hasattr(response, 'render') and not response.is_rendered:
+            response.render()
+        if response.status_code == 200 and response['Content-Type'].startswith(self.cache_content_types):
+            headers = {header: response[header] for header in STORED_HEADERS if header in response}
+            cache.set(
+                key, (response.content, response['Content-Type'], headers), settings.ADS_RESPONSE_CACHE_TIMEOUT
+            )
+        response['X-Cache'] = 'MISS'
+        return response
@@ -0,0 +1,178 @@
+import hashlib
+from functools import reduce
+
+from django.core.exceptions import ValidationError
+from django.db.models import Count, Max
+from django.http import Http404
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.response import Response
+
+from .pagination import KeysetPagination
+from .rows import row_serializer
+
+
+def make_etag(*parts, weak=False):
+    digest = hashlib.md5(repr(parts).encode()).hexdigest()
+    return f'W/"{digest}"' if weak else f'"{digest}"'
+
+
+def not_modified(request, etag, last_modified=None):
+    """304 (или 412), если клиентская копия актуальна, иначе None."""
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified and int(last_modified.timestamp())
+    )
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def lookup(obj, path):
+    # строки из .values() уже плоские, у моделей идём по связям
+    return obj[path] if isinstance(obj, dict) else reduce(getattr, path.split('__'), obj)
+
+
+def set_validators(response, etag, last_modified=None):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
+
+
+class ConditionalGetMixin:
+    # ETag считается по updated_at до сериализации: detail — строгий по самому объекту,
+    # list — слабый по агрегату (count + max updated_at); для 304 тело не строится вовсе
+    # списки читаются через .values() и RowSerializer вместо полей ModelSerializer
+    list_from_values = False
+
+    def get_row_serializer(self, prefix=''):
+        return row_serializer(self.get_serializer_class(), prefix)
+
+    def get_etag_fields(self):
+        # updated_at самого объекта и вложенных в ответ моделей, у которых он есть
+        return ['updated_at'] + [
+            f'{path}__updated_at' for path, model in self.get_row_serializer().relations
+            if any(field.name == 'updated_at' for field in model._meta.concrete_fields)
+        ]
+
+    def get_object_validators(self, obj):
+        stamps = [lookup(obj, field) for field in self.get_etag_fields()]
+        # форма ответа зависит от параметров (?fields=, ?expand=) и формата
+        shape = (self.request.META.get('QUERY_STRING', ''), self.request.META.get('HTTP_ACCEPT', ''))
+        return make_etag(obj.pk, *stamps, shape), max(stamps)
+
+    def list_etag(self, *parts):
+        request = self.request
+        return make_etag(
+            request.get_full_path(), request.user.pk, request.META.get('HTTP_ACCEPT', ''), *parts, weak=True
+        )
+
+    def get_list_validators(self, queryset, prefix=''):
+        return self.list_validators(queryset.order_by().aggregate(**self.list_stats(prefix)))
+
+    async def aget_list_validators(self, queryset, prefix=''):
+        return self.list_validators(await queryset.order_by().aaggregate(**self.list_stats(prefix)))
+
+    def list_stats(self, prefix):
+        return {'count': Count('pk'), **{f'last_{field}': Max(prefix + field) for field in self.get_etag_fields()}}
+
+    def list_validators(self, stats):
+        # этот же COUNT отдаём постраничной пагинации вместо второго
+        self.known_count = stats['count']
+        # Last-Modified для списков не отдаём: удаление не сдвигает max(updated_at)
+        return self.list_etag(sorted(stats.items()))
+
+    def get_page_validators(self, page, prefix=''):
+        # курсорный режим обходится без COUNT(*), поэтому ETag строится по уже выбранной странице
+        return self.list_etag([
+            (lookup(obj, 'pk'), *(lookup(obj, prefix + field) for field in self.get_etag_fields()))
+            for obj in page
+        ])
+
+    def conditional_list(self, request, queryset, prefix='', unwrap=None):
+        queryset, rows = self.list_rows(queryset, prefix)
+        page = None
+        if self.keyset_requested(request):
+            page = self.paginate_queryset(queryset)
+            etag = self.get_page_validators(page, prefix)
+        else:
+            etag = self.get_list_validators(queryset, prefix)
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+
+        if page is None:
+            page = self.paginate_queryset(queryset)
+        return self.list_response(queryset if page is None else page, page is not None, rows, unwrap, etag)
+
+    async def aconditional_list(self, request, queryset, prefix='', unwrap=None):
+        # как conditional_list, но агрегат и страница читаются через async ORM
+        queryset, rows = self.list_rows(queryset, prefix)
+        page = None
+        if self.keyset_requested(request):
+            page = await self.paginator.apaginate_queryset(queryset, request, view=self)
+            etag = self.get_page_validators(page, prefix)
+        else:
+            etag = await self.aget_list_validators(queryset, prefix)
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+
+        if page is None:
+            page = await self.paginator.apaginate_queryset(queryset, request, view=self)
+        if page is None:
+            return self.list_response([obj async for obj in queryset], False, rows, unwrap, etag)
+        return self.list_response(page, True, rows, unwrap, etag)
+
+    def list_rows(self, queryset, prefix):
+        rows = self.get_row_serializer(prefix) if self.list_from_values else None
+        if rows is not None:
+            # кроме колонок ответа нужны поля курсора и ETag
+            ordering = getattr(self, 'keyset_ordering', KeysetPagination.ordering)
+            etag_columns = [prefix + field for field in self.get_etag_fields()]
+            queryset = queryset.values('pk', *(field.lstrip('-') for field in ordering), *etag_columns, *rows.columns)
+        return queryset, rows
+
+    def keyset_requested(self, request):
+        use_keyset = getattr(self.paginator, 'use_keyset', None)
+        return use_keyset is not None and use_keyset(request)
+
+    def list_response(self, objects, paginated, rows, unwrap, etag):
+        if rows is not None:
+            data = rows.serialize(objects)
+        else:
+            data = self.get_serializer([unwrap(obj) for obj in objects] if unwrap else objects, many=True).data
+        response = self.get_paginated_response(data) if paginated else Response(data)
+        return set_validators(response, etag)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.object_response(request, self.get_object())
+
+    async def aretrieve(self, request, *args, **kwargs):
+        return self.object_response(request, await self.aget_object())
+
+    async def aget_object(self):
+        # get_object() через aget: те же фильтры, lookup и проверка прав на объект
+        queryset = self.filter_queryset(self.get_queryset())
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            obj = await queryset.aget(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        except queryset.model.DoesNotExist:
+            raise Http404(f'No {queryset.model._meta.object_name} matches the given query.')
+        except (TypeError, ValueError, ValidationError):
+            raise Http404
+        self.check_object_permissions(self.request, obj)
+        return obj
+
+    def object_response(self, request, instance):
+        etag, last_modified = self.get_object_validators(instance)
+        response = not_modified(request, etag, last_modified)
+        if response is None:
+            response = set_validators(Response(self.get_serializer(instance).data), etag, last_modified)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_list(request, self.filter_queryset(self.get_queryset()))
+
+    async def alist(self, request, *args, **kwargs):
+        return await self.aconditional_list(request, self.filter_queryset(self.get_queryset()))
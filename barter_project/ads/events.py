@@ -0,0 +1,120 @@
+import asyncio
+import json
+import threading
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.db import connection, transaction
+
+# канал Postgres NOTIFY: полезная нагрузка — id событий через запятую
+CHANNEL = 'ads_proposal_events'
+# NOTIFY принимает до 8000 байт
+NOTIFY_PAYLOAD_LIMIT = 7900
+
+Event = namedtuple('Event', 'id user_id proposal_id status ad_sender_id ad_receiver_id')
+
+EVENT_TYPES = {'pending': 'proposal.created', 'accepted': 'proposal.accepted', 'declined': 'proposal.declined'}
+
+
+def format_event(event):
+    data = json.dumps({
+        'id': event.proposal_id, 'status': event.status,
+        'ad_sender': event.ad_sender_id, 'ad_receiver': event.ad_receiver_id,
+    })
+    return f'id: {event.id}\nevent: {EVENT_TYPES[event.status]}\ndata: {data}\n\n'.encode()
+
+
+def parse_event_id(value):
+    # Last-Event-ID от клиента: мусор равносилен его отсутствию
+    return int(value) if value and value.isdigit() else None
+
+
+class Subscription:
+    __slots__ = ('user_id', 'loop', 'queue', 'overflowed')
+
+    def __init__(self, user_id, loop, size):
+        self.user_id = user_id
+        self.loop = loop
+        self.queue = asyncio.Queue(size)
+        self.overflowed = False
+
+    def put(self, event):
+        # вызывается в цикле подписчика; медленный клиент не копит память — он потом дочитает из БД
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    def lost(self):
+        self.overflowed = True
+        # разбудить ожидание, если очередь пуста
+        self.put(None)
+
+
+class Broker:
+    """Fan-out событий по пользователям внутри процесса.
+
+    Подписка — очередь в цикле событий ASGI-сервера; publish() можно звать из любого потока
+    (после коммита в синхронной view или из слушателя NOTIFY).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = defaultdict(set)
+
+    def subscribe(self, user_id, loop):
+        subscription = Subscription(user_id, loop, settings.ADS_EVENTS_QUEUE_SIZE)
+        with self.lock:
+            self.subscriptions[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.user_id]
+
+    def publish(self, events):
+        with self.lock:
+            targets = [
+                (subscription, event)
+                for event in events for subscription in self.subscriptions.get(event.user_id, ())
+            ]
+        for subscription, event in targets:
+            subscription.loop.call_soon_threadsafe(subscription.put, event)
+
+    def lost(self):
+        # события могли пройти мимо (обрыв LISTEN): все подписчики докачивают из БД
+        with self.lock:
+            subscriptions = [subscription for group in self.subscriptions.values() for subscription in group]
+        for subscription in subscriptions:
+            subscription.loop.call_soon_threadsafe(subscription.lost)
+
+    def count(self):
+        with self.lock:
+            return sum(len(group) for group in self.subscriptions.values())
+
+
+broker = Broker()
+
+
+def dispatch(events):
+    """Рассылает только что записанные события, когда их транзакция закоммитится."""
+    if not events:
+        return
+    if not settings.ADS_EVENTS_NOTIFY:
+        transaction.on_commit(lambda: broker.publish(events))
+        return
+    # NOTIFY доставляется только при коммите, в том числе слушателю этого же процесса
+    chunks, chunk = [], ''
+    for event in events:
+        if len(chunk) + len(str(event.id)) + 1 > NOTIFY_PAYLOAD_LIMIT:
+            chunks.append(chunk)
+            chunk = ''
+        chunk = f'{chunk},{event.id}' if chunk else str(event.id)
+    chunks.append(chunk)
+    with connection.cursor() as cursor:
+        for chunk in chunks:
+            cursor.execute('SELECT pg_notify(%s, %s)', [CHANNEL, chunk])
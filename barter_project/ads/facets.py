@@ -0,0 +1,32 @@
+from django.db.models import Count
+from rest_framework.decorators import action
+from rest_framework.response import Response
+
+from .models import FacetCount
+
+
+def live_counts(queryset, dimensions):
+    queryset = queryset.order_by()
+    return {
+        dimension: dict(
+            queryset.values_list(dimension).annotate(count=Count('pk')).order_by('-count', dimension)
+        )
+        for dimension in dimensions
+    }
+
+
+class FacetsMixin:
+    # без фильтров счётчики берутся из FacetCount одной выборкой; с фильтром или поиском
+    # выборка уже сужена индексом, и GROUP BY считается по ней
+    facet_fields = ()
+
+    def has_active_filters(self, request):
+        params = {*getattr(self, 'filterset_fields', ()), getattr(self, 'search_param', 'search')}
+        return any(request.query_params.get(name, '').strip() for name in params)
+
+    @action(detail=False, methods=['get'], pagination_class=None)
+    def facets(self, request):
+        if self.has_active_filters(request):
+            counts = live_counts(self.filter_queryset(self.get_queryset()), self.facet_fields)
+            return Response({**counts, 'source': 'live'})
+        return Response({**FacetCount.objects.totals(self.facet_fields), 'source': 'totals'})
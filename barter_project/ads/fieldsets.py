@@ -0,0 +1,34 @@
+from rest_framework.permissions import SAFE_METHODS
+
+from .rows import row_serializer
+from .serializer import FieldSelectionMixin, parse_field_tree
+
+
+class SparseFieldsMixin:
+    """?fields=id,status,ad_sender.title и ?expand=ad_receiver на GET; выборка сужается под запрошенную форму."""
+
+    def get_field_selection(self):
+        request = self.request
+        if request is None or request.method not in SAFE_METHODS:
+            return None, ()
+        params = request.query_params
+        return parse_field_tree(params.get('fields')) or None, parse_field_tree(params.get('expand'))
+
+    def get_serializer(self, *args, **kwargs):
+        if issubclass(self.get_serializer_class(), FieldSelectionMixin):
+            kwargs['fields'], kwargs['expand'] = self.get_field_selection()
+        return super().get_serializer(*args, **kwargs)
+
+    def get_row_serializer(self, prefix=''):
+        return row_serializer(self.get_serializer_class(), prefix, *self.get_field_selection())
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action not in ('list', 'retrieve'):
+            return queryset
+        # join только к вложенным в ответ моделям и только нужные колонки (плюс updated_at для ETag)
+        rows = self.get_row_serializer()
+        relations = [path for path, _ in rows.relations]
+        queryset = queryset.select_related(None).only(*rows.columns, *relations, *self.get_etag_fields())
+        # select_related() без аргументов пошёл бы по всем связям
+        return queryset.select_related(*relations) if relations else queryset
@@ -1,7 +1,23 @@
 from django import forms
+from .images import uploaded_image, validate_image
 from .models import ExchangeProposal, Ad
 
 
+class AdForm(forms.ModelForm):
+    upload = forms.ImageField(label='Фото', required=False, validators=[validate_image])
+
+    class Meta:
+        model = Ad
+        fields = ['title', 'description', 'image_url', 'category', 'condition']
+
+    def save(self, commit=True):
+        upload = self.cleaned_data.get('upload')
+        if upload:
+            for name, value in uploaded_image(upload).items():
+                setattr(self.instance, name, value)
+        return super().save(commit)
+
+
 class ExchangeProposalForm(forms.ModelForm):
     class Meta:
         model = ExchangeProposal
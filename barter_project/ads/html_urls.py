@@ -1,6 +1,6 @@
 from django.urls import path
 from .views import (
-    AdListView, AdDetailView,
+    AdListView, AdCardsView, AdDetailView,
     AdCreateView, AdUpdateView, AdDeleteView, CreateExchangeProposalView, MyExchangeProposalsView, accept_proposal,
     decline_proposal
 )
@@ -9,6 +9,7 @@ from .views import register
 
 urlpatterns = [
     path('', AdListView.as_view(), name='ad_list'),
+    path('ads/cards/', AdCardsView.as_view(), name='ad_cards'),
     path('ad/<int:pk>/', AdDetailView.as_view(), name='ad_detail'),
     path('ad/create/', AdCreateView.as_view(), name='ad_create'),
     path('ad/<int:pk>/edit/', AdUpdateView.as_view(), name='ad_edit'),
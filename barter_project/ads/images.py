@@ -0,0 +1,78 @@
+import hashlib
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models.functions import Now
+from PIL import Image
+
+from . import cache
+from .models import Ad, AdImage
+from .thumbnails import original_path, render_thumbnails, thumbnail_path
+
+# формат Pillow -> расширение оригинала; остальное (TIFF, BMP, PSD…) не принимаем
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp', 'GIF': 'gif'}
+
+
+def validate_image(upload):
+    if upload.size > settings.ADS_IMAGE_MAX_BYTES:
+        raise ValidationError(f'Файл больше {settings.ADS_IMAGE_MAX_BYTES // (1024 * 1024)} МБ')
+    upload.seek(0)
+    try:
+        with Image.open(upload) as image:
+            image_format = image.format
+    except (OSError, Image.DecompressionBombError):
+        raise ValidationError('Не удалось прочитать изображение')
+    finally:
+        upload.seek(0)
+    if image_format not in EXTENSIONS:
+        raise ValidationError('Поддерживаются JPEG, PNG, WebP и GIF')
+
+
+def store_image(upload):
+    """Сохраняет загруженный файл под именем из sha256 содержимого; те же байты второй раз не пишутся."""
+    digest = hashlib.sha256()
+    for chunk in upload.chunks():
+        digest.update(chunk)
+    upload.seek(0)
+    with Image.open(upload) as image:
+        name = f'{digest.hexdigest()}.{EXTENSIONS[image.format]}'
+        width, height = image.size
+    image = AdImage.objects.filter(pk=name).first()
+    if image is not None:
+        return image
+    path = original_path(name)
+    if not default_storage.exists(path):
+        upload.seek(0)
+        default_storage.save(path, upload)
+    image, _ = AdImage.objects.get_or_create(name=name, defaults={'width': width, 'height': height, 'size': upload.size})
+    return image
+
+
+def uploaded_image(upload):
+    # поля объявления для загруженного файла; превью, если их ещё нет, построит задача (сигнал post_save Ad)
+    image = store_image(upload)
+    return {'image': image, 'image_ready': image.ready}
+
+
+def generate_thumbnails(name):
+    """Строит превью для фото name и отмечает готовыми все объявления с ним; повторный вызов безопасен."""
+    image = AdImage.objects.filter(pk=name).first()
+    if image is None:
+        return
+    if not image.ready:
+        with default_storage.open(original_path(name)) as source:
+            data = source.read()
+        thumbnails = render_thumbnails(data, settings.ADS_THUMBNAIL_SIZES, settings.ADS_THUMBNAIL_QUALITY)
+        for (size, fmt), content in thumbnails.items():
+            path = thumbnail_path(name, size, fmt)
+            # повтор после сбоя: storage.save не перезаписывает, а добавил бы суффикс к имени
+            default_storage.delete(path)
+            default_storage.save(path, ContentFile(content))
+        AdImage.objects.filter(pk=name).update(ready=True)
+    ad_ids = list(Ad.objects.filter(image=name, image_ready=False).values_list('pk', flat=True))
+    if ad_ids:
+        # updated_at сдвигается ради ETag и кэша карточек
+        Ad.objects.filter(pk__in=ad_ids).update(image_ready=True, updated_at=Now())
+        cache.bump_ads(*ad_ids)
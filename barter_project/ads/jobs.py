@@ -0,0 +1,82 @@
+import logging
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger('ads.jobs')
+
+# имя задачи -> функция; обработчики живут в ads.tasks, его импортирует AdsConfig.ready
+HANDLERS = {}
+
+
+def handler(name):
+    """Регистрирует функцию как обработчик задачи name.
+
+    Выполнение — «хотя бы один раз»: после падения воркера задача повторится, так что обработчик
+    должен быть идемпотентным. Аргументы — то, что передано в enqueue, после JSON.
+    """
+    def decorator(func):
+        HANDLERS[name] = func
+        return func
+    return decorator
+
+
+def enqueue(name, run_at=None, **payload):
+    """Ставит задачу в очередь в текущей транзакции: откат отменит и её, а воркер увидит её только после коммита."""
+    if name not in HANDLERS:
+        raise ValueError(f'Неизвестная задача: {name}')
+    return Job.objects.create(name=name, payload=payload, run_at=run_at or timezone.now())
+
+
+def backoff(attempts):
+    return min(settings.ADS_JOBS_BACKOFF_SECONDS * 2 ** (attempts - 1), settings.ADS_JOBS_BACKOFF_MAX_SECONDS)
+
+
+def perform(pk, name, payload, attempts):
+    """Выполняет захваченную задачу; успешная удаляется, упавшая откладывается с экспоненциальной паузой."""
+    try:
+        HANDLERS[name](**payload)
+    except Exception:
+        error = traceback.format_exc()
+        if attempts >= settings.ADS_JOBS_MAX_ATTEMPTS or name not in HANDLERS:
+            Job.objects.filter(pk=pk).update(status='failed', locked_at=None, locked_by='', last_error=error)
+            logger.error('Задача %s #%s не выполнена за %s попыток:\n%s', name, pk, attempts, error)
+        else:
+            delay = backoff(attempts)
+            Job.objects.filter(pk=pk).update(
+                status='queued', locked_at=None, locked_by='', last_error=error,
+                run_at=timezone.now() + timedelta(seconds=delay),
+            )
+            logger.warning('Задача %s #%s упала (попытка %s), повтор через %ss', name, pk, attempts, delay)
+        return False
+    Job.objects.filter(pk=pk).delete()
+    return True
+
+
+def run_job(job):
+    # в потоке или процессе воркера соединения с БД, как в запросе, проверяются до и после задачи
+    close_old_connections()
+    try:
+        return perform(*job)
+    finally:
+        close_old_connections()
+
+
+def run_pending(worker='inline'):
+    """Выполняет в текущем потоке все созревшие задачи, включая поставленные ими; возвращает (успешно, упало).
+
+    Для тестов и разовых прогонов, воркер — команда run_jobs.
+    """
+    done = failed = 0
+    while claimed := Job.objects.claim(100, worker):
+        for job in claimed:
+            if perform(*job):
+                done += 1
+            else:
+                failed += 1
+    return done, failed
@@ -0,0 +1,33 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ads.archive import archive_proposals
+from ads.models import ProposalEvent
+
+
+class Command(BaseCommand):
+    help = ('Переносит решённые предложения старше заданного срока в архив короткими транзакциями '
+            'и удаляет события SSE старше ADS_EVENTS_RETENTION_DAYS')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=settings.ADS_ARCHIVE_AFTER_DAYS)
+        parser.add_argument('--batch-size', type=int, default=settings.ADS_ARCHIVE_BATCH_SIZE)
+        parser.add_argument('--max-batches', type=int, default=None, help='по умолчанию — пока есть что переносить')
+        parser.add_argument('--pause', type=float, default=0, help='пауза между партиями, с')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        moved, batches = archive_proposals(
+            options['older_than_days'], options['batch_size'], options['max_batches'], options['pause']
+        )
+        statuses = ', '.join(f'{status}: {count}' for status, count in sorted(moved.items())) or 'нечего'
+        self.stdout.write(
+            f'В архиве {sum(moved.values())} ({statuses}) за {batches} партий, {time.perf_counter() - started:.2f}s'
+        )
+        before = timezone.now() - timedelta(days=settings.ADS_EVENTS_RETENTION_DAYS)
+        trimmed, _ = ProposalEvent.objects.filter(created_at__lt=before).delete()
+        self.stdout.write(f'Удалено событий SSE: {trimmed}')
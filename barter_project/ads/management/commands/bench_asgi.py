@@ -0,0 +1,178 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from io import BytesIO
+from pathlib import Path
+
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+from django.db.models import Count
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from ads.models import Ad, ProposalParticipant
+
+from .bench_endpoints import NO_CACHE, git_commit, percentile
+
+
+class Command(BaseCommand):
+    help = ('Пропускная способность чтений при N одновременных соединениях: ASGI-приложение, вызываемое '
+            'так же, как его вызывает uvicorn, против WSGI-приложения на пуле из N потоков (как gunicorn gthread)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+        parser.add_argument('--requests', type=int, default=400, help='запросов на сценарий и уровень конкурентности')
+        parser.add_argument('--cache', action='store_true', help='не отключать кэш ответов')
+        parser.add_argument('--output', default=None)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        busiest = ProposalParticipant.objects.values('user').annotate(total=Count('id')).order_by('-total').first()
+        if busiest is None:
+            raise CommandError('Нет данных: сначала python manage.py generate_data')
+        rnd = random.Random(options['seed'])
+        ad_ids = list(Ad.objects.order_by('?').values_list('id', flat=True)[:500])
+        token = f'Bearer {AccessToken.for_user(ProposalParticipant.objects.filter(user_id=busiest["user"]).first().user)}'
+
+        scenarios = {
+            'api_ads_cursor': lambda: ('/api/ads/', 'pagination=cursor', {}),
+            'api_ad_detail': lambda: (f'/api/ads/{rnd.choice(ad_ids)}/', '', {}),
+            'api_proposals_my': lambda: ('/api/proposals/my/', 'pagination=cursor', {'authorization': token}),
+            'html_ad_list': lambda: ('/', '', {}),
+        }
+
+        results = {}
+        with override_settings(**({} if options['cache'] else {'CACHES': NO_CACHE})):
+            servers = {'wsgi': WSGIDriver(get_wsgi_application()), 'asgi': ASGIDriver(get_asgi_application())}
+            for name, request in scenarios.items():
+                for concurrency in options['concurrency']:
+                    for server, driver in servers.items():
+                        result = driver.run(request, options['requests'], concurrency)
+                        results.setdefault(name, {}).setdefault(server, {})[concurrency] = result
+                        self.stdout.write(
+                            f'{name:17} {server} c={concurrency:<3} {result["rps"]:8.1f} req/s '
+                            f'p50={result["p50_ms"]:7.2f}ms p95={result["p95_ms"]:7.2f}ms'
+                        )
+
+        report = {
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'dataset': {'ads': Ad.objects.count(), 'user_inbox': busiest['total']},
+            'requests': options['requests'],
+            'cache': options['cache'],
+            'scenarios': results,
+        }
+        output = Path(options['output'] or f'bench_results/asgi-{datetime.now():%Y%m%d-%H%M%S}.json')
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(report, ensure_ascii=False, indent=2))
+        self.stdout.write(f'Результаты: {output}')
+
+
+def summary(timings, elapsed):
+    return {
+        'rps': len(timings) / elapsed,
+        'p50_ms': percentile(timings, 50) * 1000,
+        'p95_ms': percentile(timings, 95) * 1000,
+    }
+
+
+class WSGIDriver:
+    def __init__(self, application):
+        self.application = application
+
+    def call(self, path, query, headers):
+        environ = {
+            'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query, 'SCRIPT_NAME': '',
+            'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1', 'REMOTE_ADDR': '127.0.0.1',
+            'wsgi.input': BytesIO(), 'wsgi.errors': BytesIO(), 'wsgi.url_scheme': 'http',
+            'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+            **{f'HTTP_{name.upper().replace("-", "_")}': value for name, value in headers.items()},
+        }
+        status = []
+        result = self.application(environ, lambda line, response_headers, exc_info=None: status.append(line))
+        try:
+            for _ in result:
+                pass
+        finally:
+            # close() шлёт request_finished: соединения с БД закрываются, как на настоящем сервере
+            result.close()
+        return int(status[0].split()[0])
+
+    def run(self, request, total, concurrency):
+        lock, remaining = threading.Lock(), [total]
+
+        def worker():
+            timings = []
+            while True:
+                with lock:
+                    if not remaining[0]:
+                        return timings
+                    remaining[0] -= 1
+                    path, query, headers = request()
+                started = time.perf_counter()
+                status = self.call(path, query, headers)
+                timings.append(time.perf_counter() - started)
+                if status >= 400:
+                    raise CommandError(f'WSGI {path}: {status}')
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            timings = [timing for future in [pool.submit(worker) for _ in range(concurrency)]
+                       for timing in future.result()]
+        return summary(timings, time.perf_counter() - started)
+
+
+class ASGIDriver:
+    def __init__(self, application):
+        self.application = application
+
+    async def call(self, path, query, headers):
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': path, 'raw_path': path.encode(), 'query_string': query.encode(), 'root_path': '',
+            'headers': [(b'host', b'localhost'), *((name.encode(), value.encode()) for name, value in headers.items())],
+            'client': ('127.0.0.1', 50000), 'server': ('localhost', 80),
+        }
+        received, status = [], []
+
+        async def receive():
+            if received:
+                # тело уже отдано: дальше, как у uvicorn, ждём разрыва соединения, которого не будет
+                await asyncio.Event().wait()
+            received.append(True)
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+
+        await self.application(scope, receive, send)
+        return status[0]
+
+    def run(self, request, total, concurrency):
+        remaining = [total]
+
+        async def connection(timings):
+            # одно соединение — запросы по очереди, как keep-alive клиента
+            while remaining[0]:
+                remaining[0] -= 1
+                path, query, headers = request()
+                started = time.perf_counter()
+                status = await self.call(path, query, headers)
+                timings.append(time.perf_counter() - started)
+                if status >= 400:
+                    raise CommandError(f'ASGI {path}: {status}')
+
+        async def main():
+            timings = []
+            await asyncio.gather(*(connection(timings) for _ in range(concurrency)))
+            return timings
+
+        started = time.perf_counter()
+        timings = asyncio.run(main())
+        return summary(timings, time.perf_counter() - started)
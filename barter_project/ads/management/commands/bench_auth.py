@@ -0,0 +1,44 @@
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from rest_framework.request import Request
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import AccessToken
+
+from ads.authentication import CachedJWTAuthentication
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает накладные расходы JWT-аутентификации на запрос: SELECT пользователя против кэша'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        user, _ = User.objects.get_or_create(username='bench_auth')
+        header = f'Bearer {AccessToken.for_user(user)}'
+        factory = RequestFactory()
+
+        for name, authentication in [('simplejwt', JWTAuthentication()), ('cached', CachedJWTAuthentication())]:
+            def authenticate():
+                return authentication.authenticate(Request(factory.get('/api/ads/', HTTP_AUTHORIZATION=header)))
+
+            authenticate()
+            with CaptureQueriesContext(connection) as queries:
+                authenticate()
+
+            timings = []
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                authenticate()
+                timings.append((time.perf_counter() - started) * 1_000_000)
+            self.stdout.write(
+                f'{name:10} p50={statistics.median(timings):8.1f}us '
+                f'p95={statistics.quantiles(timings, n=20, method="inclusive")[-1]:8.1f}us '
+                f'SQL на запрос: {len(queries)}'
+            )
@@ -0,0 +1,116 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from ads.matching import ProposalGraph, discover_cycles
+from ads.models import Ad, ExchangeProposal
+
+
+class Command(BaseCommand):
+    help = ('Замеряет поиск циклов обмена: на синтетическом графе в памяти и, с --db, рабочий путь '
+            'discover_cycles с загрузкой окрестности из БД на засеянных предложениях (всё откатывается)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--proposals', type=int, default=1_000_000)
+        parser.add_argument('--ads', type=int, default=500_000)
+        parser.add_argument('--max-length', type=int, default=4)
+        parser.add_argument('--incremental', type=int, default=1000)
+        parser.add_argument('--local', type=float, default=0.5,
+                            help='доля предложений внутри «соседства» (похожие категории), они и дают циклы')
+        parser.add_argument('--window', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--db', action='store_true', help='вместо графа в памяти — discover_cycles по БД')
+        parser.add_argument('--batch', type=int, default=10000, help='предложений в одном INSERT при засеве')
+
+    def handle(self, *args, **options):
+        if options['db']:
+            return self.bench_db(options)
+        rnd = random.Random(options['seed'])
+        ads, limit = options['ads'], options['max_length']
+
+        def random_edge():
+            sender = rnd.randrange(ads)
+            if rnd.random() < options['local']:
+                return sender, (sender + rnd.randint(-options['window'], options['window'])) % ads
+            return sender, rnd.randrange(ads)
+
+        started = time.perf_counter()
+        graph = ProposalGraph()
+        for proposal_id in range(options['proposals']):
+            graph.add(proposal_id, *random_edge())
+        self.stdout.write(f'граф: {options["proposals"]} дуг за {time.perf_counter() - started:.2f}s')
+
+        started = time.perf_counter()
+        cycles = graph.all_cycles(limit)
+        self.stdout.write(f'полный пересчёт: {len(cycles)} циклов за {time.perf_counter() - started:.2f}s')
+
+        timings, found = [], 0
+        next_id = options['proposals']
+        for _ in range(options['incremental']):
+            sender, receiver = random_edge()
+            started = time.perf_counter()
+            graph.add(next_id, sender, receiver)
+            found += len(graph.cycles_through(sender, receiver, limit))
+            timings.append((time.perf_counter() - started) * 1000)
+            next_id += 1
+        self.stdout.write(
+            f'инкрементально: {options["incremental"]} предложений, {found} новых циклов, '
+            f'p50={statistics.median(timings):.3f}ms '
+            f'p99={statistics.quantiles(timings, n=100, method="inclusive")[-1]:.3f}ms'
+        )
+
+    def bench_db(self, options):
+        """Засевает ожидающие предложения между существующими объявлениями и гоняет discover_cycles,
+        как его зовёт фоновая задача: окрестность из БД, поиск, сохранение циклов. Транзакция откатывается."""
+        rnd = random.Random(options['seed'])
+        ad_ids = list(Ad.objects.order_by('pk').values_list('pk', flat=True)[:options['ads']])
+        if len(ad_ids) < 2:
+            raise CommandError('Нет данных: сначала python manage.py generate_data')
+        count = len(ad_ids)
+
+        def random_edge():
+            sender = rnd.randrange(count)
+            if rnd.random() < options['local']:
+                receiver = (sender + rnd.randint(-options['window'], options['window'])) % count
+            else:
+                receiver = rnd.randrange(count)
+            return ad_ids[sender], ad_ids[receiver]
+
+        with transaction.atomic():
+            started = time.perf_counter()
+            for offset in range(0, options['proposals'], options['batch']):
+                size = min(options['batch'], options['proposals'] - offset)
+                ExchangeProposal.objects.bulk_create([
+                    ExchangeProposal(ad_sender_id=sender, ad_receiver_id=receiver, comment='bench')
+                    for sender, receiver in (random_edge() for _ in range(size))
+                ])
+            with connection.cursor() as cursor:
+                cursor.execute(f'ANALYZE {ExchangeProposal._meta.db_table}')
+            self.stdout.write(
+                f'засеяно: {options["proposals"]} предложений между {count} объявлениями '
+                f'за {time.perf_counter() - started:.2f}s'
+            )
+
+            timings, queries, found = [], [], 0
+            for _ in range(options['incremental']):
+                sender, receiver = random_edge()
+                proposal = ExchangeProposal.objects.bulk_create([
+                    ExchangeProposal(ad_sender_id=sender, ad_receiver_id=receiver, comment='bench')
+                ])[0]
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    found += len(discover_cycles(proposal))
+                    timings.append((time.perf_counter() - started) * 1000)
+                queries.append(len(captured))
+            transaction.set_rollback(True)
+
+        self.stdout.write(
+            f'discover_cycles: {options["incremental"]} предложений, {found} новых циклов, '
+            f'p50={statistics.median(timings):.3f}ms '
+            f'p99={statistics.quantiles(timings, n=100, method="inclusive")[-1]:.3f}ms, '
+            f'запросов: {statistics.mean(queries):.1f}'
+        )
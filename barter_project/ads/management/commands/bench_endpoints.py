@@ -0,0 +1,133 @@
+import json
+import random
+import statistics
+import subprocess
+import time
+from contextlib import ExitStack
+from datetime import datetime, timezone
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+
+from ads.models import Ad, ExchangeProposal, ProposalParticipant
+from ads.synthetic import ITEMS
+
+NO_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+
+
+def percentile(values, q):
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1] if len(values) > 1 else values[0]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Гоняет основные эндпоинты через тестовый клиент и сохраняет p50/p95/p99, число запросов и rows/sec'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--warmup', type=int, default=10)
+        parser.add_argument('--cache', action='store_true', help='не отключать кэш ответов')
+        parser.add_argument('--output', default=None)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        busiest = ProposalParticipant.objects.values('user').annotate(total=Count('id')).order_by('-total').first()
+        if busiest is None:
+            raise CommandError('Нет данных: сначала python manage.py generate_data')
+        self.rnd = random.Random(options['seed'])
+        self.user = ProposalParticipant.objects.filter(user_id=busiest['user']).select_related('user').first().user
+        self.pending = list(ExchangeProposal.objects.filter(
+            status='pending', ad_receiver__user=self.user
+        ).values_list('id', flat=True)[:1000])
+
+        self.anonymous = APIClient(SERVER_NAME='localhost')
+        self.client = APIClient(SERVER_NAME='localhost')
+        self.client.force_authenticate(self.user)
+        self.client.force_login(self.user)
+
+        scenarios = {
+            'api_ads_list': lambda: self.anonymous.get('/api/ads/', {'page': self.rnd.randint(1, 20)}),
+            'api_ads_cursor': lambda: self.anonymous.get('/api/ads/', {'pagination': 'cursor'}),
+            'api_ads_filter': lambda: self.anonymous.get('/api/ads/', {'category': 'одежда', 'condition': 'used'}),
+            'api_ads_search': lambda: self.anonymous.get('/api/ads/', {'search': self.rnd.choice(ITEMS)}),
+            'api_proposals_my': lambda: self.client.get('/api/proposals/my/'),
+            'html_ad_list': lambda: self.anonymous.get('/'),
+            'html_ad_search': lambda: self.anonymous.get('/', {'q': self.rnd.choice(ITEMS)}),
+        }
+        if self.pending:
+            scenarios['api_accept'] = lambda: self.rolled_back('accept')
+            scenarios['api_decline'] = lambda: self.rolled_back('decline')
+
+        with override_settings(**({} if options['cache'] else {'CACHES': NO_CACHE})):
+            results = {
+                name: self.measure(request, options['requests'], options['warmup'])
+                for name, request in scenarios.items()
+            }
+
+        report = {
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'dataset': {
+                'ads': Ad.objects.count(),
+                'proposals': ExchangeProposal.objects.count(),
+                'user_inbox': busiest['total'],
+            },
+            'requests': options['requests'],
+            'cache': options['cache'],
+            'scenarios': results,
+        }
+        for name, result in results.items():
+            self.stdout.write(
+                f'{name:18} p50={result["p50_ms"]:8.2f}ms p95={result["p95_ms"]:8.2f}ms '
+                f'p99={result["p99_ms"]:8.2f}ms queries={result["queries"]:5.1f} rows/s={result["rows_per_sec"]:10.0f}'
+            )
+
+        output = Path(options['output'] or f'bench_results/endpoints-{datetime.now():%Y%m%d-%H%M%S}.json')
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(report, ensure_ascii=False, indent=2))
+        self.stdout.write(f'Результаты: {output}')
+
+    def rolled_back(self, action):
+        # принятие меняет данные, поэтому каждую итерацию откатываем
+        with transaction.atomic():
+            response = self.client.post(f'/api/proposals/{self.rnd.choice(self.pending)}/{action}/')
+            transaction.set_rollback(True)
+        return response
+
+    def measure(self, request, count, warmup):
+        for _ in range(warmup):
+            request()
+
+        timings, queries, rows = [], [], 0
+        for _ in range(count):
+            # запросы считаются по всем алиасам: чтения GET уходят на реплику
+            with ExitStack() as stack:
+                captured = [stack.enter_context(CaptureQueriesContext(alias)) for alias in connections.all()]
+                started = time.perf_counter()
+                response = request()
+                timings.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                raise CommandError(f'{response.status_code}: {response.content[:200]!r}')
+            queries.append(sum(map(len, captured)))
+            if response.get('Content-Type', '').startswith('application/json'):
+                rows += len(response.json().get('results', ()))
+
+        return {
+            'p50_ms': percentile(timings, 50) * 1000,
+            'p95_ms': percentile(timings, 95) * 1000,
+            'p99_ms': percentile(timings, 99) * 1000,
+            'queries': statistics.mean(queries),
+            'rows_per_sec': rows / sum(timings),
+        }
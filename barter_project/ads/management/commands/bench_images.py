@@ -0,0 +1,92 @@
+import json
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+from io import BytesIO
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from PIL import Image, ImageFilter
+
+from ads.thumbnails import FORMATS, render_thumbnails
+
+from .bench_endpoints import git_commit
+
+
+def synthetic_photo(seed, side):
+    # шум поверх градиента, размытый и снова зашумлённый: жмётся примерно как фото с телефона, а не как заливка
+    rng = random.Random(seed)
+    width, height = side, side * 3 // 4
+    image = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    image = Image.blend(image, Image.new('RGB', (width, height), tuple(rng.randrange(256) for _ in range(3))), 0.6)
+    noise = Image.effect_noise((width, height), 60).convert('RGB')
+    image = Image.blend(image, noise.filter(ImageFilter.GaussianBlur(3)), 0.4)
+    image = Image.blend(image, Image.effect_noise((width, height), 20).convert('RGB'), 0.1)
+    output = BytesIO()
+    image.save(output, 'JPEG', quality=92)
+    return output.getvalue()
+
+
+class Command(BaseCommand):
+    help = ('Пропускная способность построения превью в пуле процессов (на ядро) и вес картинок страницы '
+            'списка: оригиналы против превью small в WebP и JPEG')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=24)
+        parser.add_argument('--side', type=int, default=4000, help='ширина исходных фото, px (4:3)')
+        parser.add_argument('--processes', type=int, default=os.cpu_count())
+        parser.add_argument('--output', default=None)
+
+    def handle(self, *args, **options):
+        sizes, quality = settings.ADS_THUMBNAIL_SIZES, settings.ADS_THUMBNAIL_QUALITY
+        # в дочерний процесс уходит только ads.thumbnails: этот модуль тянет модели и без django.setup() не импортируется
+        render = partial(render_thumbnails, sizes=sizes, quality=quality)
+        originals = [synthetic_photo(seed, options['side']) for seed in range(options['images'])]
+
+        # тот же путь, что у run_jobs --pool process: spawn и render_thumbnails без Django
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(options['processes'], mp_context=context) as pool:
+            # прогрев: запуск интерпретаторов и импорт Pillow в замер не входят
+            list(pool.map(render, originals[:options['processes']]))
+            started = time.perf_counter()
+            thumbnails = list(pool.map(render, originals))
+            elapsed = time.perf_counter() - started
+
+        page = min(settings.ADS_HTML_PAGE_SIZE, len(originals))
+        small = min(sizes, key=sizes.get)
+        payload = {'original': sum(map(len, originals[:page]))}
+        for fmt in FORMATS:
+            payload[fmt] = sum(len(rendered[small, fmt]) for rendered in thumbnails[:page])
+        result = {
+            'images_per_s': len(originals) / elapsed,
+            'images_per_s_per_core': len(originals) / elapsed / options['processes'],
+            'ms_per_image': elapsed / len(originals) * 1000 * options['processes'],
+            'page_images': page,
+            'page_bytes': payload,
+        }
+
+        self.stdout.write(
+            f'{len(originals)} фото {options["side"]}px за {elapsed:.2f}s в {options["processes"]} процессах: '
+            f'{result["images_per_s_per_core"]:.2f} фото/с на ядро ({result["ms_per_image"]:.0f}ms на фото)\n'
+            f'картинки страницы из {page} карточек: оригиналы {payload["original"] / 1024:.0f} КиБ, '
+            f'{small} WebP {payload["webp"] / 1024:.0f} КиБ, {small} JPEG {payload["jpeg"] / 1024:.0f} КиБ'
+        )
+        report = {
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'images': options['images'],
+            'side': options['side'],
+            'processes': options['processes'],
+            'sizes': sizes,
+            'quality': quality,
+            **result,
+        }
+        output = Path(options['output'] or f'bench_results/images-{datetime.now():%Y%m%d-%H%M%S}.json')
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(report, ensure_ascii=False, indent=2))
+        self.stdout.write(f'Результаты: {output}')
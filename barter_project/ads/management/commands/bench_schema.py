@@ -0,0 +1,44 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from drf_spectacular.views import SpectacularAPIView
+
+from ads.schema import CachedSchemaView, clear_memory
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает время ответа /api/schema/: генерация на каждый запрос против закэшированной схемы'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        factory = RequestFactory()
+        request = lambda **headers: factory.get('/api/schema/', **headers)
+
+        clear_memory()
+        cached = CachedSchemaView.as_view()
+        started = time.perf_counter()
+        response = cached(request())
+        self.stdout.write(f'cached (первый запрос процесса): {(time.perf_counter() - started) * 1000:.1f}ms')
+        etag = response['ETag']
+
+        paths = [
+            ('spectacular', SpectacularAPIView.as_view(), {}),
+            ('cached', cached, {}),
+            ('cached 304', cached, {'HTTP_IF_NONE_MATCH': etag}),
+        ]
+        for name, view, headers in paths:
+            timings = []
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                response = view(request(**headers))
+                if hasattr(response, 'render'):
+                    response.render()
+                timings.append((time.perf_counter() - started) * 1000)
+            self.stdout.write(
+                f'{name:12} p50={statistics.median(timings):8.2f}ms max={max(timings):8.2f}ms '
+                f'status={response.status_code} size={len(response.content)}'
+            )
@@ -0,0 +1,62 @@
+import random
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.db.models.functions import Lower
+
+from ads.models import Ad
+from ads.search import search_ads
+from ads.synthetic import create_ads
+
+QUERIES = ['футболка', 'кроссовки Nike', 'гитара', 'складной стул', 'Apple', 'зимняя куртка', 'самокат']
+
+
+def icontains_search(queryset, q):
+    # прежний путь AdListView: последовательный ILIKE '%q%'
+    return queryset.annotate(
+        title_lower=Lower('title'),
+        description_lower=Lower('description'),
+    ).filter(
+        Q(title_lower__icontains=q.lower()) |
+        Q(description_lower__icontains=q.lower())
+    ).order_by('-created_at')
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает полнотекстовый поиск с прежним icontains на большом числе объявлений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ads', type=int, default=1_000_000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        self.seed_ads(options['ads'], options['batch_size'], random.Random(options['seed']))
+
+        paths = [('icontains', icontains_search), ('fulltext', search_ads)]
+        for name, search in paths:
+            timings = []
+            for _ in range(options['repeat']):
+                for q in QUERIES:
+                    started = time.perf_counter()
+                    queryset = search(Ad.objects.all(), q)
+                    queryset.count()
+                    list(queryset[:10])
+                    timings.append((time.perf_counter() - started) * 1000)
+            self.stdout.write(
+                f'{name:10} p50={statistics.median(timings):8.2f}ms '
+                f'p95={statistics.quantiles(timings, n=20, method="inclusive")[-1]:8.2f}ms '
+                f'max={max(timings):8.2f}ms'
+            )
+
+    def seed_ads(self, total, batch_size, rnd):
+        missing = total - Ad.objects.count()
+        if missing <= 0:
+            return
+        user, _ = User.objects.get_or_create(username='bench_search')
+        self.stdout.write(f'Создаю {missing} объявлений...')
+        create_ads([user.pk], missing, batch_size, rnd)
@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ads.models import Ad, ExchangeProposal
+from ads.rows import row_serializer
+from ads.serializer import AdSerializer, ExchangeProposalSerializer
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает ModelSerializer и RowSerializer на страницах 10/100/1000: строк в секунду'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        if not Ad.objects.exists():
+            raise CommandError('Нет данных: сначала python manage.py generate_data')
+        cases = [
+            ('ads', AdSerializer, Ad.objects.select_related('user').order_by('-created_at', '-id')),
+            ('proposals', ExchangeProposalSerializer, ExchangeProposal.objects.with_ads().order_by('-created_at', '-id')),
+        ]
+
+        self.stdout.write(f'{"":10} {"size":>5} {"serializer":>12} {"rows":>12} {"+fetch":>12} {"+fetch rows":>12}')
+        for name, serializer_class, queryset in cases:
+            rows = row_serializer(serializer_class)
+            for size in options['sizes']:
+                objects = list(queryset[:size])
+                values = list(queryset.values(*rows.columns)[:size])
+                results = {
+                    'serializer': self.rate(lambda: serializer_class(objects, many=True).data, len(objects), options),
+                    'rows': self.rate(lambda: rows.serialize(values), len(values), options),
+                    # с выборкой из БД — то, что реально видит эндпоинт
+                    '+fetch': self.rate(
+                        lambda: serializer_class(list(queryset[:size]), many=True).data, len(objects), options
+                    ),
+                    '+fetch rows': self.rate(
+                        lambda: rows.serialize(queryset.values(*rows.columns)[:size]), len(values), options
+                    ),
+                }
+                self.stdout.write(
+                    f'{name:10} {size:5} ' + ' '.join(f'{rate:12.0f}' for rate in results.values())
+                )
+        self.stdout.write('строк в секунду, больше — лучше')
+
+    def rate(self, serialize, count, options):
+        serialize()
+        started = time.perf_counter()
+        for _ in range(options['repeat']):
+            serialize()
+        return count * options['repeat'] / (time.perf_counter() - started)
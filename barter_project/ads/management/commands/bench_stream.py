@@ -0,0 +1,121 @@
+import asyncio
+import json
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken
+
+from ads.events import Event, broker
+from ads.models import ProposalParticipant
+from ads.stream import ProposalStreamApp
+
+from .bench_endpoints import git_commit, percentile
+
+
+class Command(BaseCommand):
+    help = ('Держит N простаивающих SSE-соединений в одном процессе: память и потоки на соединение, '
+            'время рассылки события всем подписчикам')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=2000)
+        parser.add_argument('--users', type=int, default=50, help='между скольким пользователями делятся соединения')
+        parser.add_argument('--events', type=int, default=20)
+        parser.add_argument('--output', default=None)
+
+    def handle(self, *args, **options):
+        user_ids = list(ProposalParticipant.objects.values_list('user_id', flat=True).distinct()[:options['users']])
+        if not user_ids:
+            raise CommandError('Нет данных: сначала python manage.py generate_data')
+        tokens = {user.pk: str(AccessToken.for_user(user)) for user in User.objects.filter(pk__in=user_ids)}
+        result = asyncio.run(self.run(ProposalStreamApp(get_asgi_application()), tokens, options))
+
+        self.stdout.write(
+            f'{options["connections"]} соединений за {result["open_s"]:.2f}s, '
+            f'{result["bytes_per_connection"] / 1024:.1f} КиБ на соединение, потоков: {result["threads"]}\n'
+            f'рассылка события: p50={result["fanout_p50_ms"]:.2f}ms p95={result["fanout_p95_ms"]:.2f}ms '
+            f'(подписчиков на событие: {result["subscribers_per_event"]})'
+        )
+        report = {
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'connections': options['connections'],
+            'users': len(user_ids),
+            **result,
+        }
+        output = Path(options['output'] or f'bench_results/stream-{datetime.now():%Y%m%d-%H%M%S}.json')
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(report, ensure_ascii=False, indent=2))
+        self.stdout.write(f'Результаты: {output}')
+
+    async def run(self, app, tokens, options):
+        user_ids = list(tokens)
+        disconnected = asyncio.Event()
+        ready = asyncio.Semaphore(0)
+        # id события -> моменты, когда его получили подписчики
+        received = {}
+
+        async def receive():
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        def client(user_id):
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                'scheme': 'http', 'path': '/api/proposals/stream/', 'raw_path': b'/api/proposals/stream/',
+                'query_string': b'', 'root_path': '', 'client': ('127.0.0.1', 50000), 'server': ('localhost', 80),
+                'headers': [(b'host', b'localhost'), (b'authorization', f'Bearer {tokens[user_id]}'.encode())],
+            }
+
+            async def send(message):
+                body = message.get('body', b'')
+                if body.startswith(b'retry:'):
+                    ready.release()
+                elif body.startswith(b'id: '):
+                    received.setdefault(int(body[4:body.index(b'\n')]), []).append(time.perf_counter())
+                elif message['type'] == 'http.response.start' and message['status'] != 200:
+                    raise CommandError(f'Стрим ответил {message["status"]}')
+
+            return app(scope, receive, send)
+
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        owners = [user_ids[i % len(user_ids)] for i in range(options['connections'])]
+        tasks = [asyncio.ensure_future(client(user_id)) for user_id in owners]
+        for _ in tasks:
+            await ready.acquire()
+        open_s = time.perf_counter() - started
+        # пусть потоки, через которые шла аутентификация, отработают
+        await asyncio.sleep(0.5)
+        memory = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        threads = threading.active_count()
+
+        # синтетические события вместо записи в БД: меряется путь от брокера до send каждого стрима
+        latencies = []
+        for number in range(options['events']):
+            event_id = 10 ** 12 + number
+            user_id = user_ids[number % len(user_ids)]
+            expected = owners.count(user_id)
+            published = time.perf_counter()
+            broker.publish([Event(event_id, user_id, 0, 'pending', 0, 0)])
+            while len(received.get(event_id, ())) < expected:
+                await asyncio.sleep(0)
+            latencies.append(max(received[event_id]) - published)
+
+        disconnected.set()
+        await asyncio.gather(*tasks)
+        return {
+            'open_s': open_s,
+            'bytes_per_connection': memory / len(tasks),
+            'threads': threads,
+            'subscribers_per_event': round(len(tasks) / len(user_ids)),
+            'fanout_p50_ms': percentile(latencies, 50) * 1000,
+            'fanout_p95_ms': percentile(latencies, 95) * 1000,
+        }
@@ -0,0 +1,35 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from ads import synthetic
+
+
+class Command(BaseCommand):
+    help = 'Массово создаёт синтетических пользователей, объявления и предложения для нагрузочных замеров'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--ads', type=int, default=10000)
+        parser.add_argument('--proposals', type=int, default=20000)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--prefix', default=None, help='префикс имён пользователей')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        batch_size = options['batch_size']
+
+        started = time.perf_counter()
+        user_ids = synthetic.create_users(options['users'], batch_size, options['prefix'])
+        self.stdout.write(f'пользователи: {len(user_ids)} за {time.perf_counter() - started:.1f}s')
+
+        started = time.perf_counter()
+        owners = synthetic.create_ads(user_ids, options['ads'], batch_size, rnd)
+        self.stdout.write(f'объявления: {len(owners)} за {time.perf_counter() - started:.1f}s')
+
+        started = time.perf_counter()
+        created = synthetic.create_proposals(owners, options['proposals'], batch_size, rnd)
+        self.stdout.write(f'предложения: {created} за {time.perf_counter() - started:.1f}s')
+        self.stdout.write('Циклы обмена для новых предложений: python manage.py rebuild_cycles')
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+from ads.schema import CachedSchemaView, clear_memory, code_version, remove_stale_files
+
+MEDIA_TYPES = ['application/vnd.oai.openapi', 'application/yaml', 'application/vnd.oai.openapi+json', 'application/json']
+
+
+class Command(BaseCommand):
+    help = 'Заранее строит OpenAPI-схему во всех форматах для текущей версии кода (шаг деплоя)'
+
+    def handle(self, *args, **options):
+        clear_memory()
+        view = CachedSchemaView.as_view()
+        for media_type in MEDIA_TYPES:
+            response = view(RequestFactory().get('/api/schema/', HTTP_ACCEPT=media_type))
+            self.stdout.write(f'{media_type}: {len(response.content)} байт, ETag {response["ETag"]}')
+        self.stdout.write(f'Версия {code_version()}, удалено устаревших файлов: {remove_stale_files()}')
@@ -0,0 +1,39 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from ads.bulk import MEDIA_TYPES, detect_type, import_ads, read_rows
+
+
+class Command(BaseCommand):
+    help = 'Массово импортирует объявления из NDJSON или CSV, пачками через bulk_create'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--user', required=True, help='имя владельца объявлений')
+        parser.add_argument('--type', choices=list(MEDIA_TYPES), default=None, help='по умолчанию — по расширению файла')
+        parser.add_argument('--chunk-size', type=int, default=settings.ADS_IMPORT_CHUNK_SIZE)
+        parser.add_argument('--max-errors', type=int, default=100, help='сколько ошибок вывести')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f'Пользователь {options["user"]} не найден')
+        kind = detect_type(options['type'], name=options['path'])
+        if kind is None:
+            raise CommandError('Не удалось определить формат, укажите --type')
+
+        started = time.perf_counter()
+        with open(options['path'], 'rb') as lines:
+            report = import_ads(user, read_rows(lines, kind), options['chunk_size'], options['max_errors'])
+        elapsed = time.perf_counter() - started
+
+        for error in report['errors']:
+            self.stderr.write(f'строка {error["line"]}: {error["errors"]}')
+        self.stdout.write(
+            f'Создано: {report["created"]}, с ошибками: {report["failed"]} за {elapsed:.1f}s '
+            f'({report["created"] / elapsed:.0f} строк/s)'
+        )
@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ads.matching import max_length, rebuild_cycles
+
+
+class Command(BaseCommand):
+    help = 'Полностью пересчитывает циклы обмена по всем ожидающим предложениям'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-length', type=int, default=None)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        cycles = rebuild_cycles(options['max_length'])
+        self.stdout.write(
+            f'Найдено циклов: {len(cycles)} (длина до {options["max_length"] or max_length()}) '
+            f'за {time.perf_counter() - started:.2f}s'
+        )
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ads.models import FacetCount
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счётчики фасетов GROUP BY по объявлениям и предложениям (починка дрейфа)'
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        before = {(facet.dimension, facet.value): facet.count for facet in FacetCount.objects.all()}
+        rows = FacetCount.objects.rebuild()
+        drift = {
+            (row.dimension, row.value): row.count - before.get((row.dimension, row.value), 0)
+            for row in rows if row.count != before.get((row.dimension, row.value), 0)
+        }
+        for (dimension, value), delta in sorted(drift.items()):
+            self.stdout.write(f'{dimension}={value}: {delta:+d}')
+        self.stdout.write(
+            f'Пересчитано значений: {len(rows)}, расхождений: {len(drift)} за {time.perf_counter() - started:.2f}s'
+        )
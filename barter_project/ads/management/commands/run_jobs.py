@@ -0,0 +1,126 @@
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from concurrent.futures import FIRST_COMPLETED, BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import partial
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection
+
+
+def init_process():
+    # Ctrl+C и SIGTERM ловит родитель и дожидается начатых задач; дочерние процессы их не замечают
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    django.setup()
+
+
+class Command(BaseCommand):
+    help = ('Воркер фоновых задач: забирает созревшие задачи из таблицы через SKIP LOCKED и выполняет их '
+            'в пуле потоков или процессов; воркеров можно запускать сколько угодно')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=settings.ADS_JOBS_CONCURRENCY)
+        parser.add_argument('--pool', choices=['thread', 'process'], default='thread',
+                            help='process — для задач, которые упираются в CPU')
+        parser.add_argument('--poll', type=float, default=settings.ADS_JOBS_POLL_SECONDS, help='пауза при пустой очереди, с')
+        parser.add_argument('--once', action='store_true', help='выйти, когда созревших задач не останется')
+
+    def handle(self, *args, **options):
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+        if options['pool'] == 'process':
+            # spawn, а не fork: дочерние процессы не должны унаследовать соединение с БД родителя
+            make_pool = partial(ProcessPoolExecutor, options['concurrency'],
+                                mp_context=multiprocessing.get_context('spawn'), initializer=init_process)
+        else:
+            make_pool = partial(ThreadPoolExecutor, options['concurrency'], thread_name_prefix='job')
+
+        self.stopping = False
+        previous = {signum: signal.signal(signum, self.stop) for signum in (signal.SIGINT, signal.SIGTERM)}
+        self.stdout.write(f'Воркер {worker}: {options["pool"]} x{options["concurrency"]}')
+        try:
+            done, failed = self.work(make_pool, worker, options)
+        finally:
+            for signum, action in previous.items():
+                signal.signal(signum, action)
+        self.stdout.write(f'Выполнено задач: {done}, упало: {failed}')
+
+    def stop(self, signum, frame):
+        # новые задачи не берём, начатые доделываем
+        self.stopping = True
+
+    def work(self, make_pool, worker, options):
+        # не на уровне модуля: дочерний процесс импортирует этот модуль ради init_process ещё до django.setup()
+        from ads.jobs import run_job
+        from ads.models import Job
+
+        concurrency = options['concurrency']
+        pool = make_pool()
+        running = set()
+        results = []
+        requeued_at = 0
+        try:
+            while not self.stopping:
+                claimed = []
+                try:
+                    if time.monotonic() - requeued_at > settings.ADS_JOBS_LEASE_SECONDS / 2:
+                        requeued_at = time.monotonic()
+                        stale = Job.objects.requeue_stale(settings.ADS_JOBS_LEASE_SECONDS, settings.ADS_JOBS_MAX_ATTEMPTS)
+                        if stale:
+                            self.stdout.write(f'Брошенных задач возвращено в очередь: {stale}')
+                    if len(running) < concurrency:
+                        claimed = Job.objects.claim(concurrency - len(running), worker)
+                except DatabaseError as error:
+                    # БД недоступна: начатые задачи доделываются, новые заберём после паузы
+                    self.stderr.write(f'Очередь недоступна: {error}')
+                    connection.close()
+                broken = False
+                try:
+                    for job in claimed:
+                        running.add(pool.submit(run_job, job))
+                except BrokenExecutor:
+                    # не отправленные задачи остались захваченными: их вернёт requeue_stale
+                    broken = True
+                if options['once'] and not claimed and not running:
+                    break
+                if running:
+                    # только что забрали — сразу пробуем добрать до полного пула, иначе ждём освобождения слота
+                    finished, running = wait(running, timeout=0 if claimed else options['poll'],
+                                             return_when=FIRST_COMPLETED)
+                    broken |= self.collect(finished, results)
+                elif not broken:
+                    time.sleep(options['poll'])
+                    continue
+                if broken:
+                    # упавший дочерний процесс ломает весь пул: остальные его задачи падают следом, пул создаём заново
+                    self.stderr.write('Пул задач сломан, создаём новый')
+                    self.collect(wait(running).done, results)
+                    running = set()
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = make_pool()
+            self.collect(wait(running).done, results)
+        finally:
+            pool.shutdown()
+        return results.count(True), results.count(False)
+
+    def collect(self, finished, results):
+        """Складывает итоги завершённых задач в results; возвращает True, если пул сломан.
+
+        Исключение из задачи (например, из учёта её итога в БД) воркер не роняет: она считается упавшей,
+        а её строка остаётся захваченной и вернётся в очередь через requeue_stale.
+        """
+        broken = False
+        for future in finished:
+            try:
+                results.append(future.result())
+            except BrokenExecutor:
+                broken = True
+                results.append(False)
+            except Exception as error:
+                self.stderr.write(f'Задача упала вне обработчика: {error!r}')
+                results.append(False)
+        return broken
@@ -0,0 +1,171 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import ExchangeProposal, TradeCycle
+
+# обмен вдвоём (A→B, B→A) — это обычное встречное предложение, ищем от трёх участников
+MIN_LENGTH = 3
+
+
+def max_length():
+    return settings.ADS_CYCLE_MAX_LENGTH
+
+
+def canonical(ads, proposals):
+    # цикл хранится с наименьшего объявления, чтобы A→B→C и B→C→A не дублировались
+    start = ads.index(min(ads))
+    return ads[start:] + ads[:start], proposals[start:] + proposals[:start]
+
+
+class ProposalGraph:
+    """Граф ожидающих предложений: вершины — объявления, дуга sender → receiver."""
+
+    def __init__(self):
+        self.out = defaultdict(dict)
+        self.inc = defaultdict(dict)
+
+    def add(self, proposal_id, sender, receiver):
+        if sender == receiver:
+            return
+        self.out[sender].setdefault(receiver, set()).add(proposal_id)
+        self.inc[receiver].setdefault(sender, set()).add(proposal_id)
+
+    def remove(self, proposal_id, sender, receiver):
+        for index, a, b in ((self.out, sender, receiver), (self.inc, receiver, sender)):
+            proposals = index.get(a, {}).get(b)
+            if proposals is None:
+                continue
+            proposals.discard(proposal_id)
+            if not proposals:
+                del index[a][b]
+                if not index[a]:
+                    del index[a]
+
+    def edge(self, sender, receiver):
+        return min(self.out[sender][receiver])
+
+    def distances_to(self, target, depth):
+        # обратный BFS: сколько дуг от вершины до target, не дальше depth
+        distances = {target: 0}
+        frontier = [target]
+        for level in range(1, depth + 1):
+            next_frontier = []
+            for node in frontier:
+                for sender in self.inc.get(node, ()):
+                    if sender not in distances:
+                        distances[sender] = level
+                        next_frontier.append(sender)
+            frontier = next_frontier
+        return distances
+
+    def cycles_through(self, sender, receiver, limit):
+        """Циклы, проходящие через дугу sender → receiver; обходится только окрестность этой дуги."""
+        if receiver not in self.out.get(sender, {}):
+            return []
+        distances = self.distances_to(sender, limit - 1)
+        if distances.get(receiver, limit) > limit - 1:
+            return []
+
+        cycles = []
+        path = [sender, receiver]
+
+        def walk(node, budget):
+            for neighbour in self.out.get(node, ()):
+                if neighbour == sender:
+                    if len(path) >= MIN_LENGTH:
+                        cycles.append(list(path))
+                elif neighbour not in path and distances.get(neighbour, limit) <= budget - 1:
+                    path.append(neighbour)
+                    walk(neighbour, budget - 1)
+                    path.pop()
+
+        walk(receiver, limit - 1)
+        return [self.with_proposals(cycle) for cycle in cycles]
+
+    def all_cycles(self, limit):
+        # каждый цикл находится один раз — из его наименьшей вершины
+        cycles = []
+        for start in sorted(self.out):
+            path = [start]
+
+            def walk(node):
+                for neighbour in self.out.get(node, ()):
+                    if neighbour == start:
+                        if len(path) >= MIN_LENGTH:
+                            cycles.append(list(path))
+                    elif neighbour > start and neighbour not in path and len(path) < limit:
+                        path.append(neighbour)
+                        walk(neighbour)
+                        path.pop()
+
+            walk(start)
+        return [self.with_proposals(cycle) for cycle in cycles]
+
+    def with_proposals(self, ads):
+        proposals = [self.edge(a, b) for a, b in zip(ads, ads[1:] + ads[:1])]
+        return canonical(ads, proposals)
+
+
+def load_neighbourhood(senders, limit):
+    # подграф из дуг, ведущих к senders не длиннее limit - 1: по запросу на уровень,
+    # каждый идёт по частичному индексу ожидающих предложений
+    graph = ProposalGraph()
+    seen = set(senders)
+    frontier = list(seen)
+    for _ in range(limit - 1):
+        rows = ExchangeProposal.objects.filter(status='pending', ad_receiver__in=frontier).values_list(
+            'id', 'ad_sender_id', 'ad_receiver_id'
+        )
+        frontier = []
+        for proposal_id, a, b in rows:
+            graph.add(proposal_id, a, b)
+            if a not in seen:
+                seen.add(a)
+                frontier.append(a)
+        if not frontier:
+            break
+    return graph
+
+
+def save_cycles(cycles):
+    TradeCycle.objects.bulk_create([
+        TradeCycle(key=TradeCycle.make_key(ads), ads=ads, proposals=proposals, length=len(ads))
+        for ads, proposals in cycles
+    ], ignore_conflicts=True, batch_size=1000)
+
+
+def discover_cycles(*proposals):
+    """Находит и сохраняет циклы, которые замкнули новые предложения; окрестность грузится одна на всех."""
+    proposals = [proposal for proposal in proposals if proposal.status == 'pending']
+    if not proposals:
+        return []
+    limit = max_length()
+    graph = load_neighbourhood({proposal.ad_sender_id for proposal in proposals}, limit)
+    for proposal in proposals:
+        graph.add(proposal.pk, proposal.ad_sender_id, proposal.ad_receiver_id)
+    # цикл из нескольких новых дуг найдётся через каждую из них, в базу он попадёт один раз по key
+    cycles = {}
+    for proposal in proposals:
+        for ads, cycle_proposals in graph.cycles_through(proposal.ad_sender_id, proposal.ad_receiver_id, limit):
+            cycles[tuple(ads)] = (ads, cycle_proposals)
+    cycles = list(cycles.values())
+    save_cycles(cycles)
+    return cycles
+
+
+def load_graph(chunk_size=10000):
+    graph = ProposalGraph()
+    rows = ExchangeProposal.objects.filter(status='pending').values_list('id', 'ad_sender_id', 'ad_receiver_id')
+    for proposal_id, sender, receiver in rows.iterator(chunk_size=chunk_size):
+        graph.add(proposal_id, sender, receiver)
+    return graph
+
+
+def rebuild_cycles(limit=None):
+    cycles = load_graph().all_cycles(limit or max_length())
+    with transaction.atomic():
+        TradeCycle.objects.all().delete()
+        save_cycles(cycles)
+    return cycles
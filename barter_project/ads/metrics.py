@@ -0,0 +1,86 @@
+import threading
+from collections import defaultdict
+
+from .cache import cache_stats
+
+# границы корзин гистограммы в секундах, как принято в Prometheus
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class RouteStats:
+    __slots__ = ('buckets', 'count', 'duration', 'queries', 'sql_duration')
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.duration = 0.0
+        self.queries = 0
+        self.sql_duration = 0.0
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = defaultdict(RouteStats)
+
+    def observe(self, route, method, duration, queries, sql_duration):
+        with self.lock:
+            stats = self.routes[route, method]
+            for index, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    stats.buckets[index] += 1
+                    break
+            stats.count += 1
+            stats.duration += duration
+            stats.queries += queries
+            stats.sql_duration += sql_duration
+
+    def reset(self):
+        with self.lock:
+            self.routes.clear()
+
+    def render(self):
+        with self.lock:
+            snapshot = sorted(self.routes.items())
+            lines = [
+                '# HELP barter_request_duration_seconds Request wall time per route.',
+                '# TYPE barter_request_duration_seconds histogram',
+            ]
+            for (route, method), stats in snapshot:
+                labels = f'route="{route}",method="{method}"'
+                cumulative = 0
+                for bound, count in zip(BUCKETS, stats.buckets):
+                    cumulative += count
+                    lines.append(f'barter_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'barter_request_duration_seconds_bucket{{{labels},le="+Inf"}} {stats.count}')
+                lines.append(f'barter_request_duration_seconds_sum{{{labels}}} {stats.duration:.6f}')
+                lines.append(f'barter_request_duration_seconds_count{{{labels}}} {stats.count}')
+
+            lines += [
+                '# HELP barter_request_queries_total SQL queries executed per route.',
+                '# TYPE barter_request_queries_total counter',
+            ]
+            lines += [
+                f'barter_request_queries_total{{route="{route}",method="{method}"}} {stats.queries}'
+                for (route, method), stats in snapshot
+            ]
+            lines += [
+                '# HELP barter_request_sql_seconds_total Time spent in SQL per route.',
+                '# TYPE barter_request_sql_seconds_total counter',
+            ]
+            lines += [
+                f'barter_request_sql_seconds_total{{route="{route}",method="{method}"}} {stats.sql_duration:.6f}'
+                for (route, method), stats in snapshot
+            ]
+
+        stats = cache_stats()
+        lines += [
+            '# HELP barter_response_cache_requests_total Anonymous response cache lookups.',
+            '# TYPE barter_response_cache_requests_total counter',
+            f'barter_response_cache_requests_total{{result="hit"}} {stats["hits"]}',
+            f'barter_response_cache_requests_total{{result="miss"}} {stats["misses"]}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
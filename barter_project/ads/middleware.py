@@ -0,0 +1,147 @@
+import logging
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+
+from .metrics import registry
+from .routers import enter_request, exit_request
+
+logger = logging.getLogger('ads.performance')
+
+
+class QueryTimer:
+    __slots__ = ('count', 'duration', 'slow_threshold')
+
+    def __init__(self, slow_threshold):
+        self.count = 0
+        self.duration = 0.0
+        self.slow_threshold = slow_threshold
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.count += 1
+            self.duration += duration
+            if duration > self.slow_threshold:
+                logger.warning('Медленный запрос %.1fms: %s', duration * 1000, sql[:1000])
+
+
+class PerformanceMiddleware:
+    """Время запроса, число и время SQL: заголовок Server-Timing, лог медленных запросов, гистограммы для /metrics."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timer, started = self.start()
+        with self.wrap_connections(timer):
+            response = self.get_response(request)
+        return self.finish(request, response, timer, started)
+
+    async def __acall__(self, request):
+        timer, started = self.start()
+        with self.wrap_connections(timer):
+            response = await self.get_response(request)
+        return self.finish(request, response, timer, started)
+
+    def start(self):
+        return QueryTimer(settings.PERFORMANCE_SLOW_QUERY_MS / 1000), time.perf_counter()
+
+    def wrap_connections(self, timer):
+        stack = ExitStack()
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(timer))
+        return stack
+
+    def finish(self, request, response, timer, started):
+        duration = time.perf_counter() - started
+        match = request.resolver_match
+        route = match.view_name if match else 'unmatched'
+        registry.observe(route, request.method, duration, timer.count, timer.duration)
+
+        response['Server-Timing'] = (
+            f'app;dur={duration * 1000:.1f}, db;dur={timer.duration * 1000:.1f};desc="{timer.count} queries"'
+        )
+        if duration * 1000 > settings.PERFORMANCE_SLOW_REQUEST_MS:
+            logger.warning(
+                'Медленный запрос %s %s (%s): %.1fms, SQL: %d за %.1fms',
+                request.method, request.path, route, duration * 1000, timer.count, timer.duration * 1000,
+            )
+        return response
+
+
+class PrimaryReplicaMiddleware:
+    """Безопасные запросы читают с реплик; после записи клиент на время закрепляется за primary (cookie)."""
+
+    sync_capable = True
+    async_capable = True
+    cookie_name = 'ads_primary'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state, token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            exit_request(token)
+        return self.finish(response, state)
+
+    async def __acall__(self, request):
+        state, token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            exit_request(token)
+        return self.finish(response, state)
+
+    def start(self, request):
+        pinned = request.method not in ('GET', 'HEAD', 'OPTIONS') or self.cookie_name in request.COOKIES
+        return enter_request(pinned)
+
+    def finish(self, response, state):
+        if state.wrote:
+            response.set_cookie(
+                self.cookie_name, '1', max_age=settings.ADS_REPLICA_PIN_SECONDS, httponly=True, samesite='Lax'
+            )
+        return response
+
+
+class AsyncUrlconfMiddleware:
+    """Под ASGI маршруты сначала ищутся в ADS_ASGI_URLCONF (нативно асинхронные view), под WSGI всё как было."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        if settings.ADS_ASGI_URLCONF:
+            request.urlconf = settings.ADS_ASGI_URLCONF
+        return await self.get_response(request)
@@ -0,0 +1,38 @@
+from django.db import migrations, transaction
+
+CHUNK_SIZE = 1000
+
+
+def backfill_participants(apps, schema_editor):
+    ExchangeProposal = apps.get_model('ads', 'ExchangeProposal')
+    ProposalParticipant = apps.get_model('ads', 'ProposalParticipant')
+
+    # каждая пачка в своей транзакции, чтобы не держать блокировки на всю таблицу
+    last_id = 0
+    while True:
+        rows = list(
+            ExchangeProposal.objects.filter(id__gt=last_id).order_by('id').values_list(
+                'id', 'created_at', 'ad_sender__user_id', 'ad_receiver__user_id'
+            )[:CHUNK_SIZE]
+        )
+        if not rows:
+            break
+        with transaction.atomic():
+            ProposalParticipant.objects.bulk_create([
+                ProposalParticipant(user_id=user_id, proposal_id=proposal_id, created_at=created_at)
+                for proposal_id, created_at, sender_id, receiver_id in rows
+                for user_id in {sender_id, receiver_id}
+            ], ignore_conflicts=True)
+        last_id = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('ads', '0007_proposal_participant'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_participants, migrations.RunPython.noop),
+    ]
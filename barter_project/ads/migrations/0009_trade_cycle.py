@@ -0,0 +1,38 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:29
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0008_backfill_proposal_participants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TradeCycle',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True)),
+                ('ads', django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), size=None)),
+                ('proposals', django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), size=None)),
+                ('length', models.PositiveSmallIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='exchangeproposal',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['ad_receiver', 'ad_sender'], name='ads_proposal_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tradecycle',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['ads'], name='ads_cycle_ads_gin'),
+        ),
+        migrations.AddIndex(
+            model_name='tradecycle',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['proposals'], name='ads_cycle_proposals_gin'),
+        ),
+    ]
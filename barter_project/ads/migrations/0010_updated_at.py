@@ -0,0 +1,27 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:41
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0009_trade_cycle'),
+    ]
+
+    operations = [
+        # существующие строки получают время миграции: кэши клиентов один раз инвалидируются, и только
+        migrations.AddField(
+            model_name='ad',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='exchangeproposal',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
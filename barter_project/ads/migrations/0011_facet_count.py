@@ -0,0 +1,37 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:52
+
+from django.db import migrations, models
+
+
+def fill_facets(apps, schema_editor):
+    FacetCount = apps.get_model('ads', 'FacetCount')
+    for model_name, dimensions in (('Ad', ('category', 'condition')), ('ExchangeProposal', ('status',))):
+        model = apps.get_model('ads', model_name)
+        for dimension in dimensions:
+            FacetCount.objects.bulk_create([
+                FacetCount(dimension=dimension, value=value, count=count)
+                for value, count in model.objects.order_by().values_list(dimension).annotate(count=models.Count('pk'))
+            ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0010_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacetCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimension', models.CharField(max_length=50)),
+                ('value', models.CharField(max_length=50)),
+                ('count', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('dimension', 'value'), name='ads_facet_unique')],
+            },
+        ),
+        migrations.RunPython(fill_facets, migrations.RunPython.noop),
+    ]
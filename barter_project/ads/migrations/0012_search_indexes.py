@@ -0,0 +1,41 @@
+# Generated by Django 5.2.1 on 2026-10-18 17:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+TRIGRAM_INDEXES = {
+    'ads_ad_title_trgm': 'title',
+    'ads_ad_description_trgm': 'description',
+}
+
+
+def create_trigram_indexes(apps, schema_editor):
+    # pg_trgm есть не на каждом сервере (в сборках без contrib его нет): тогда поиск остаётся без запасного варианта
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        if cursor.fetchone() is None:
+            return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for name, column in TRIGRAM_INDEXES.items():
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON ads_ad USING gin ({column} gin_trgm_ops)')
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    for name in TRIGRAM_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0011_facet_count'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ad',
+            index=models.Index(fields=['updated_at'], name='ads_ad_updated_idx'),
+        ),
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.1 on 2026-10-18 17:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0012_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedProposal',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('comment', models.TextField()),
+                ('status', models.CharField(choices=[('pendidng', 'ожидает'), ('accepted', 'принят'), ('declined', 'отклонен')], max_length=50)),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='exchangeproposal',
+            index=models.Index(condition=models.Q(('status', 'pending'), _negated=True), fields=['updated_at', 'id'], name='ads_proposal_resolved_idx'),
+        ),
+        migrations.AddField(
+            model_name='archivedproposal',
+            name='ad_receiver',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_received', to='ads.ad'),
+        ),
+        migrations.AddField(
+            model_name='archivedproposal',
+            name='ad_sender',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_sent', to='ads.ad'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedproposal',
+            index=models.Index(fields=['-created_at', '-id'], name='ads_archived_created_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.1 on 2026-10-18 17:55
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0013_archived_proposal'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProposalEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('proposal_id', models.BigIntegerField()),
+                ('status', models.CharField(max_length=50)),
+                ('ad_sender_id', models.BigIntegerField()),
+                ('ad_receiver_id', models.BigIntegerField()),
+                ('created_at', models.DateTimeField()),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'id'], name='ads_event_user_idx'), models.Index(fields=['created_at'], name='ads_event_created_idx')],
+            },
+        ),
+    ]
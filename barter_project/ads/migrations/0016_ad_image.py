@@ -0,0 +1,35 @@
+# Generated by Django 5.2.1 on 2026-10-18 18:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0015_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AdImage',
+            fields=[
+                ('name', models.CharField(max_length=80, primary_key=True, serialize=False)),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('size', models.PositiveIntegerField()),
+                ('ready', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='ad',
+            name='image_ready',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='ad',
+            name='image',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ads', to='ads.adimage'),
+        ),
+    ]
@@ -1,8 +1,42 @@
-from django.db import models
+import json
+from collections import Counter
+from contextlib import nullcontext
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.conf import settings
+from django.contrib.postgres.search import SearchVectorField
+from django.core.files.storage import default_storage
+from django.db import connection, models, transaction
+from django.db.models.functions import Now
+from django.utils import timezone
 from django.contrib.auth.models import User
 
+from . import cache, events
+from .search import SEARCH_VECTOR
+from .thumbnails import FORMATS, original_path, thumbnail_path
+
+
+class AdManager(models.Manager):
+    def get_queryset(self):
+        # поисковый вектор нужен только в WHERE, тащить его в каждую выборку незачем
+        return super().get_queryset().defer('search_vector')
+
 
 class Ad(models.Model):
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='ads_ad_search_gin'),
+            models.Index(fields=['-created_at', '-id'], name='ads_ad_created_idx'),
+            models.Index(fields=['category', '-created_at', '-id'], name='ads_ad_category_idx'),
+            models.Index(fields=['condition', '-created_at', '-id'], name='ads_ad_condition_idx'),
+            # догрузка изменений для индекса автодополнения
+            models.Index(fields=['updated_at'], name='ads_ad_updated_idx'),
+        ]
+
     CONDITION_CHOICES = [
         ('new', 'новый'),
         ('used', 'б/у')
@@ -12,17 +46,151 @@ class Ad(models.Model):
     title = models.CharField(max_length=200)
     description = models.CharField(max_length=200)
     image_url = models.URLField(blank=True, null=True)
+    # загруженное фото; image_ready — превью уже построены (флаг здесь, чтобы списку не нужен был join)
+    image = models.ForeignKey('AdImage', on_delete=models.SET_NULL, null=True, blank=True, related_name='ads')
+    image_ready = models.BooleanField(default=False)
     category = models.CharField(max_length=50)
     condition = models.CharField(max_length=10, choices=CONDITION_CHOICES)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    search_vector = models.GeneratedField(
+        expression=SEARCH_VECTOR,
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
+    objects = AdManager()
+
+    FACETS = ('category', 'condition')
 
     def __str__(self):
         return self.title
 
+    @property
+    def image_urls(self):
+        return AdImage.urls(self.image_id, self.image_ready)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_user_id = instance.__dict__.get('user_id')
+        instance._loaded_facets = facet_values(instance)
+        return instance
+
+    def save(self, *args, **kwargs):
+        owner_changed = not self._state.adding and self.user_id != getattr(self, '_loaded_user_id', self.user_id)
+        facets = facet_deltas(None if self._state.adding else self._loaded_facets, facet_values(self))
+        with transaction.atomic() if owner_changed or facets else nullcontext():
+            super().save(*args, **kwargs)
+            if owner_changed:
+                proposals = ExchangeProposal.objects.filter(models.Q(ad_sender=self) | models.Q(ad_receiver=self))
+                ProposalParticipant.objects.rebuild(proposals.values_list('id', flat=True))
+            FacetCount.objects.apply(facets)
+        self._loaded_user_id = self.user_id
+        self._loaded_facets = facet_values(self)
+
+
+class AdImage(models.Model):
+    # файл адресуется содержимым: имя — sha256 байт оригинала и расширение, одинаковые загрузки делят файл и превью
+    name = models.CharField(max_length=80, primary_key=True)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    size = models.PositiveIntegerField()
+    ready = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @staticmethod
+    def urls(name, ready):
+        """{'original': url, размер: {'webp': url, 'jpeg': url} или None, пока превью не готовы}; None без фото."""
+        if name is None:
+            return None
+        urls = {'original': default_storage.url(original_path(name))}
+        for size in settings.ADS_THUMBNAIL_SIZES:
+            urls[size] = {
+                fmt: default_storage.url(thumbnail_path(name, size, fmt)) for fmt in FORMATS
+            } if ready else None
+        return urls
+
+
+class ProposalQuerySet(models.QuerySet):
+    def with_ads(self):
+        return self.select_related('ad_sender__user', 'ad_receiver').defer(
+            'ad_sender__search_vector', 'ad_receiver__search_vector'
+        )
+
+
+class ExchangeProposalQuerySet(ProposalQuerySet):
+
+    def change_statuses(self, actions, ads):
+        """Принимает/отклоняет предложения пачкой: actions — [(id, 'accept' | 'decline')] по порядку,
+        ads — {id: (ad_sender_id, ad_receiver_id)}. Возвращает по элементу на действие:
+        новый статус или 'conflict', если предложение уже обработано (в том числе принятием раньше в пачке).
+        """
+        accept_ads = sorted({ad for pk, action in actions if action == 'accept' for ad in ads[pk]})
+        with transaction.atomic():
+            # объявления блокируются в одном порядке, поэтому принятия на одно объявление идут по очереди
+            list(Ad.objects.select_for_update().filter(pk__in=accept_ads).order_by('pk').values_list('pk', flat=True))
+            # сами предложения и всё ожидающее по этим объявлениям — одной выборкой под блокировкой
+            touched = models.Q(pk__in=[pk for pk, action in actions])
+            if accept_ads:
+                touched |= models.Q(status='pending') & (
+                    models.Q(ad_sender__in=accept_ads) | models.Q(ad_receiver__in=accept_ads)
+                )
+            current = {
+                pk: (status, (sender, receiver))
+                for pk, status, sender, receiver in self.filter(touched).order_by('pk').select_for_update()
+                .values_list('pk', 'status', 'ad_sender_id', 'ad_receiver_id')
+            }
+
+            results, accepted, declined, taken = [], set(), set(), set()
+            for pk, action in actions:
+                status, pair = current.get(pk, (None, None))
+                # пара объявлений могла смениться после чтения ads — тогда блокировки не те
+                if status != 'pending' or pk in accepted or pk in declined or pair != ads[pk] or taken & set(pair):
+                    results.append('conflict')
+                elif action == 'accept':
+                    accepted.add(pk)
+                    taken.update(pair)
+                    results.append('accepted')
+                else:
+                    declined.add(pk)
+                    results.append('declined')
+
+            # остальные ожидающие предложения по принятым объявлениям больше невыполнимы
+            declined.update(
+                pk for pk, (status, pair) in current.items()
+                if status == 'pending' and pk not in accepted and taken & set(pair)
+            )
+            if accepted:
+                self.filter(pk__in=accepted).update(status='accepted', updated_at=Now())
+            if declined:
+                self.filter(pk__in=declined).update(status='declined', updated_at=Now())
+            if accepted or declined:
+                ProposalEvent.objects.record(accepted | declined)
+                stale = [models.Q(ads__overlap=sorted(taken))] if taken else []
+                stale += [models.Q(proposals__overlap=sorted(declined))] if declined else []
+                TradeCycle.objects.filter(reduce(or_, stale)).delete()
+                FacetCount.objects.apply({
+                    ('status', 'pending'): -len(accepted) - len(declined),
+                    ('status', 'accepted'): len(accepted), ('status', 'declined'): len(declined),
+                })
+        cache.bump_ads(*{ad for pk in accepted | declined for ad in current[pk][1]}, listing=False)
+        return results
+
 
 class ExchangeProposal(models.Model):
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='ads_proposal_created_idx'),
+            models.Index(fields=['status', '-created_at', '-id'], name='ads_proposal_status_idx'),
+            # список смежности графа обменов: входящие дуги объявления среди ожидающих предложений
+            models.Index(fields=['ad_receiver', 'ad_sender'], condition=models.Q(status='pending'),
+                         name='ads_proposal_pending_idx'),
+            # кандидаты в архив: решённые предложения по времени решения
+            models.Index(fields=['updated_at', 'id'], condition=~models.Q(status='pending'),
+                         name='ads_proposal_resolved_idx'),
+        ]
 
     STATUS_CHOICES = [
         ('pendidng', 'ожидает'),
@@ -35,7 +203,348 @@ class ExchangeProposal(models.Model):
     comment = models.TextField()
     status = models.CharField(max_length=50, choices=STATUS_CHOICES, default='pending')
     created_at = models.DateTimeField(auto_now_add=True)
+    # auto_now не срабатывает на .update(), поэтому смены статуса проставляют его сами
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ExchangeProposalQuerySet.as_manager()
+
+    FACETS = ('status',)
 
     def __str__(self):
         return self.comment
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_ads = (instance.__dict__.get('ad_sender_id'), instance.__dict__.get('ad_receiver_id'))
+        instance._loaded_facets = facet_values(instance)
+        return instance
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        ads_changed = getattr(self, '_loaded_ads', None) not in (None, (self.ad_sender_id, self.ad_receiver_id))
+        facets = facet_deltas(None if adding else self._loaded_facets, facet_values(self))
+        with transaction.atomic() if adding or ads_changed or facets else nullcontext():
+            super().save(*args, **kwargs)
+            if adding:
+                ProposalParticipant.objects.bulk_create(ProposalParticipant.for_proposal(self))
+                ProposalEvent.objects.record([self.pk])
+            elif ads_changed:
+                ProposalParticipant.objects.rebuild([self.pk])
+            FacetCount.objects.apply(facets)
+        self._loaded_ads = (self.ad_sender_id, self.ad_receiver_id)
+        self._loaded_facets = facet_values(self)
+
+    def accept(self):
+        return self.change_status('accept')
+
+    def decline(self):
+        return self.change_status('decline')
+
+    def change_status(self, action):
+        result, = ExchangeProposal.objects.change_statuses(
+            [(self.pk, action)], {self.pk: (self.ad_sender_id, self.ad_receiver_id)}
+        )
+        if result == 'conflict':
+            return False
+        self.status = result
+        self._loaded_facets = facet_values(self)
+        return True
+
+
+class ArchivedProposal(models.Model):
+    # решённые предложения старше ADS_ARCHIVE_AFTER_DAYS: те же колонки и id, что в ExchangeProposal,
+    # поэтому читаются тем же сериализатором; переносит их ads.archive
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='ads_archived_created_idx'),
+        ]
+
+    id = models.BigIntegerField(primary_key=True)
+    ad_sender = models.ForeignKey(Ad, on_delete=models.CASCADE, related_name='archived_sent')
+    ad_receiver = models.ForeignKey(Ad, on_delete=models.CASCADE, related_name='archived_received')
+    comment = models.TextField()
+    status = models.CharField(max_length=50, choices=ExchangeProposal.STATUS_CHOICES)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    objects = ProposalQuerySet.as_manager()
+
+    def __str__(self):
+        return self.comment
+
+
+class ProposalParticipantQuerySet(models.QuerySet):
+    def inbox(self, user):
+        return self.filter(user=user).order_by('-created_at', '-proposal_id').select_related(
+            'proposal__ad_sender__user', 'proposal__ad_receiver'
+        ).defer('proposal__ad_sender__search_vector', 'proposal__ad_receiver__search_vector')
+
+    def rebuild(self, proposal_ids):
+        proposals = ExchangeProposal.objects.filter(pk__in=proposal_ids).values_list(
+            'id', 'created_at', 'ad_sender__user_id', 'ad_receiver__user_id'
+        )
+        participants = []
+        for proposal_id, created_at, sender_id, receiver_id in proposals:
+            participants += [
+                ProposalParticipant(user_id=user_id, proposal_id=proposal_id, created_at=created_at)
+                for user_id in {sender_id, receiver_id}
+            ]
+        self.filter(proposal_id__in=proposal_ids).delete()
+        self.bulk_create(participants)
+
+
+class ProposalParticipant(models.Model):
+    # входящие и исходящие предложения пользователя одной строкой на участника:
+    # «мои предложения» читаются одним диапазоном индекса (user, created_at)
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'proposal'], name='ads_participant_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-proposal'], name='ads_participant_inbox_idx'),
+        ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='proposal_inbox')
+    proposal = models.ForeignKey(ExchangeProposal, on_delete=models.CASCADE, related_name='participants')
+    created_at = models.DateTimeField()
+
+    objects = ProposalParticipantQuerySet.as_manager()
+
+    @classmethod
+    def for_proposal(cls, proposal):
+        users = {proposal.ad_sender.user_id, proposal.ad_receiver.user_id}
+        return [cls(user_id=user_id, proposal=proposal, created_at=proposal.created_at) for user_id in users]
+
+
+
+class ProposalEventQuerySet(models.QuerySet):
+    def record(self, proposal_ids):
+        """Пишет по событию на участника каждого предложения в его текущем статусе одним INSERT ... SELECT;
+        рассылка подписчикам — после коммита.
+        """
+        if not proposal_ids:
+            return []
+        columns = 'user_id, proposal_id, status, ad_sender_id, ad_receiver_id'
+        with connection.cursor() as cursor:
+            cursor.execute(f'''
+                INSERT INTO {self.model._meta.db_table} ({columns}, created_at)
+                SELECT participant.user_id, proposal.id, proposal.status, proposal.ad_sender_id,
+                       proposal.ad_receiver_id, now()
+                FROM {ProposalParticipant._meta.db_table} participant
+                JOIN {ExchangeProposal._meta.db_table} proposal ON proposal.id = participant.proposal_id
+                WHERE participant.proposal_id = ANY(%s)
+                ORDER BY proposal.id, participant.user_id
+                RETURNING id, {columns}
+            ''', [sorted(proposal_ids)])
+            recorded = [events.Event(*row) for row in cursor.fetchall()]
+        events.dispatch(recorded)
+        return recorded
+
+    def since(self, user_id, last_id, limit):
+        return [
+            events.Event(*row) for row in self.filter(user_id=user_id, pk__gt=last_id).order_by('pk').values_list(
+                'pk', 'user_id', 'proposal_id', 'status', 'ad_sender_id', 'ad_receiver_id'
+            )[:limit]
+        ]
+
+    def resume_point(self, user_id, last_id, window):
+        """id, после которого дочитывать события пользователя, уже получившего last_id.
+
+        id выдаётся при вставке, а виден после коммита: транзакция с меньшим id может закоммититься позже,
+        поэтому перечитываются и события за window до last_id — повторы отсеивает получатель.
+        """
+        anchor = self.filter(pk=last_id).values_list('created_at', flat=True).first()
+        if anchor is None:
+            return last_id
+        first = self.filter(user_id=user_id, pk__lt=last_id, created_at__gte=anchor - window).order_by('pk').values_list(
+            'pk', flat=True
+        ).first()
+        return first - 1 if first is not None else last_id
+
+    def by_ids(self, ids):
+        return [
+            events.Event(*row) for row in self.filter(pk__in=ids).order_by('pk').values_list(
+                'pk', 'user_id', 'proposal_id', 'status', 'ad_sender_id', 'ad_receiver_id'
+            )
+        ]
+
+
+class ProposalEvent(models.Model):
+    # лента событий по предложениям для SSE: строка на участника, id — Last-Event-ID для докачки
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'id'], name='ads_event_user_idx'),
+            models.Index(fields=['created_at'], name='ads_event_created_idx'),
+        ]
+
+    # отдельный индекс по user не нужен: его покрывает (user, id)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', db_index=False)
+    # без внешних ключей: предложение уходит в архив, а событие о нём остаётся
+    proposal_id = models.BigIntegerField()
+    status = models.CharField(max_length=50)
+    ad_sender_id = models.BigIntegerField()
+    ad_receiver_id = models.BigIntegerField()
+    created_at = models.DateTimeField()
+
+    objects = ProposalEventQuerySet.as_manager()
+
+
+class JobQuerySet(models.QuerySet):
+    def claim(self, limit, worker):
+        """Забирает до limit созревших задач одним оператором; занятые другими воркерами строки пропускаются.
+
+        Захват коммитится сразу, сама задача выполняется уже без блокировок. Время — statement_timestamp(),
+        а не now(): внутри долгой транзакции now() застывает на её начале.
+        """
+        table = self.model._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f'''
+                UPDATE {table} SET status = 'running', attempts = attempts + 1, locked_at = statement_timestamp(),
+                    locked_by = %s
+                WHERE id IN (
+                    SELECT id FROM {table}
+                    WHERE status = 'queued' AND run_at <= statement_timestamp()
+                    ORDER BY run_at, id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, name, payload, attempts
+            ''', [worker, limit])
+            return [(pk, name, json.loads(payload), attempts) for pk, name, payload, attempts in cursor.fetchall()]
+
+    def requeue_stale(self, lease_seconds, max_attempts):
+        # воркер умер посреди задачи: через lease_seconds она снова в очереди, если попытки не кончились
+        return self.filter(status='running', locked_at__lt=Now() - timedelta(seconds=lease_seconds)).update(
+            status=models.Case(
+                models.When(attempts__gte=max_attempts, then=models.Value('failed')), default=models.Value('queued')
+            ),
+            locked_at=None, locked_by='', run_at=Now(),
+        )
+
+
+class Job(models.Model):
+    # фоновая задача: создаётся в транзакции вызывающего кода и видна воркеру только после её коммита
+    class Meta:
+        indexes = [
+            models.Index(fields=['run_at', 'id'], condition=models.Q(status='queued'), name='ads_job_queued_idx'),
+        ]
+
+    STATUS_CHOICES = [
+        ('queued', 'в очереди'),
+        ('running', 'выполняется'),
+        ('failed', 'попытки исчерпаны'),
+    ]
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    locked_by = models.CharField(max_length=100, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = JobQuerySet.as_manager()
+
+
+class TradeCycle(models.Model):
+    # цикл обмена A→B→C→A: ads[i] отдаётся владельцу ads[i + 1] по предложению proposals[i]
+    class Meta:
+        indexes = [
+            GinIndex(fields=['ads'], name='ads_cycle_ads_gin'),
+            GinIndex(fields=['proposals'], name='ads_cycle_proposals_gin'),
+        ]
+
+    key = models.CharField(max_length=255, unique=True)
+    ads = ArrayField(models.BigIntegerField())
+    proposals = ArrayField(models.BigIntegerField())
+    length = models.PositiveSmallIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @staticmethod
+    def make_key(ads):
+        return '-'.join(map(str, ads))
+
+
+def facet_values(instance):
+    return {dimension: instance.__dict__.get(dimension) for dimension in instance.FACETS}
+
+
+def facet_deltas(old, new):
+    # old=None — объект только создаётся, new=None — удаляется
+    deltas = Counter()
+    for dimension in old or new:
+        before = old[dimension] if old else None
+        after = new[dimension] if new else None
+        if old and new and before is None:
+            continue  # поле было отложено (defer), сравнивать не с чем
+        if before != after:
+            if before is not None:
+                deltas[dimension, before] -= 1
+            if after is not None:
+                deltas[dimension, after] += 1
+    return dict(deltas)
+
+
+def facet_totals(objects):
+    # для bulk_create, который обходит save: приращения по всей пачке разом
+    return Counter((dimension, value) for obj in objects for dimension, value in facet_values(obj).items())
+
+
+class FacetCountQuerySet(models.QuerySet):
+    def apply(self, deltas):
+        deltas = {key: delta for key, delta in sorted(deltas.items()) if delta}
+        if not deltas:
+            return
+        # строки новых значений создаются нулевыми, сам счёт всегда идёт через count = count + delta,
+        # поэтому параллельные транзакции не теряют чужие приращения
+        self.bulk_create([FacetCount(dimension=dimension, value=value) for dimension, value in deltas],
+                         ignore_conflicts=True)
+        self.filter(reduce(or_, (models.Q(dimension=dimension, value=value) for dimension, value in deltas))).update(
+            count=models.F('count') + models.Case(
+                *(models.When(dimension=dimension, value=value, then=delta)
+                  for (dimension, value), delta in deltas.items()),
+                output_field=models.BigIntegerField(),
+            )
+        )
+
+    def totals(self, dimensions):
+        counts = {dimension: {} for dimension in dimensions}
+        for dimension, value, count in self.filter(dimension__in=dimensions, count__gt=0).order_by(
+            'dimension', '-count', 'value'
+        ).values_list('dimension', 'value', 'count'):
+            counts[dimension][value] = count
+        return counts
+
+    def rebuild(self):
+        rows = []
+        for model in (Ad, ExchangeProposal):
+            for dimension in model.FACETS:
+                rows += [
+                    FacetCount(dimension=dimension, value=value, count=count)
+                    for value, count in model.objects.order_by().values_list(dimension).annotate(
+                        count=models.Count('pk')
+                    )
+                ]
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create(rows)
+        return rows
+
+
+class FacetCount(models.Model):
+    # счётчики для фасетов category/condition/status, чтобы не считать GROUP BY по всей таблице;
+    # поддерживаются в save/accept/decline и сигналах удаления, дрейф чинит rebuild_facets
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['dimension', 'value'], name='ads_facet_unique'),
+        ]
+
+    dimension = models.CharField(max_length=50)
+    value = models.CharField(max_length=50)
+    count = models.BigIntegerField(default=0)
+
+    objects = FacetCountQuerySet.as_manager()
@@ -0,0 +1,235 @@
+import json
+from base64 import b64decode, b64encode
+from datetime import datetime
+from functools import partial
+
+from django.core.paginator import InvalidPage, Paginator
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+def encode_cursor(values, reverse=False):
+    payload = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    data = json.dumps({'v': payload, 'r': int(reverse)}, separators=(',', ':'))
+    return b64encode(data.encode()).decode()
+
+
+def cursor_value(field, value):
+    # курсор приходит от клиента: значение неверного типа должно дать 404 здесь, а не 500 на выборке
+    name = field.lstrip('-')
+    if name.endswith('_at'):
+        return datetime.fromisoformat(value)
+    if name in ('id', 'pk') or name.endswith('_id'):
+        if type(value) is not int:
+            raise ValueError
+        return value
+    if name == 'rank':
+        if type(value) not in (int, float):
+            raise ValueError
+        return float(value)
+    return value
+
+
+def decode_cursor(encoded, ordering):
+    try:
+        data = json.loads(b64decode(encoded.encode()).decode())
+        values = data['v']
+        if not isinstance(values, list) or len(values) != len(ordering):
+            raise ValueError
+        values = [cursor_value(field, value) for field, value in zip(ordering, values)]
+        return values, bool(data.get('r'))
+    except (TypeError, ValueError, KeyError, UnicodeDecodeError):
+        raise NotFound('Invalid cursor')
+
+
+def keyset_filter(ordering, values, reverse=False):
+    # (a, b) < (va, vb) раскрывается в a <= va AND (a < va OR (a = va AND b < vb)):
+    # первое условие даёт диапазон по индексу, остальное отсекает границу
+    fields = [field.lstrip('-') for field in ordering]
+    lookups = ['gt' if field.startswith('-') == reverse else 'lt' for field in ordering]
+
+    condition = Q()
+    for position, field in enumerate(fields):
+        step = Q(**dict(zip(fields[:position], values[:position])))
+        step &= Q(**{f'{field}__{lookups[position]}': values[position]})
+        condition |= step
+    return Q(**{f'{fields[0]}__{lookups[0]}e': values[0]}) & condition
+
+
+def reverse_ordering(ordering):
+    return [field[1:] if field.startswith('-') else f'-{field}' for field in ordering]
+
+
+def get_keyset_values(obj, ordering):
+    if isinstance(obj, dict):
+        return [obj[field.lstrip('-')] for field in ordering]
+    return [getattr(obj, field.lstrip('-')) for field in ordering]
+
+
+class KeysetPagination(BasePagination):
+    page_size = api_settings.PAGE_SIZE
+    cursor_query_param = 'cursor'
+    ordering = ('-created_at', '-id')
+
+    def get_ordering(self, view):
+        return list(getattr(view, 'keyset_ordering', self.ordering))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.set_page(list(self.page_queryset(queryset, request, view)))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        return self.set_page([obj async for obj in self.page_queryset(queryset, request, view)])
+
+    def page_queryset(self, queryset, request, view):
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(view)
+
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded:
+            self.cursor_values, self.reverse = decode_cursor(encoded, self.ordering)
+        else:
+            self.cursor_values, self.reverse = None, False
+
+        ordering = reverse_ordering(self.ordering) if self.reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if self.cursor_values is not None:
+            queryset = queryset.filter(keyset_filter(self.ordering, self.cursor_values, self.reverse))
+        return queryset[:self.page_size + 1]
+
+    def set_page(self, results):
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if self.reverse:
+            results.reverse()
+            self.has_next, self.has_previous = self.cursor_values is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.cursor_values is not None
+
+        self.page = results
+        return results
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        cursor = encode_cursor(get_keyset_values(self.page[-1], self.ordering))
+        return replace_query_param(self.base_url, self.cursor_query_param, cursor)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        cursor = encode_cursor(get_keyset_values(self.page[0], self.ordering), reverse=True)
+        return replace_query_param(self.base_url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        return [{
+            'name': self.cursor_query_param,
+            'required': False,
+            'in': 'query',
+            'description': 'Курсор страницы из ссылок next/previous',
+            'schema': {'type': 'string'},
+        }]
+
+
+class CountedPaginator(Paginator):
+    # число строк уже известно (агрегат для ETag), второй COUNT(*) не нужен
+    def __init__(self, *args, count, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.count = count
+
+
+class HybridPagination(PageNumberPagination):
+    # ?pagination=cursor включает курсорный режим без COUNT(*) и OFFSET;
+    # порядок в нём всегда (created_at, id), ранжирование поиска не учитывается
+    mode_query_param = 'pagination'
+    keyset_class = KeysetPagination
+
+    def use_keyset(self, request):
+        keyset = self.keyset_class
+        return (request.query_params.get(self.mode_query_param) == 'cursor' or
+                keyset.cursor_query_param in request.query_params)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if self.use_keyset(request):
+            self.keyset = self.keyset_class()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        count = getattr(view, 'known_count', None)
+        if count is not None:
+            self.django_paginator_class = partial(CountedPaginator, count=count)
+        return super().paginate_queryset(queryset, request, view)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if self.use_keyset(request):
+            self.keyset = self.keyset_class()
+            return await self.keyset.apaginate_queryset(queryset, request, view)
+
+        # то же, что PageNumberPagination.paginate_queryset, но COUNT и страница читаются через async ORM
+        self.request = request
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+        count = getattr(view, 'known_count', None)
+        if count is None:
+            count = await queryset.acount()
+        paginator = CountedPaginator(queryset, page_size, count=count)
+        page_number = self.get_page_number(request, paginator)
+        try:
+            self.page = paginator.page(page_number)
+        except InvalidPage as exc:
+            raise NotFound(self.invalid_page_message.format(page_number=page_number, message=str(exc)))
+        self.page.object_list = [obj async for obj in self.page.object_list]
+        return list(self.page)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+    def get_next_link(self):
+        if self.keyset is not None:
+            return self.keyset.get_next_link()
+        return super().get_next_link()
+
+    def get_previous_link(self):
+        if self.keyset is not None:
+            return self.keyset.get_previous_link()
+        return super().get_previous_link()
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema['required'] = ['results']
+        return response_schema
+
+    def get_schema_operation_parameters(self, view):
+        return super().get_schema_operation_parameters(view) + [
+            {
+                'name': self.mode_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'cursor — курсорная пагинация по (created_at, id)',
+                'schema': {'type': 'string', 'enum': ['cursor']},
+            },
+        ] + self.keyset_class().get_schema_operation_parameters(view)
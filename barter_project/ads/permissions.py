@@ -6,7 +6,7 @@ class IsOwnerOrReadOnly(permissions.BasePermission):
         if request.method in permissions.SAFE_METHODS:
             return True
         else:
-            return obj.user == request.user
+            return obj.user_id == request.user.id
 
 
 class IsSenderOrReadOnly(permissions.BasePermission):
@@ -15,4 +15,4 @@ class IsSenderOrReadOnly(permissions.BasePermission):
             return True
 
         else:
-            return obj.ad_sender.user == request.user
+            return obj.ad_sender.user_id == request.user.id
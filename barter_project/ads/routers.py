@@ -0,0 +1,69 @@
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# состояние текущего HTTP-запроса; вне запросов (команды, shell, тесты) всё читается с primary
+_request_state = ContextVar('ads_db_request_state', default=None)
+
+
+class RequestState:
+    __slots__ = ('pinned', 'wrote')
+
+    def __init__(self, pinned):
+        self.pinned = pinned
+        self.wrote = False
+
+
+def enter_request(pinned):
+    state = RequestState(pinned)
+    return state, _request_state.set(state)
+
+
+def exit_request(token):
+    _request_state.reset(token)
+
+
+def pin_primary():
+    # до конца запроса читать с primary, не закрепляя клиента cookie
+    state = _request_state.get()
+    if state is not None:
+        state.pinned = True
+
+
+def replicas():
+    return settings.ADS_READ_REPLICAS
+
+
+class PrimaryReplicaRouter:
+    """Чтения безопасных запросов — на случайную реплику, остальное — на primary.
+
+    После записи запрос до конца читает с primary, а middleware закрепляет за клиентом primary
+    ещё на ADS_REPLICA_PIN_SECONDS, чтобы он видел свои изменения, пока реплика догоняет.
+    select_for_update сам идёт через db_for_write.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = _request_state.get()
+        if state is None or state.pinned or not replicas():
+            return DEFAULT_DB_ALIAS
+        # внутри транзакции на primary читаем оттуда же, иначе не увидим свои незакоммиченные строки
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas())
+
+    def db_for_write(self, model, **hints):
+        state = _request_state.get()
+        if state is not None:
+            state.pinned = state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # реплики — копии primary, объекты из них можно связывать между собой
+        aliases = {DEFAULT_DB_ALIAS, *replicas()}
+        return obj1._state.db in aliases and obj2._state.db in aliases
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # схему на реплику приносит репликация
+        return db not in replicas()
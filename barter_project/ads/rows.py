@@ -0,0 +1,108 @@
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.fields import ISO_8601
+from rest_framework.settings import api_settings
+
+from .serializer import ColumnsField, FieldSelectionMixin
+
+# поля, у которых to_representation для значения из БД ничего не меняет
+PLAIN_FIELDS = (serializers.IntegerField, serializers.CharField, serializers.ChoiceField, serializers.BooleanField)
+
+
+def iso_datetime(value):
+    # то же, что DateTimeField.to_representation для ISO 8601 и текущей зоны, без обвязки поля
+    if not value:
+        return None
+    value = timezone.localtime(value).isoformat()
+    return value[:-6] + 'Z' if value.endswith('+00:00') else value
+
+
+def datetime_converter(field):
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    if settings.USE_TZ and not hasattr(field, 'timezone') and output_format and output_format.lower() == ISO_8601:
+        return iso_datetime
+    return field.to_representation
+
+
+def display_converter(model, name):
+    labels = dict(model._meta.get_field(name).flatchoices)
+    return lambda value: labels.get(value, value)
+
+
+class RowSerializer:
+    """Read-only сериализатор поверх .values(): собирается из DRF-сериализатора в одно выражение-словарь.
+
+    Форма JSON та же, что у исходного сериализатора; писать по-прежнему через него.
+    """
+
+    def __init__(self, serializer_class, prefix='', fields=None, expand=()):
+        self.prefix = prefix
+        self.columns = []
+        self.headers = []
+        # вложенные модели: (путь от корня, модель) — для select_related и ETag
+        self.relations = []
+        self.converters = {}
+        if issubclass(serializer_class, FieldSelectionMixin):
+            serializer = serializer_class(fields=fields, expand=expand)
+        else:
+            serializer = serializer_class()
+        body = self.compile(serializer, prefix)
+        # в выражение попадают только имена полей сериализатора и колонки, собранные выше
+        self.to_representation = eval(f'lambda row: {body}', self.converters)
+        self.columns = list(dict.fromkeys(self.columns))
+
+    def compile(self, serializer, prefix, path=''):
+        model = serializer.Meta.model
+        items = []
+        for name, field in serializer.fields.items():
+            if field.write_only:
+                continue
+            source = field.source
+            if isinstance(field, serializers.ModelSerializer):
+                self.relations.append(((prefix + source)[len(self.prefix):], field.Meta.model))
+                value = self.compile(field, f'{prefix}{source}__', f'{path}{name}.')
+                items.append(f'{name!r}: {value}')
+                continue
+
+            if isinstance(field, ColumnsField):
+                converter_name = f'_{len(self.converters)}'
+                self.converters[converter_name] = field.from_columns
+                columns = [prefix + column for column in field.columns]
+                self.columns += columns
+                self.headers += [f'{path}{name}.{header}' for header in field.headers]
+                items.append(f'{name!r}: {converter_name}({", ".join(f"row[{column!r}]" for column in columns)})')
+                continue
+
+            converter = None
+            if source.startswith('get_') and source.endswith('_display'):
+                source = source[len('get_'):-len('_display')]
+                converter = display_converter(model, source)
+            elif isinstance(field, serializers.DateTimeField):
+                converter = datetime_converter(field)
+            elif not isinstance(field, PLAIN_FIELDS) or '.' in source:
+                raise ImproperlyConfigured(f'{type(serializer).__name__}.{name}: {type(field).__name__} не поддержан')
+
+            column = prefix + source
+            self.columns.append(column)
+            self.headers.append(path + name)
+            value = f'row[{column!r}]'
+            if converter is not None:
+                converter_name = f'_{len(self.converters)}'
+                self.converters[converter_name] = converter
+                value = f'{converter_name}({value})'
+            items.append(f'{name!r}: {value}')
+        return '{' + ', '.join(items) + '}'
+
+    def serialize(self, rows):
+        to_representation = self.to_representation
+        return [to_representation(row) for row in rows]
+
+
+@lru_cache
+def row_serializer(serializer_class, prefix='', fields=None, expand=()):
+    # fields/expand — замороженные деревья parse_field_tree; кэш ограничен, форм от клиентов может быть много
+    return RowSerializer(serializer_class, prefix, fields, expand)
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import tempfile
+import threading
+from functools import lru_cache
+from pathlib import Path
+
+import drf_spectacular
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils import translation
+from drf_spectacular.utils import extend_schema
+from drf_spectacular.views import SCHEMA_KWARGS, SpectacularAPIView
+from rest_framework.settings import api_settings
+
+from .conditional import not_modified, set_validators
+
+_memory = {}
+_lock = threading.Lock()
+
+
+@lru_cache
+def code_version():
+    """Версия схемы: ADS_SCHEMA_VERSION (например, git sha из деплоя) или хеш исходников проекта."""
+    if settings.ADS_SCHEMA_VERSION:
+        return settings.ADS_SCHEMA_VERSION
+    digest = hashlib.md5(drf_spectacular.__version__.encode())
+    for path in sorted(Path(settings.BASE_DIR).rglob('*.py')):
+        digest.update(str(path.relative_to(settings.BASE_DIR)).encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()[:12]
+
+
+def schema_path(key):
+    return Path(settings.ADS_SCHEMA_CACHE_DIR) / f'schema-{code_version()}-{hashlib.md5(key.encode()).hexdigest()}'
+
+
+def read_file(path):
+    try:
+        content_type, content = path.read_bytes().split(b'\n', 1)
+    except (OSError, ValueError):
+        return None
+    return content, content_type.decode()
+
+
+def write_file(path, content, content_type):
+    # через временный файл и rename: соседний воркер не прочитает недописанную схему
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.schema-')
+    with os.fdopen(fd, 'wb') as file:
+        file.write(content_type.encode() + b'\n' + content)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+
+
+def remove_stale_files():
+    prefix = f'schema-{code_version()}-'
+    removed = 0
+    for path in Path(settings.ADS_SCHEMA_CACHE_DIR).glob('schema-*'):
+        if not path.name.startswith(prefix):
+            path.unlink(missing_ok=True)
+            removed += 1
+    return removed
+
+
+def clear_memory():
+    with _lock:
+        _memory.clear()
+
+
+class CachedSchemaView(SpectacularAPIView):
+    """Схема строится один раз на версию кода, формат, язык и версию API: дальше — из памяти процесса,
+    после рестарта — из файла (его заранее пишет generate_schema). Отдаётся со строгим ETag.
+
+    Ключ — только из того, что меняет схему, и в уже нормализованном виде: иначе каждый мусорный
+    параметр или суффикс Accept заводил бы новую запись в памяти, новый файл и полную генерацию.
+    """
+
+    @extend_schema(**SCHEMA_KWARGS)
+    def get(self, request, *args, **kwargs):
+        lang = self.get_lang(request)
+        version = self.api_version or request.version or self._get_version_parameter(request)
+        key = repr((code_version(), request.accepted_renderer.media_type, lang, version))
+        cached = _memory.get(key)
+        if cached is None:
+            with _lock:
+                cached = _memory.get(key)
+                if cached is None:
+                    cached = _memory[key] = self.load(request, key, lang)
+
+        content, content_type, etag = cached
+        response = not_modified(request, etag)
+        if response is None:
+            response = set_validators(HttpResponse(content, content_type=content_type), etag)
+        return response
+
+    def _get_version_parameter(self, request):
+        # без ALLOWED_VERSIONS API не версионируется: произвольный ?version= попал бы в схему и в ключ
+        version = request.GET.get('version')
+        return version if version in (api_settings.ALLOWED_VERSIONS or ()) else None
+
+    def get_lang(self, request):
+        # неизвестный язык — как без параметра, а не отдельная копия схемы
+        lang = request.GET.get('lang')
+        if settings.USE_I18N and lang:
+            try:
+                return translation.get_supported_language_variant(lang)
+            except LookupError:
+                pass
+        return settings.LANGUAGE_CODE
+
+    def load(self, request, key, lang):
+        path = schema_path(key)
+        stored = read_file(path)
+        if stored is None:
+            content, content_type = self.generate(request, lang)
+            write_file(path, content, content_type)
+        else:
+            content, content_type = stored
+        return content, content_type, f'"{hashlib.md5(content).hexdigest()}"'
+
+    def generate(self, request, lang):
+        # язык и параметры media type (indent и т.п.) — нормализованные, как в ключе, а не как прислал клиент
+        with translation.override(lang):
+            response = self._get_schema_response(request)
+        response.accepted_renderer = request.accepted_renderer
+        response.accepted_media_type = request.accepted_renderer.media_type
+        response.renderer_context = self.get_renderer_context()
+        response.render()
+        return response.content, response['Content-Type']
@@ -0,0 +1,82 @@
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramWordSimilarity
+from django.db import connections
+from django.db.models import F, FloatField, Q
+from django.db.models.functions import Cast, Greatest
+from rest_framework.filters import BaseFilterBackend
+
+# конфигурация 'russian' стеммит кириллицу russian_stem, а латиницу english_stem,
+# поэтому одной колонкой покрываются оба языка
+SEARCH_CONFIG = 'russian'
+
+SEARCH_VECTOR = (
+    SearchVector('title', weight='A', config=SEARCH_CONFIG) +
+    SearchVector('description', weight='B', config=SEARCH_CONFIG)
+)
+
+WORD_RE = re.compile(r'\w+')
+
+
+def build_search_query(text):
+    # каждое слово ищем как префикс, чтобы «футб» находил «футболка», как раньше с icontains
+    words = WORD_RE.findall(text.lower())
+    if not words:
+        return None
+    raw = ' & '.join(f'{word}:*' for word in words)
+    return SearchQuery(raw, config=SEARCH_CONFIG, search_type='raw')
+
+
+@lru_cache
+def has_trigram(alias):
+    # pg_trgm ставит миграция 0012, если расширение есть на сервере; без него запасного поиска нет
+    with connections[alias].cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        return cursor.fetchone() is not None
+
+
+def similar_ads(queryset, text):
+    # %> идёт по GIN-индексам gin_trgm_ops и прощает опечатки: «кросовки» находит «кроссовки»
+    return queryset.filter(Q(title__trigram_word_similar=text) | Q(description__trigram_word_similar=text)).annotate(
+        rank=Cast(Greatest(TrigramWordSimilarity(text, 'title'), TrigramWordSimilarity(text, 'description')),
+                  FloatField())
+    ).order_by('-rank', '-created_at', '-id')
+
+
+def search_ads(queryset, text):
+    query = build_search_query(text or '')
+    if query is None:
+        return queryset
+    # ts_rank возвращает real: без приведения к double значение не переживает круг через курсор
+    found = queryset.filter(search_vector=query).annotate(
+        rank=Cast(SearchRank(F('search_vector'), query), FloatField())
+    ).order_by('-rank', '-created_at', '-id')
+
+    threshold = settings.ADS_SEARCH_FALLBACK_BELOW
+    if threshold and has_trigram(queryset.db) and found[:threshold].count() < threshold:
+        return similar_ads(queryset, text.strip())
+    return found
+
+
+class AdSearchFilter(BaseFilterBackend):
+    search_param = 'search'
+
+    def get_search_param(self, view):
+        return getattr(view, 'search_param', self.search_param)
+
+    def filter_queryset(self, request, queryset, view):
+        text = request.GET.get(self.get_search_param(view), '').strip()
+        return search_ads(queryset, text)
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.get_search_param(view),
+                'required': False,
+                'in': 'query',
+                'description': 'Полнотекстовый поиск по названию и описанию',
+                'schema': {'type': 'string'},
+            },
+        ]
@@ -1,34 +1,136 @@
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth.models import User
+from drf_spectacular.utils import extend_schema_field
 from rest_framework.exceptions import PermissionDenied
 
-from .models import Ad, ExchangeProposal
+from .images import uploaded_image, validate_image
+from .models import Ad, AdImage, ExchangeProposal, TradeCycle
+from .thumbnails import FORMATS
 
 
-class UserSerializer(serializers.ModelSerializer):
+def freeze(tree):
+    return tuple(sorted((name, freeze(subtree)) for name, subtree in tree.items()))
+
+
+def parse_field_tree(value):
+    """'id,ad_sender.title' -> (('ad_sender', (('title', ()),)), ('id', ())): хешируемое дерево полей."""
+    tree = {}
+    for path in (value or '').split(','):
+        node = tree
+        for name in filter(None, (part.strip() for part in path.split('.'))):
+            node = node.setdefault(name, {})
+    return freeze(tree)
+
+
+class FieldSelectionMixin:
+    # fields — какие поля отдавать (вложенные через точку, пустое поддерево — объект целиком),
+    # expand — какие из expandable_fields раскрыть; write-only поля не трогаем, чтобы не ломать запись
+    expandable_fields = {}
+
+    def __init__(self, *args, fields=None, expand=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.selected_fields = dict(fields) if fields else None
+        self.expanded_fields = dict(expand)
+
+    def get_fields(self):
+        fields = super().get_fields()
+        expand = dict(self.expanded_fields)
+        # запрошенное в fields раскрываемое поле раскрывается и без expand
+        for name in self.selected_fields or ():
+            expand.setdefault(name, ())
+        for name in expand:
+            if name in self.expandable_fields:
+                serializer_class, kwargs = self.expandable_fields[name]
+                fields[name] = serializer_class(**kwargs)
+
+        for name, field in list(fields.items()):
+            if self.selected_fields is not None and name not in self.selected_fields and not field.write_only:
+                del fields[name]
+            elif isinstance(field, FieldSelectionMixin):
+                subtree = self.selected_fields.get(name) if self.selected_fields else None
+                field.selected_fields = dict(subtree) if subtree else None
+                field.expanded_fields = dict(expand.get(name, ()))
+        return fields
+
+
+class ColumnsField(serializers.Field):
+    """Read-only поле из нескольких колонок модели; RowSerializer строит его из строки .values() тем же from_columns."""
+    columns = ()
+
+    def __init__(self, **kwargs):
+        super().__init__(source='*', read_only=True, **kwargs)
+
+    @property
+    def headers(self):
+        # колонки CSV-экспорта: пути (через точку) в словаре, который возвращает from_columns
+        return ()
+
+    def to_representation(self, instance):
+        return self.from_columns(*(
+            getattr(instance, instance._meta.get_field(column).attname) for column in self.columns
+        ))
+
+    def from_columns(self, *values):
+        raise NotImplementedError
+
+
+THUMBNAIL_SCHEMA = {'type': 'object', 'nullable': True, 'properties': {
+    fmt: {'type': 'string', 'format': 'uri'} for fmt in FORMATS
+}}
+
+
+@extend_schema_field({'type': 'object', 'nullable': True, 'properties': {
+    'original': {'type': 'string', 'format': 'uri'},
+    **{size: THUMBNAIL_SCHEMA for size in settings.ADS_THUMBNAIL_SIZES},
+}})
+class AdImageField(ColumnsField):
+    # null без фото; размеры — null, пока превью строятся
+    columns = ('image', 'image_ready')
+
+    @property
+    def headers(self):
+        return ['original', *(f'{size}.{fmt}' for size in settings.ADS_THUMBNAIL_SIZES for fmt in FORMATS)]
+
+    def from_columns(self, name, ready):
+        return AdImage.urls(name, ready)
+
+
+class UserSerializer(FieldSelectionMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['id', 'username']
 
 
-class AdSerializer(serializers.ModelSerializer):
+class AdSerializer(FieldSelectionMixin, serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
+    image = AdImageField()
+    upload = serializers.ImageField(write_only=True, required=False, validators=[validate_image])
 
     class Meta:
         model = Ad
-        fields = ['id', 'title', 'description', 'image_url', 'category', 'condition', 'created_at', 'user']
+        fields = ['id', 'title', 'description', 'image_url', 'image', 'upload', 'category', 'condition', 'created_at',
+                  'user']
         read_only_fields = ['user', 'created_at']
 
     def create(self, validated_data):
         validated_data['user'] = self.context['request'].user
-        return super().create(validated_data)
+        return super().create(self.with_image(validated_data))
+
+    def update(self, instance, validated_data):
+        return super().update(instance, self.with_image(validated_data))
 
+    def with_image(self, validated_data):
+        upload = validated_data.pop('upload', None)
+        return {**validated_data, **uploaded_image(upload)} if upload else validated_data
 
-class ExchangeProposalSerializer(serializers.ModelSerializer):
+
+class ExchangeProposalSerializer(FieldSelectionMixin, serializers.ModelSerializer):
     ad_sender = AdSerializer(read_only=True)
     ad_sender_id = serializers.PrimaryKeyRelatedField(queryset=Ad.objects.all(), write_only=True, source='ad_sender')
     ad_receiver_id = serializers.PrimaryKeyRelatedField(queryset=Ad.objects.all(), write_only=True, source='ad_receiver')
     status_display = serializers.CharField(source='get_status_display', read_only=True)
+    expandable_fields = {'ad_receiver': (AdSerializer, {'read_only': True})}
 
     class Meta:
         model = ExchangeProposal
@@ -37,6 +139,32 @@ class ExchangeProposalSerializer(serializers.ModelSerializer):
 
     def validate_ad_sender_id(self, value):
         request = self.context['request']
-        if value.user != request.user:
+        if value.user_id != request.user.id:
             raise PermissionDenied("Можно отправлять предложения только от своих объявлений")
         return value
+
+
+class TradeCycleSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = TradeCycle
+        fields = ['id', 'ads', 'proposals', 'length', 'created_at']
+
+
+class ProposalActionSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    action = serializers.ChoiceField(choices=['accept', 'decline'])
+
+
+class ProposalBatchItemSerializer(serializers.Serializer):
+    # объявления проверяются одной выборкой на всю пачку, а не PrimaryKeyRelatedField на каждый элемент
+    ad_sender_id = serializers.IntegerField()
+    ad_receiver_id = serializers.IntegerField()
+    comment = serializers.CharField()
+
+
+class ProposalBatchSerializer(serializers.Serializer):
+    actions = ProposalActionSerializer(many=True, required=False, max_length=settings.ADS_BATCH_MAX_SIZE)
+    # элементы на создание проверяются поштучно, чтобы ошибка одного не роняла пачку
+    create = serializers.ListField(
+        child=serializers.DictField(), required=False, max_length=settings.ADS_BATCH_MAX_SIZE
+    )
@@ -0,0 +1,67 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import cache
+from .authentication import invalidate_user
+from .autocomplete import title_index
+from .jobs import enqueue
+from .models import Ad, ExchangeProposal, FacetCount, TradeCycle, facet_deltas, facet_values
+
+
+@receiver(post_save, sender=Ad)
+@receiver(post_delete, sender=Ad)
+def ad_changed(sender, instance, **kwargs):
+    cache.bump_ads(instance.pk)
+
+
+@receiver(post_save, sender=Ad)
+def ad_image_saved(sender, instance, **kwargs):
+    # в транзакции сохранения: задача не увидит объявление раньше коммита и не пропустит его
+    if instance.image_id and not instance.image_ready:
+        enqueue('make_thumbnails', image=instance.image_id)
+
+
+@receiver(post_save, sender=Ad)
+def ad_title_saved(sender, instance, **kwargs):
+    transaction.on_commit(lambda: title_index.changed(instance.pk, instance.title))
+
+
+@receiver(post_delete, sender=Ad)
+def ad_title_deleted(sender, instance, **kwargs):
+    ad_id = instance.pk
+    transaction.on_commit(lambda: title_index.changed(ad_id))
+
+
+@receiver(post_save, sender=ExchangeProposal)
+@receiver(post_delete, sender=ExchangeProposal)
+def proposal_changed(sender, instance, **kwargs):
+    cache.bump_ads(instance.ad_sender_id, instance.ad_receiver_id, listing=False)
+
+
+@receiver(post_save, sender=ExchangeProposal)
+def proposal_created(sender, instance, created, **kwargs):
+    if created:
+        # сигнал приходит внутри транзакции save: задача закоммитится вместе с предложением
+        enqueue('discover_cycles', proposal_ids=[instance.pk])
+
+
+@receiver(post_delete, sender=ExchangeProposal)
+def proposal_deleted(sender, instance, **kwargs):
+    TradeCycle.objects.filter(proposals__contains=[instance.pk]).delete()
+
+
+@receiver(post_delete, sender=Ad)
+@receiver(post_delete, sender=ExchangeProposal)
+def facets_deleted(sender, instance, **kwargs):
+    # сигнал приходит внутри транзакции удаления, включая каскадные предложения
+    loaded = getattr(instance, '_loaded_facets', None) or facet_values(instance)
+    FacetCount.objects.apply(facet_deltas(loaded, None))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    # деактивация, смена пароля и прочие правки: закэшированный для JWT пользователь устарел
+    invalidate_user(instance.pk)
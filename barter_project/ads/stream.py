@@ -0,0 +1,295 @@
+import asyncio
+import json
+import logging
+from collections import deque
+from datetime import timedelta
+from functools import wraps
+from importlib import import_module
+from io import BytesIO
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.core.exceptions import DisallowedHost
+from django.core.handlers.asgi import ASGIRequest
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connection, connections
+from django.urls import reverse
+from rest_framework.exceptions import APIException, NotAuthenticated
+from rest_framework.renderers import BaseRenderer
+
+from .authentication import CachedJWTAuthentication
+from .events import CHANNEL, broker, format_event, parse_event_id
+from .models import ProposalEvent
+
+logger = logging.getLogger('ads.stream')
+
+# пропущенные события отдаются пачками такого размера
+BACKLOG_BATCH = 500
+
+
+class EventStreamRenderer(BaseRenderer):
+    # EventSource шлёт Accept: text/event-stream; ошибки (401) отдаются тем же JSON, что у API
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data if isinstance(data, bytes) else json.dumps(data).encode()
+
+
+def preamble(last_id):
+    # id без data событие не создаёт, но запоминается браузером: переподключение придёт с Last-Event-ID
+    head = f'retry: {settings.ADS_EVENTS_RETRY_MS}\n'
+    return (head + (f'id: {last_id}\n' if last_id else '') + '\n').encode()
+
+
+def latest_id(user_id):
+    return ProposalEvent.objects.filter(user_id=user_id).order_by('-pk').values_list('pk', flat=True).first() or 0
+
+
+def resume_point(user_id, last_id):
+    window = timedelta(seconds=settings.ADS_EVENTS_RESUME_WINDOW_SECONDS)
+    return ProposalEvent.objects.resume_point(user_id, last_id, window)
+
+
+def missed_events(user_id, last_id):
+    """Для синхронного пути: до ADS_EVENTS_BACKLOG_LIMIT событий после last_id и id, с которого продолжать.
+
+    Окно перед last_id отдаётся повторно: события — снимки статуса, повтор клиенту безвреден, а потеря — нет.
+    """
+    if last_id is None:
+        return [], latest_id(user_id)
+    events = [
+        event for event in ProposalEvent.objects.since(
+            user_id, resume_point(user_id, last_id), settings.ADS_EVENTS_BACKLOG_LIMIT
+        ) if event.id != last_id
+    ]
+    return events, max(last_id, events[-1].id) if events else last_id
+
+
+class Delivered:
+    """Последние отданные в стрим id: ограниченное множество вместо верхней отметки, которая теряла бы
+    событие с меньшим id, закоммиченное после большего."""
+
+    def __init__(self, size):
+        self.ids = set()
+        self.order = deque(maxlen=size)
+
+    def add(self, event_id):
+        if event_id in self.ids:
+            return False
+        if len(self.order) == self.order.maxlen:
+            self.ids.discard(self.order[0])
+        self.order.append(event_id)
+        self.ids.add(event_id)
+        return True
+
+
+def outside_request(func):
+    # вызов из пула потоков без Django-запроса: закрыть соединение, кроме нас, некому,
+    # а держать его на каждый открытый стрим нельзя
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            connection.close()
+    return sync_to_async(wrapper, thread_sensitive=False)
+
+
+@outside_request
+def open_stream(scope, last_id, loop):
+    """Аутентификация, подписка и точка отсчёта за одно соединение с БД; возвращает (подписка, last_id).
+
+    Подписка раньше выборки: событие, закоммиченное между ними, придёт дважды (отсеется по id), а не потеряется.
+    JWT — как у API, иначе сессия сайта: EventSource в браузере заголовков не шлёт.
+    """
+    request = ASGIRequest(scope, BytesIO())
+    request.get_host()
+    user_auth = CachedJWTAuthentication().authenticate(request)
+    if user_auth is None:
+        engine = import_module(settings.SESSION_ENGINE)
+        request.session = engine.SessionStore(request.COOKIES.get(settings.SESSION_COOKIE_NAME))
+        user = get_user(request)
+        if not user.is_authenticated:
+            raise NotAuthenticated()
+    else:
+        user = user_auth[0]
+    subscription = broker.subscribe(user.pk, loop)
+    return subscription, latest_id(user.pk) if last_id is None else last_id
+
+
+class Listener:
+    """LISTEN на отдельном соединении psycopg2 — одно на процесс: id из NOTIFY догружаются одной выборкой
+    и раздаются брокером, так что записи в любом процессе доходят до стримов в этом."""
+
+    reconnect_delay = 1
+
+    def __init__(self):
+        self.loop = None
+        self.connection = None
+
+    def start(self, loop):
+        if self.loop is loop:
+            return
+        # новый цикл событий (в тестах — на каждый тест): старое соединение к нему не привязано
+        self.close()
+        self.loop = loop
+        loop.create_task(self.connect())
+
+    def close(self):
+        if self.connection is not None:
+            if self.loop is not None and not self.loop.is_closed():
+                self.loop.remove_reader(self.connection.fileno())
+            self.connection.close()
+            self.connection = None
+
+    def open(self):
+        database = connections[DEFAULT_DB_ALIAS]
+        raw = database.get_new_connection(database.get_connection_params())
+        raw.autocommit = True
+        with raw.cursor() as cursor:
+            cursor.execute(f'LISTEN {CHANNEL}')
+        return raw
+
+    async def connect(self):
+        loop = self.loop
+        while True:
+            try:
+                raw = await loop.run_in_executor(None, self.open)
+                break
+            except DatabaseError as error:
+                logger.warning('LISTEN %s не удался: %s', CHANNEL, error)
+                await asyncio.sleep(self.reconnect_delay)
+        if self.loop is not loop:
+            raw.close()
+            return
+        self.connection = raw
+        loop.add_reader(raw.fileno(), self.on_readable)
+        # пока соединения не было, NOTIFY могли пройти мимо: подписчики дочитывают из БД
+        broker.lost()
+
+    def on_readable(self):
+        try:
+            self.connection.poll()
+        except DatabaseError as error:
+            logger.warning('LISTEN %s оборвался: %s', CHANNEL, error)
+            self.close()
+            self.loop.create_task(self.connect())
+            return
+        ids = []
+        while self.connection.notifies:
+            ids += map(int, self.connection.notifies.pop(0).payload.split(','))
+        if ids:
+            self.loop.create_task(self.deliver(ids))
+
+    async def deliver(self, ids):
+        broker.publish(await outside_request(ProposalEvent.objects.by_ids)(ids))
+
+
+listener = Listener()
+
+
+class ProposalStreamApp:
+    """SSE /api/proposals/stream/ под ASGI в обход Django-обработчика; остальные запросы — в application.
+
+    Открытый стрим — корутина и очередь в брокере: ни потока, ни соединения с БД, поэтому тысячи
+    простаивающих клиентов почти ничего не стоят. В БД идём при подключении (аутентификация, пропущенное
+    после Last-Event-ID) и когда медленный клиент переполнил очередь.
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.path = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            if self.path is None:
+                self.path = reverse('proposal-stream')
+            if scope['path'] == self.path:
+                return await self.stream(scope, receive, send)
+        return await self.application(scope, receive, send)
+
+    async def stream(self, scope, receive, send):
+        headers = dict(scope['headers'])
+        request_id = headers.get(b'last-event-id', b'').decode('latin-1')
+        query_id = ASGIRequest(scope, BytesIO()).GET.get('last_event_id')
+        last_id = parse_event_id(request_id) or parse_event_id(query_id)
+
+        loop = asyncio.get_running_loop()
+        try:
+            subscription, last_id = await open_stream(scope, last_id, loop)
+        except DisallowedHost:
+            return await self.respond(send, 400, {'detail': 'Bad Request'})
+        except APIException as error:
+            data = error.detail if isinstance(error.detail, (list, dict)) else {'detail': error.detail}
+            extra = [(b'www-authenticate', b'Bearer realm="api"')] if error.status_code == 401 else []
+            return await self.respond(send, error.status_code, data, extra)
+        if settings.ADS_EVENTS_NOTIFY:
+            listener.start(loop)
+
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                # nginx не должен копить поток в буфере
+                (b'x-accel-buffering', b'no'),
+            ]})
+            pumping = asyncio.ensure_future(self.pump(send, subscription, last_id, bool(request_id or query_id)))
+            disconnected = asyncio.ensure_future(self.wait_disconnect(receive))
+            done, pending = await asyncio.wait({pumping, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            if pumping in done:
+                pumping.result()
+        finally:
+            broker.unsubscribe(subscription)
+
+    async def pump(self, send, subscription, last_id, resume):
+        delivered = Delivered(settings.ADS_EVENTS_DEDUP_SIZE)
+
+        async def write(body):
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+
+        async def deliver(events):
+            # возвращает наибольший id пачки: от него считается окно следующей докачки
+            fresh = [event for event in events if delivered.add(event.id)]
+            if fresh:
+                await write(b''.join(map(format_event, fresh)))
+            return max(event.id for event in events)
+
+        await write(preamble(last_id))
+        if resume:
+            # само событие Last-Event-ID клиент уже получил
+            delivered.add(last_id)
+            last_id = await self.catch_up(deliver, subscription.user_id, last_id)
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), settings.ADS_EVENTS_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                # комментарий не даёт прокси закрыть простаивающее соединение
+                await write(b': ping\n\n')
+                continue
+            if subscription.overflowed:
+                subscription.overflowed = False
+                last_id = await self.catch_up(deliver, subscription.user_id, last_id)
+            elif event is not None:
+                last_id = max(last_id, await deliver([event]))
+
+    async def catch_up(self, deliver, user_id, last_id):
+        after = await outside_request(resume_point)(user_id, last_id)
+        while True:
+            events = await outside_request(ProposalEvent.objects.since)(user_id, after, BACKLOG_BATCH)
+            if events:
+                last_id = max(last_id, await deliver(events))
+                after = events[-1].id
+            if len(events) < BACKLOG_BATCH:
+                return last_id
+
+    async def wait_disconnect(self, receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def respond(self, send, status, data, extra=()):
+        await send({'type': 'http.response.start', 'status': status, 'headers': [
+            (b'content-type', b'application/json'), *extra,
+        ]})
+        await send({'type': 'http.response.body', 'body': json.dumps(data).encode()})
@@ -0,0 +1,93 @@
+import uuid
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+
+from . import cache
+from .models import Ad, ExchangeProposal, FacetCount, ProposalParticipant, facet_totals
+
+ITEMS = ['футболка', 'книга', 'кроссовки', 'велосипед', 'стул', 'стол', 'куртка', 'телефон',
+         'ноутбук', 'гитара', 'лампа', 'рюкзак', 'палатка', 'самокат', 'наушники', 'часы']
+ADJECTIVES = ['черная', 'новый', 'старый', 'детский', 'зимняя', 'кожаный', 'складной', 'большой']
+BRANDS = ['Salomon', 'Nike', 'Apple', 'Samsung', 'Ikea', 'Yamaha', 'Xiaomi', 'Adidas']
+
+# распределения примерно как в проде: одежды и техники больше всего, б/у чаще нового,
+# большинство предложений висит в ожидании
+CATEGORIES = {'одежда': 30, 'техника': 20, 'книги': 15, 'обувь': 12, 'спорт': 10, 'дом': 8, 'детское': 5}
+CONDITIONS = {'used': 70, 'new': 30}
+STATUSES = {'pending': 60, 'declined': 30, 'accepted': 10}
+
+
+def weighted(rnd, distribution):
+    return rnd.choices(list(distribution), weights=list(distribution.values()))[0]
+
+
+def skewed(rnd, items):
+    # небольшая доля «активных» пользователей владеет большей частью объявлений
+    return items[int(len(items) * rnd.random() ** 3)]
+
+
+def random_ad(user_id, rnd):
+    item = rnd.choice(ITEMS)
+    return Ad(
+        user_id=user_id,
+        title=f'{rnd.choice(ADJECTIVES)} {item} {rnd.choice(BRANDS)}',
+        description=f'{item}, {rnd.choice(ADJECTIVES)}, {rnd.randint(1, 99)} см',
+        category=weighted(rnd, CATEGORIES),
+        condition=weighted(rnd, CONDITIONS),
+    )
+
+
+def batched(count, batch_size):
+    while count > 0:
+        size = min(batch_size, count)
+        yield size
+        count -= size
+
+
+def create_users(count, batch_size, prefix=None, password='synthetic'):
+    prefix = prefix or f'synthetic_{uuid.uuid4().hex[:6]}_'
+    hashed = make_password(password)
+    user_ids = []
+    for offset, size in enumerate(batched(count, batch_size)):
+        users = User.objects.bulk_create([
+            User(username=f'{prefix}{offset * batch_size + i}', password=hashed) for i in range(size)
+        ])
+        user_ids += [user.pk for user in users]
+    return user_ids
+
+
+def create_ads(user_ids, count, batch_size, rnd):
+    owners = {}
+    for size in batched(count, batch_size):
+        ads = Ad.objects.bulk_create([random_ad(skewed(rnd, user_ids), rnd) for _ in range(size)])
+        owners.update((ad.pk, ad.user_id) for ad in ads)
+        FacetCount.objects.apply(facet_totals(ads))
+    cache.bump_ads()
+    return owners
+
+
+def create_proposals(owners, count, batch_size, rnd):
+    ad_ids = list(owners)
+    created = 0
+    for size in batched(count, batch_size):
+        proposals = []
+        while len(proposals) < size:
+            sender, receiver = skewed(rnd, ad_ids), rnd.choice(ad_ids)
+            if owners[sender] == owners[receiver]:
+                continue
+            proposals.append(ExchangeProposal(
+                ad_sender_id=sender, ad_receiver_id=receiver,
+                comment='Предлагаю обмен', status=weighted(rnd, STATUSES),
+            ))
+        proposals = ExchangeProposal.objects.bulk_create(proposals)
+        # bulk_create обходит ExchangeProposal.save, поэтому участников пишем сами
+        ProposalParticipant.objects.bulk_create([
+            ProposalParticipant(user_id=user_id, proposal_id=proposal.pk, created_at=proposal.created_at)
+            for proposal in proposals
+            for user_id in {owners[proposal.ad_sender_id], owners[proposal.ad_receiver_id]}
+        ])
+        # счётчики фасетов тоже: сигналов и save здесь нет
+        FacetCount.objects.apply(facet_totals(proposals))
+        created += len(proposals)
+    return created
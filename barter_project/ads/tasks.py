@@ -0,0 +1,18 @@
+from .images import generate_thumbnails
+from .jobs import handler
+from .matching import discover_cycles
+from .models import ExchangeProposal
+
+
+@handler('discover_cycles')
+def discover_proposal_cycles(proposal_ids):
+    # к моменту выполнения часть предложений могла быть принята или удалена — discover_cycles берёт только pending
+    discover_cycles(*ExchangeProposal.objects.filter(pk__in=proposal_ids).only(
+        'id', 'status', 'ad_sender_id', 'ad_receiver_id'
+    ))
+
+
+@handler('make_thumbnails')
+def make_thumbnails(image):
+    # упирается в CPU: воркер для неё запускают с --pool process
+    generate_thumbnails(image)
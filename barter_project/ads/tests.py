@@ -1,8 +1,72 @@
+import asyncio
+import json
+import random
+import tempfile
+import threading
+from base64 import b64encode
+from io import BytesIO, StringIO
+from pathlib import Path
+from contextlib import ContextDecorator
+from datetime import timedelta
+from unittest.mock import patch
+from urllib.parse import urlencode
+
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import User
+from django.core.asgi import get_asgi_application
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, connection, connections, transaction
+from django.db.models import F, QuerySet
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from rest_framework.test import APITestCase
+from django.utils import timezone
+from django.test import TransactionTestCase, override_settings
+from PIL import Image
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework import status
-from .models import Ad, ExchangeProposal
+from .autocomplete import title_index
+from .cache import cache_stats
+from .events import broker
+from .matching import ProposalGraph, rebuild_cycles
+from .metrics import registry
+from .facets import live_counts
+from .images import generate_thumbnails
+from .jobs import HANDLERS, enqueue, handler, run_pending
+from .models import (
+    Ad, AdImage, ArchivedProposal, ExchangeProposal, FacetCount, Job, ProposalEvent, ProposalParticipant, TradeCycle,
+)
+from .routers import PrimaryReplicaRouter, enter_request, exit_request
+from .rows import row_serializer
+from .schema import clear_memory, code_version
+from .search import has_trigram
+from .serializer import AdSerializer, ExchangeProposalSerializer
+from .stream import ProposalStreamApp, listener, outside_request
+from .thumbnails import original_path, thumbnail_path
+from .views import AdDetailView, AdListView, AdViewSet, ExchangeProposalViewSet
+
+
+class query_budget(ContextDecorator):
+    """Падает, если внутри блока (или теста) выполнено больше SQL-запросов, чем budget."""
+
+    def __init__(self, budget):
+        self.budget = budget
+
+    def __enter__(self):
+        self.context = CaptureQueriesContext(connection)
+        self.context.__enter__()
+        return self.context
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.context.__exit__(exc_type, exc_value, traceback)
+        if exc_type is None and len(self.context) > self.budget:
+            queries = '\n'.join(query['sql'] for query in self.context.captured_queries)
+            raise AssertionError(f'{len(self.context)} запросов при бюджете {self.budget}:\n{queries}')
+        return False
 
 
 class BarterTests(APITestCase):
@@ -107,3 +171,1520 @@ class BarterTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(proposal.status, 'accepted')
 
+    def test_accept_declines_competing_proposals(self):
+        ad3 = Ad.objects.create(user=self.user1, title="Лампа", description="Настольная", category="дом", condition="used")
+        accepted = ExchangeProposal.objects.create(ad_sender=self.ad1, ad_receiver=self.ad2, comment="Обмен")
+        competing = ExchangeProposal.objects.create(ad_sender=ad3, ad_receiver=self.ad2, comment="Или лампу")
+
+        self.authenticate(self.user2)
+        response = self.client.post(f'/api/proposals/{accepted.id}/accept/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        competing.refresh_from_db()
+        self.assertEqual(competing.status, 'declined')
+
+        response = self.client.post(f'/api/proposals/{competing.id}/accept/')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        response = self.client.post(f'/api/proposals/{accepted.id}/decline/')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+
+    def test_search_ads_fulltext(self):
+        response = self.client.get('/api/ads/', {'search': 'футболку'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([ad['id'] for ad in response.data['results']], [self.ad1.id])
+
+        response = self.client.get('/api/ads/', {'search': 'фант'})
+        self.assertEqual([ad['id'] for ad in response.data['results']], [self.ad2.id])
+
+        response = self.client.get('/api/ads/', {'search': 'велосипед'})
+        self.assertEqual(response.data['count'], 0)
+        self.assertIn('message', response.data)
+
+    def test_search_ads_html(self):
+        response = self.client.get('/', {'q': 'Книга'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(response.context['ads']), [self.ad2])
+
+    def test_ads_cursor_pagination(self):
+        Ad.objects.bulk_create([
+            Ad(user=self.user1, title=f"Вещь {i}", description="Описание", category="одежда", condition="new")
+            for i in range(12)
+        ])
+        expected = list(Ad.objects.filter(category="одежда").order_by('-created_at', '-id').values_list('id', flat=True))
+
+        seen = []
+        url = '/api/ads/?' + urlencode({'pagination': 'cursor', 'category': "одежда"})
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            seen += [ad['id'] for ad in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(seen, expected)
+
+        response = self.client.get(response.data['previous'])
+        self.assertEqual([ad['id'] for ad in response.data['results']], expected[:10])
+
+        response = self.client.get('/api/ads/', {'pagination': 'cursor', 'category': 'мебель'})
+        self.assertEqual(response.data['results'], [])
+        self.assertIn('message', response.data)
+
+    def test_my_proposals_cursor_pagination(self):
+        ExchangeProposal.objects.create(ad_sender=self.ad1, ad_receiver=self.ad2, comment="Обмен")
+        self.authenticate(self.user2)
+        response = self.client.get('/api/proposals/my/', {'pagination': 'cursor'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertIsNone(response.data['next'])
+
+        response = self.client.get('/api/proposals/my/', {'cursor': 'мусор'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_tampered_cursor_values_are_not_found(self):
+        # курсор правильной формы, но со значениями не того типа — 404, а не 500 на выборке
+        def cursor(values):
+            return b64encode(json.dumps({'v': values}).encode()).decode()
+
+        moment = '2020-01-01T00:00:00+00:00'
+        for values in ([moment, 'abc'], [1, 2], [moment, 1.5], [moment, True], 'ab'):
+            for url in ('/api/ads/', '/'):
+                response = self.client.get(url, {'cursor': cursor(values)})
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND, (values, url))
+        # страница поиска сайта листает по (rank, created_at, id)
+        response = self.client.get('/', {'q': "Футболка", 'cursor': cursor(['x', moment, 1])})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get('/', {'q': "Футболка", 'cursor': cursor([0.5, moment, 1])})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class QueryBudgetTests(APITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='batman', password='1234')
+        self.user2 = User.objects.create_user(username='genji', password='5678')
+        self.grow(1)
+
+    def grow(self, count):
+        # кэш ответов сбрасывается только после коммита — в TestCase его надо выполнить явно
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_ads(count)
+
+    def create_ads(self, count):
+        for _ in range(count):
+            ad1 = Ad.objects.create(user=self.user1, title="Футболка", description="Черная", category="одежда", condition="used")
+            ad2 = Ad.objects.create(user=self.user2, title="Книга", description="Фантастика", category="книги", condition="new")
+            self.proposal = ExchangeProposal.objects.create(ad_sender=ad1, ad_receiver=ad2, comment="Обмен")
+
+    def assertQueryBudget(self, budget, method, url, user=None, data=None):
+        self.client.force_authenticate(user)
+        with query_budget(budget) as queries:
+            response = getattr(self.client, method)(url, data)
+        self.assertLess(response.status_code, 400)
+        return len(queries)
+
+    def assertStableQueryBudget(self, budget, method, url, user=None):
+        # число запросов не должно зависеть от размера страницы
+        before = self.assertQueryBudget(budget, method, url, user)
+        self.grow(9)
+        after = self.assertQueryBudget(budget, method, url, user)
+        self.assertEqual(before, after)
+
+    def test_ad_list_budget(self):
+        self.assertStableQueryBudget(2, 'get', '/api/ads/')
+        self.assertStableQueryBudget(1, 'get', '/api/ads/?pagination=cursor')
+
+    def test_ad_detail_budget(self):
+        self.assertQueryBudget(1, 'get', f'/api/ads/{self.proposal.ad_sender_id}/')
+
+    def test_proposal_list_budget(self):
+        self.assertStableQueryBudget(2, 'get', '/api/proposals/')
+
+    def test_proposal_detail_budget(self):
+        self.assertQueryBudget(1, 'get', f'/api/proposals/{self.proposal.id}/')
+
+    def test_my_proposals_budget(self):
+        self.assertStableQueryBudget(2, 'get', '/api/proposals/my/', self.user1)
+
+    def test_accept_decline_budget(self):
+        declined = self.proposal
+        self.grow(1)
+        # get_object, блокировка предложения, смена статуса, события SSE, счётчики фасетов
+        # (вставка новых значений + приращение), сброс циклов + savepoint
+        self.assertQueryBudget(9, 'post', f'/api/proposals/{declined.id}/decline/', self.user2)
+        # get_object, блокировка объявлений, блокировка предложения вместе с конкурентами, принятие,
+        # отклонение конкурентов, события SSE, сброс циклов, счётчики фасетов + savepoint
+        self.assertQueryBudget(11, 'post', f'/api/proposals/{self.proposal.id}/accept/', self.user2)
+
+    def test_proposal_update_budget(self):
+        self.assertQueryBudget(
+            2, 'patch', f'/api/proposals/{self.proposal.id}/', self.user1, {'comment': "Новый комментарий"}
+        )
+
+    def test_html_my_proposals_budget(self):
+        self.client.force_login(self.user1)
+        with query_budget(3) as before:
+            self.client.get('/my-proposals/')
+        self.grow(9)
+        with query_budget(3) as after:
+            response = self.client.get('/my-proposals/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(before), len(after))
+
+    def test_html_ad_list_budget(self):
+        # одна выборка страницы без COUNT(*), сколько бы объявлений ни было
+        with query_budget(1) as before:
+            self.client.get('/')
+        self.grow(30)
+        with query_budget(1) as after:
+            response = self.client.get('/')
+        self.assertEqual(len(response.context['ads']), 24)
+        self.assertEqual(len(before), len(after))
+
+    def test_html_ad_detail_budget(self):
+        with query_budget(1):
+            response = self.client.get(f'/ad/{self.proposal.ad_sender_id}/')
+        self.assertContains(response, 'batman')
+
+
+@override_settings(ADS_HTML_PAGE_SIZE=5)
+class HtmlAdListTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='batman', password='1234')
+        self.ads = [
+            Ad.objects.create(user=self.user, title=f"Книга {i}", description="Описание", category="книги", condition="new")
+            for i in range(12)
+        ]
+
+    def walk(self, params):
+        # первая страница, затем пачки через партиал, как при прокрутке
+        response = self.client.get('/', params)
+        seen = [ad.id for ad in response.context['ads']]
+        next_query = response.context['next_query']
+        while next_query:
+            response = self.client.get(f'/ads/cards/?{next_query}')
+            self.assertNotContains(response, '<nav')
+            seen += [ad.id for ad in response.context['ads']]
+            next_query = response.context['next_query']
+        return seen
+
+    def test_scroll_through_pages(self):
+        self.assertEqual(self.walk({}), [ad.id for ad in reversed(self.ads)])
+        self.assertEqual(sorted(self.walk({'q': 'книга'})), sorted(ad.id for ad in self.ads))
+        self.assertEqual(self.client.get('/', {'cursor': 'мусор'}).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_card_fragment_follows_ad_version(self):
+        self.client.force_login(self.user)
+        self.assertContains(self.client.get('/'), "Книга 11")
+        Ad.objects.filter(pk=self.ads[11].pk).update(title="Тайно")
+        # версия та же — карточка из кэша фрагментов
+        self.assertContains(self.client.get('/'), "Книга 11")
+        ad = Ad.objects.get(pk=self.ads[11].pk)
+        ad.title = "Журнал"
+        ad.save()
+        self.assertContains(self.client.get('/'), "Журнал")
+
+
+class SearchSuggestTests(APITestCase):
+    def setUp(self):
+        title_index.invalidate()
+        self.user = User.objects.create_user(username='batman', password='1234')
+        for title in ["Детский велосипед", "детский  велосипед", "Детский велосипед", "Детская куртка", "Велосипед горный"]:
+            self.make_ad(title)
+
+    def make_ad(self, title):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Ad.objects.create(user=self.user, title=title, description="Описание", category="спорт", condition="used")
+
+    def warm_up(self):
+        # индекс строится вне запроса (на сервере — фоновым потоком); в тесте синхронно, в его транзакции
+        title_index.refresh()
+
+    def suggest(self, q):
+        with query_budget(0):
+            response = self.client.get('/api/ads/autocomplete/', {'q': q})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [(item['title'], item['count']) for item in response.data['results']]
+
+    def test_prefix_of_any_word_weighted_by_popularity(self):
+        self.warm_up()
+        self.assertEqual(self.suggest('дет'), [("Детский велосипед", 3), ("Детская куртка", 1)])
+        self.assertEqual(self.suggest('ВЕЛО'), [("Детский велосипед", 3), ("Велосипед горный", 1)])
+        self.assertEqual(self.suggest('самокат'), [])
+
+    @override_settings(ADS_AUTOCOMPLETE_REFRESH_SECONDS=3600)
+    def test_index_follows_changes(self):
+        self.warm_up()
+        scooter = self.make_ad("Самокат")
+        self.assertEqual(self.suggest('сам'), [("Самокат", 1)])
+        with self.captureOnCommitCallbacks(execute=True):
+            scooter.title = "Детский самокат"
+            scooter.save()
+        self.assertEqual(self.suggest('сам'), [("Детский самокат", 1)])
+        with self.captureOnCommitCallbacks(execute=True):
+            scooter.delete()
+        self.assertEqual(self.suggest('сам'), [])
+
+        # bulk_create минует сигналы: такие строки догружаются по updated_at
+        Ad.objects.bulk_create([Ad(user=self.user, title="Санки", description="Описание", category="спорт", condition="used")])
+        self.assertEqual(self.suggest('сан'), [])
+        title_index.refresh()
+        self.assertEqual(self.suggest('сан'), [("Санки", 1)])
+
+    def test_requests_never_build_the_index(self):
+        # холодный или устаревший индекс: запрос только будит фоновое обновление и отвечает тем, что есть
+        with patch.object(title_index, 'warm') as warm:
+            self.assertEqual(self.suggest('дет'), [])
+            warm.assert_called_once()
+            self.warm_up()
+            self.assertEqual(self.suggest('д'), [("Детский велосипед", 3), ("Детская куртка", 1)])
+            warm.assert_called_once()
+            with override_settings(ADS_AUTOCOMPLETE_REFRESH_SECONDS=0):
+                self.assertEqual(self.suggest('д'), [("Детский велосипед", 3), ("Детская куртка", 1)])
+            self.assertEqual(warm.call_count, 2)
+
+    def test_typo_falls_back_to_trigrams(self):
+        if not has_trigram(connection.alias):
+            self.skipTest('pg_trgm недоступен на этом сервере')
+        response = self.client.get('/api/ads/', {'search': 'велосепед'})
+        self.assertEqual(response.data['count'], 4)
+
+
+class ArchiveTests(APITestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='batman', password='1234')
+        self.sender = User.objects.create_user(username='genji', password='5678')
+        wanted = Ad.objects.create(user=self.owner, title="Книга", description="Фантастика", category="книги", condition="new")
+        self.proposals = {}
+        for name, status_ in [('old_accepted', 'accepted'), ('old_declined', 'declined'), ('old_declined2', 'declined'),
+                              ('old_pending', 'pending'), ('recent', 'declined')]:
+            ad = Ad.objects.create(user=self.sender, title=name, description="Описание", category="разное", condition="used")
+            proposal = ExchangeProposal.objects.create(ad_sender=ad, ad_receiver=wanted, comment=name, status=status_)
+            self.proposals[name] = proposal
+        ExchangeProposal.objects.filter(comment__startswith='old').update(updated_at=timezone.now() - timedelta(days=200))
+
+    def test_moves_resolved_in_batches_and_serves_on_request(self):
+        out = StringIO()
+        call_command('archive_proposals', '--batch-size', '2', stdout=out)
+        self.assertIn('В архиве 3 (accepted: 1, declined: 2) за 2 партий', out.getvalue())
+
+        archived = {p.id for name, p in self.proposals.items() if name in ('old_accepted', 'old_declined', 'old_declined2')}
+        self.assertEqual(set(ArchivedProposal.objects.values_list('id', flat=True)), archived)
+        self.assertFalse(ExchangeProposal.objects.filter(pk__in=archived).exists())
+        self.assertFalse(ProposalParticipant.objects.filter(proposal_id__in=archived).exists())
+        self.assertEqual(FacetCount.objects.totals(['status']), {'status': {'pending': 1, 'declined': 1}})
+
+        response = self.client.get('/api/proposals/')
+        self.assertEqual({item['id'] for item in response.data['results']},
+                         {self.proposals['old_pending'].id, self.proposals['recent'].id})
+
+        response = self.client.get('/api/proposals/', {'archived': 1, 'status': 'declined'})
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(response.data['results'][0]['status_display'], 'отклонен')
+        accepted = self.proposals['old_accepted']
+        response = self.client.get(f'/api/proposals/{accepted.id}/', {'archived': 1})
+        self.assertEqual((response.data['comment'], response.data['ad_sender']['title']), ('old_accepted', 'old_accepted'))
+        self.assertEqual(self.client.get(f'/api/proposals/{accepted.id}/').status_code, status.HTTP_404_NOT_FOUND)
+
+        # повторный запуск ничего не находит
+        out = StringIO()
+        call_command('archive_proposals', stdout=out)
+        self.assertIn('В архиве 0 (нечего)', out.getvalue())
+
+
+class SchemaCacheTests(APITestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(ADS_SCHEMA_CACHE_DIR=directory.name, ADS_SCHEMA_VERSION='v1')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.directory = Path(directory.name)
+        code_version.cache_clear()
+        self.addCleanup(code_version.cache_clear)
+        clear_memory()
+
+    def test_generated_once_per_version_and_served_with_etag(self):
+        response = self.client.get('/api/schema/', HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('/api/proposals/batch/', json.loads(response.content)['paths'])
+        etag = response['ETag']
+        self.assertEqual([path.name.split('-')[1] for path in self.directory.iterdir()], ['v1'])
+
+        response = self.client.get('/api/schema/', HTTP_ACCEPT='application/json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        yaml = self.client.get('/api/schema/')
+        self.assertEqual(yaml['Content-Type'], 'application/vnd.oai.openapi; charset=utf-8')
+        self.assertNotEqual(yaml['ETag'], etag)
+
+        # новый процесс берёт схему из файла; подменённое содержимое показывает, что генерации не было
+        path = next(path for path in self.directory.iterdir() if path.read_bytes().startswith(b'application/json'))
+        path.write_bytes(b'application/json\n{"stale": true}')
+        clear_memory()
+        self.assertEqual(self.client.get('/api/schema/', HTTP_ACCEPT='application/json').json(), {'stale': True})
+
+        # новая версия кода — новая схема, старые файлы чистит generate_schema
+        with override_settings(ADS_SCHEMA_VERSION='v2'):
+            code_version.cache_clear()
+            out = StringIO()
+            call_command('generate_schema', stdout=out)
+            self.assertIn('удалено устаревших файлов: 2', out.getvalue())
+        self.assertEqual({path.name.split('-')[1] for path in self.directory.iterdir()}, {'v2'})
+
+
+    def test_cache_key_ignores_params_that_do_not_change_schema(self):
+        etag = self.client.get('/api/schema/', HTTP_ACCEPT='application/json')['ETag']
+        for params in ({'junk': '1'}, {'other': 'x', 'version': 'v9'}, {'lang': 'xx-yy'}):
+            response = self.client.get('/api/schema/', params, HTTP_ACCEPT='application/json; indent=4')
+            self.assertEqual(response['ETag'], etag)
+        self.assertEqual(len(list(self.directory.iterdir())), 1)
+
+        response = self.client.get('/api/schema/', {'lang': 'ru'}, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(list(self.directory.iterdir())), 2)
+
+
+class CachedJWTAuthenticationTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='batman', password='1234')
+
+    def get_my(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/proposals/my/')
+        return response.status_code, sum(query['sql'].startswith('SELECT "auth_user"') for query in queries)
+
+    def test_user_is_cached_until_changed(self):
+        self.assertEqual(self.get_my(), (status.HTTP_200_OK, 1))
+        self.assertEqual(self.get_my(), (status.HTTP_200_OK, 0))
+
+        self.user.set_password('новый пароль')
+        self.user.save()
+        self.assertEqual(self.get_my(), (status.HTTP_200_OK, 1))
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.get_my()[0], status.HTTP_401_UNAUTHORIZED)
+
+
+class ProposalInboxTests(APITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='batman', password='1234')
+        self.user2 = User.objects.create_user(username='genji', password='5678')
+        self.user3 = User.objects.create_user(username='robin', password='9012')
+        self.ad1 = Ad.objects.create(user=self.user1, title="Футболка", description="Черная", category="одежда", condition="used")
+        self.ad2 = Ad.objects.create(user=self.user2, title="Книга", description="Фантастика", category="книги", condition="new")
+        self.proposal = ExchangeProposal.objects.create(ad_sender=self.ad1, ad_receiver=self.ad2, comment="Обмен")
+
+    def inbox_ids(self, user):
+        self.client.force_authenticate(user)
+        return [proposal['id'] for proposal in self.client.get('/api/proposals/my/').data['results']]
+
+    def test_inbox_contains_sent_and_received(self):
+        self.assertEqual(self.inbox_ids(self.user1), [self.proposal.id])
+        self.assertEqual(self.inbox_ids(self.user2), [self.proposal.id])
+        self.assertEqual(self.inbox_ids(self.user3), [])
+
+    def test_inbox_follows_ad_owner_change(self):
+        self.ad2.user = self.user3
+        self.ad2.save()
+        self.assertEqual(self.inbox_ids(self.user2), [])
+        self.assertEqual(self.inbox_ids(self.user3), [self.proposal.id])
+
+    def test_backfill_migration(self):
+        from importlib import import_module
+        from django.apps import apps
+        migration = import_module('ads.migrations.0008_backfill_proposal_participants')
+
+        ProposalParticipant.objects.all().delete()
+        migration.backfill_participants(apps, None)
+        self.assertEqual(
+            set(ProposalParticipant.objects.values_list('user_id', 'proposal_id')),
+            {(self.user1.id, self.proposal.id), (self.user2.id, self.proposal.id)},
+        )
+
+
+class ResponseCacheTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user1 = User.objects.create_user(username='batman', password='1234')
+        self.ad1 = Ad.objects.create(user=self.user1, title="Футболка", description="Черная", category="одежда", condition="used")
+
+    def test_anonymous_list_is_cached_and_invalidated(self):
+        stats = cache_stats()
+        self.assertEqual(self.client.get('/api/ads/', {'category': "одежда"})['X-Cache'], 'MISS')
+        with query_budget(0):
+            response = self.client.get('/api/ads/', {'category': " одежда ", 'page': '1'})
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response.json()['count'], 1)
+        self.assertEqual(cache_stats()['hits'], stats['hits'] + 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Ad.objects.create(user=self.user1, title="Куртка", description="Зимняя", category="одежда", condition="new")
+        response = self.client.get('/api/ads/', {'category': "одежда"})
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['count'], 2)
+
+    def test_detail_is_invalidated_per_ad(self):
+        other = Ad.objects.create(user=self.user1, title="Книга", description="Фантастика", category="книги", condition="new")
+        self.client.get(f'/ad/{self.ad1.id}/')
+        self.assertEqual(self.client.get(f'/ad/{self.ad1.id}/')['X-Cache'], 'HIT')
+
+        other.title = "Журнал"
+        with self.captureOnCommitCallbacks(execute=True):
+            other.save()
+        self.assertEqual(self.client.get(f'/ad/{self.ad1.id}/')['X-Cache'], 'HIT')
+
+        self.ad1.title = "Майка"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ad1.save()
+        response = self.client.get(f'/ad/{self.ad1.id}/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertContains(response, "Майка")
+
+    @override_settings(ALLOWED_HOSTS=['localhost', '127.0.0.1'])
+    def test_key_includes_scheme_and_host_and_hit_keeps_headers(self):
+        Ad.objects.bulk_create([
+            Ad(user=self.user1, title=f"Вещь {i}", description="Описание", category="разное", condition="used")
+            for i in range(10)
+        ])
+        miss = self.client.get('/api/ads/', HTTP_HOST='localhost')
+        self.assertEqual(miss['X-Cache'], 'MISS')
+        self.assertEqual(miss.json()['next'], 'http://localhost/api/ads/?page=2')
+
+        # ссылки в ответе абсолютные: другой хост или https — другой ключ
+        other = self.client.get('/api/ads/', HTTP_HOST='127.0.0.1', secure=True)
+        self.assertEqual(other['X-Cache'], 'MISS')
+        self.assertEqual(other.json()['next'], 'https://127.0.0.1/api/ads/?page=2')
+
+        hit = self.client.get('/api/ads/', HTTP_HOST='localhost')
+        self.assertEqual(hit['X-Cache'], 'HIT')
+        for header in ('Vary', 'Allow', 'ETag'):
+            self.assertEqual(hit[header], miss[header])
+        self.assertIn('Accept', hit['Vary'])
+
+    def test_authenticated_and_unknown_params_bypass_cache(self):
+        self.client.get('/api/ads/', {'format': 'json'})
+        self.assertNotIn('X-Cache', self.client.get('/api/ads/', {'format': 'json'}))
+
+        self.client.force_login(self.user1)
+        self.client.get('/')
+        self.assertNotIn('X-Cache', self.client.get('/'))
+
+
+class ResponseCacheCommitTests(TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username='batman', password='1234')
+        self.ad = Ad.objects.create(user=user, title="Old", description="Черная", category="одежда", condition="used")
+
+    def get(self, results):
+        try:
+            response = self.client.get(f'/api/ads/{self.ad.pk}/')
+            results.append((response['X-Cache'], response.json()['title']))
+        finally:
+            connections.close_all()
+
+    def test_read_during_uncommitted_write_is_not_cached_under_new_version(self):
+        results = []
+        with transaction.atomic():
+            self.ad.title = "New"
+            self.ad.save()
+            # чтение из другого соединения видит старую строку и кладёт её в кэш
+            thread = threading.Thread(target=self.get, args=(results,))
+            thread.start()
+            thread.join()
+        self.get(results)
+        self.assertEqual(results, [('MISS', "Old"), ('MISS', "New")])
+        self.get(results)
+        self.assertEqual(results[-1], ('HIT', "New"))
+
+
+class ConditionalGetTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user1 = User.objects.create_user(username='batman', password='1234')
+        self.user2 = User.objects.create_user(username='genji', password='5678')
+        self.ad1 = Ad.objects.create(user=self.user1, title="Футболка", description="Черная", category="одежда", condition="used")
+        self.ad2 = Ad.objects.create(user=self.user2, title="Книга", description="Фантастика", category="книги", condition="new")
+        self.proposal = ExchangeProposal.objects.create(ad_sender=self.ad1, ad_receiver=self.ad2, comment="Обмен")
+
+    def assertNotModified(self, url, etag, budget=1, **extra):
+        with query_budget(budget):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, **extra)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+    def test_ad_detail_strong_etag(self):
+        url = f'/api/ads/{self.ad1.id}/'
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        self.assertIn('Last-Modified', response)
+        self.assertNotModified(url, etag, budget=0)
+
+        self.ad1.title = "Майка"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ad1.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_proposal_detail_follows_nested_ad(self):
+        url = f'/api/proposals/{self.proposal.id}/'
+        etag = self.client.get(url)['ETag']
+        self.assertNotModified(url, etag)
+
+        self.ad1.title = "Майка"
+        self.ad1.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_my_proposals_polling(self):
+        self.client.force_authenticate(self.user1)
+        response = self.client.get('/api/proposals/my/')
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        self.assertNotModified('/api/proposals/my/', etag)
+
+        self.proposal.decline()
+        response = self.client.get('/api/proposals/my/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['status'], 'declined')
+
+        # ETag личный: чужой клиент с тем же значением получает полный ответ
+        self.client.force_authenticate(self.user2)
+        self.assertEqual(
+            self.client.get('/api/proposals/my/', HTTP_IF_NONE_MATCH=response['ETag']).status_code,
+            status.HTTP_200_OK,
+        )
+
+    def test_list_etag_changes_on_delete_and_cursor_mode(self):
+        etag = self.client.get('/api/ads/', {'format': 'json'})['ETag']
+        self.assertNotModified('/api/ads/?format=json', etag)
+        Ad.objects.create(user=self.user1, title="Куртка", description="Зимняя", category="одежда", condition="new").delete()
+        self.assertNotModified('/api/ads/?format=json', etag)
+        self.ad2.delete()
+        self.assertEqual(
+            self.client.get('/api/ads/?format=json', HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK
+        )
+
+        url = '/api/ads/?format=json&pagination=cursor'
+        self.assertNotModified(url, self.client.get(url)['ETag'])
+
+    def test_cached_response_and_html_detail(self):
+        etag = self.client.get('/api/ads/')['ETag']
+        self.assertNotModified('/api/ads/', etag, budget=0)
+
+        url = f'/ad/{self.ad1.id}/'
+        response = self.client.get(url)
+        self.assertNotModified(url, response['ETag'], budget=0)
+        self.client.force_login(self.user1)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, status.HTTP_200_OK)
+
+
+class FacetCountTests(APITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='batman', password='1234')
+        self.user2 = User.objects.create_user(username='genji', password='5678')
+        self.ad1 = Ad.objects.create(user=self.user1, title="Футболка", description="Черная", category="одежда", condition="used")
+        self.ad2 = Ad.objects.create(user=self.user2, title="Книга", description="Фантастика", category="книги", condition="new")
+        self.ad3 = Ad.objects.create(user=self.user2, title="Куртка", description="Зимняя", category="одежда", condition="new")
+
+    def assertCountersMatch(self):
+        for model in (Ad, ExchangeProposal):
+            self.assertEqual(FacetCount.objects.totals(model.FACETS), live_counts(model.objects.all(), model.FACETS))
+
+    def test_counters_follow_changes(self):
+        self.assertCountersMatch()
+        self.ad3.category = "верхняя одежда"
+        self.ad3.save()
+        Ad.objects.only('id', 'title').get(pk=self.ad1.pk).save()
+        self.assertCountersMatch()
+
+        accepted = ExchangeProposal.objects.create(ad_sender=self.ad1, ad_receiver=self.ad2, comment="Обмен")
+        ExchangeProposal.objects.create(ad_sender=self.ad1, ad_receiver=self.ad3, comment="Или куртку")
+        declined = ExchangeProposal.objects.create(ad_sender=self.ad3, ad_receiver=self.ad1, comment="Встречное")
+        declined.decline()
+        accepted.accept()
+        self.assertCountersMatch()
+        self.assertEqual(FacetCount.objects.totals(['status'])['status'], {'declined': 2, 'accepted': 1})
+
+        self.ad1.delete()
+        self.assertCountersMatch()
+
+    def test_facets_endpoint(self):
+        with query_budget(1):
+            response = self.client.get('/api/ads/facets/')
+        self.assertEqual(response.data['source'], 'totals')
+        self.assertEqual(response.data['category'], {'одежда': 2, 'книги': 1})
+        self.assertEqual(response.data['condition'], {'new': 2, 'used': 1})
+
+        response = self.client.get('/api/ads/facets/', {'category': "одежда"})
+        self.assertEqual(response.data['source'], 'live')
+        self.assertEqual(response.data['condition'], {'new': 1, 'used': 1})
+        response = self.client.get('/api/ads/facets/', {'search': "куртка"})
+        self.assertEqual(response.data['category'], {'одежда': 1})
+
+        ExchangeProposal.objects.create(ad_sender=self.ad1, ad_receiver=self.ad2, comment="Обмен")
+        self.assertEqual(self.client.get('/api/proposals/facets/').data['status'], {'pending': 1})
+
+    def test_rebuild_repairs_drift(self):
+        FacetCount.objects.filter(value="одежда").update(count=100)
+        FacetCount.objects.filter(value="книги").delete()
+        out = StringIO()
+        call_command('rebuild_facets', stdout=out)
+        self.assertIn('category=одежда: -98', out.getvalue())
+        self.assertCountersMatch()
+
+
+class RowSerializerTests(APITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='batman', password='1234')
+        self.user2 = User.objects.create_user(username='genji', password='5678')
+        ad1 = Ad.objects.create(user=self.user1, title="Футболка", description="Черная", category="одежда", condition="used")
+        ad2 = Ad.objects.create(user=self.user2, title="Книга", description="Фантастика", category="книги", condition="new",
+                                image_url="https://example.com/book.jpg")
+        ExchangeProposal.objects.create(ad_sender=ad1, ad_receiver=ad2, comment="Обмен")
+        ExchangeProposal.objects.create(ad_sender=ad2, ad_receiver=ad1, comment="Встречное").decline()
+
+    def assertSameJSON(self, fast, slow):
+        self.assertEqual(json.loads(JSONRenderer().render(fast)), json.loads(JSONRenderer().render(slow)))
+
+    def test_parity_with_model_serializers(self):
+        for serializer_class, queryset in (
+            (AdSerializer, Ad.objects.select_related('user').order_by('id')),
+            (ExchangeProposalSerializer, ExchangeProposal.objects.with_ads().order_by('id')),
+        ):
+            rows = row_serializer(serializer_class)
+            for zone in ('UTC', 'Europe/Moscow'):
+                with timezone.override(zone):
+                    self.assertSameJSON(
+                        rows.serialize(queryset.values(*rows.columns)), serializer_class(queryset, many=True).data
+                    )
+
+    def test_list_endpoints_use_rows(self):
+        response = self.client.get('/api/ads/', {'format': 'json'})
+        self.assertSameJSON(
+            response.data['results'], AdSerializer(Ad.objects.order_by('-created_at', '-id'), many=True).data
+        )
+
+        self.client.force_authenticate(self.user1)
+        inbox = ProposalParticipant.objects.inbox(self.user1)
+        expected = ExchangeProposalSerializer([participant.proposal for participant in inbox], many=True).data
+        self.assertSameJSON(self.client.get('/api/proposals/my/').data['results'], expected)
+        self.assertSameJSON(self.client.get('/api/proposals/my/', {'pagination': 'cursor'}).data['results'], expected)
+
+
+class BulkImportExportTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='batman', password='1234')
+        self.client.force_authenticate(self.user)
+
+    def test_ndjson_import_reports_bad_rows(self):
+        body = '\n'.join([
+            json.dumps({'title': "Футболка", 'description': "Черная", 'category': "одежда", 'condition': "used"}),
+            '{broken',
+            json.dumps({'title': "Книга", 'description': "Фантастика", 'category': "книги", 'condition': "плохое"}),
+            '',
+            json.dumps({'title': "Кеды", 'description': "41", 'category': "обувь", 'condition': "new"}),
+        ])
+        self.client.get('/api/ads/')
+        with override_settings(ADS_IMPORT_CHUNK_SIZE=2), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/ads/import/', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((response.data['created'], response.data['failed']), (2, 2))
+        self.assertEqual([error['line'] for error in response.data['errors']], [2, 3])
+        self.assertIn('condition', response.data['errors'][1]['errors'])
+
+        self.assertEqual(set(Ad.objects.values_list('title', 'user')), {("Футболка", self.user.id), ("Кеды", self.user.id)})
+        self.assertEqual(FacetCount.objects.totals(['category'])['category'], {'одежда': 1, 'обувь': 1})
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get('/api/ads/').data['count'], 2)
+
+    def test_csv_upload_and_command(self):
+        upload = SimpleUploadedFile('ads.csv', (
+            'title,description,category,condition,image_url\n'
+            'Стул,"Деревянный, со спинкой",дом,used,\n'
+            ',Без названия,дом,used,\n'
+        ).encode())
+        response = self.client.post('/api/ads/import/', {'file': upload}, format='multipart')
+        self.assertEqual((response.data['created'], response.data['failed']), (1, 1))
+        self.assertEqual(response.data['errors'][0]['line'], 3)
+        self.assertEqual(Ad.objects.get().description, "Деревянный, со спинкой")
+
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson', encoding='utf-8') as source:
+            source.write(json.dumps({'title': "Стол", 'description': "Обеденный", 'category': "дом", 'condition': "new"}))
+            source.flush()
+            out = StringIO()
+            call_command('import_ads', source.name, user='batman', stdout=out)
+        self.assertIn('Создано: 1', out.getvalue())
+
+    def test_streaming_export(self):
+        Ad.objects.create(user=self.user, title="Футболка", description="Черная", category="одежда", condition="used")
+        Ad.objects.create(user=self.user, title="Книга", description="Фантастика", category="книги", condition="new")
+
+        response = self.client.get('/api/ads/export/', {'category': "одежда"})
+        self.assertTrue(response.streaming)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertSameRows(rows, AdSerializer(Ad.objects.filter(category="одежда"), many=True).data)
+
+        response = self.client.get('/api/ads/export/', {'type': 'csv'})
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        images = ','.join(f'image.{size}.{fmt}' for size in ('small', 'medium', 'large') for fmt in ('webp', 'jpeg'))
+        self.assertEqual(lines[0], f'id,title,description,image_url,image.original,{images},category,condition,'
+                                   'created_at,user.id,user.username')
+        self.assertEqual(len(lines), 3)
+
+    def assertSameRows(self, rows, expected):
+        self.assertEqual(rows, json.loads(JSONRenderer().render(expected)))
+
+
+class SparseFieldsTests(APITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='batman', password='1234')
+        self.user2 = User.objects.create_user(username='genji', password='5678')
+        self.ad1 = Ad.objects.create(user=self.user1, title="Футболка", description="Черная", category="одежда", condition="used")
+        self.ad2 = Ad.objects.create(user=self.user2, title="Книга", description="Фантастика", category="книги", condition="new")
+        self.proposal = ExchangeProposal.objects.create(ad_sender=self.ad1, ad_receiver=self.ad2, comment="Обмен")
+
+    def get(self, url, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, ' '.join(query['sql'] for query in queries.captured_queries)
+
+    def test_fields_prune_payload_and_joins(self):
+        response, sql = self.get('/api/proposals/', fields='id,status,ad_sender.title')
+        self.assertEqual(response.json()['results'], [
+            {'id': self.proposal.id, 'status': 'pending', 'ad_sender': {'title': "Футболка"}},
+        ])
+        self.assertNotIn('auth_user', sql)
+        self.assertNotIn('"comment"', sql)
+
+        response, sql = self.get(f'/api/proposals/{self.proposal.id}/', fields='id,comment')
+        self.assertEqual(response.json(), {'id': self.proposal.id, 'comment': "Обмен"})
+        self.assertNotIn('ads_ad', sql)
+
+        response, sql = self.get('/api/ads/', fields='title,user.username', format='json')
+        self.assertEqual(response.json()['results'][0], {'title': "Книга", 'user': {'username': 'genji'}})
+
+    def test_expand_ad_receiver(self):
+        response, _ = self.get('/api/proposals/', expand='ad_receiver')
+        proposal = response.json()['results'][0]
+        self.assertEqual(proposal['ad_receiver']['title'], "Книга")
+        self.assertEqual(proposal['ad_receiver']['user']['username'], 'genji')
+        self.assertIn('ad_sender', proposal)
+
+        response, _ = self.get(f'/api/proposals/{self.proposal.id}/', fields='id,ad_receiver.title')
+        self.assertEqual(response.json(), {'id': self.proposal.id, 'ad_receiver': {'title': "Книга"}})
+        full, _ = self.get(f'/api/proposals/{self.proposal.id}/')
+        self.assertNotEqual(response['ETag'], full['ETag'])
+        self.assertNotIn('ad_receiver', full.json())
+
+        # правка раскрытого объявления получателя меняет ETag
+        self.ad2.title = "Журнал"
+        self.ad2.save()
+        changed, _ = self.get(f'/api/proposals/{self.proposal.id}/', fields='id,ad_receiver.title')
+        self.assertNotEqual(changed['ETag'], response['ETag'])
+
+    def test_fields_do_not_affect_writes(self):
+        self.client.force_authenticate(self.user1)
+        response = self.client.post('/api/proposals/?fields=id', {
+            'ad_sender_id': self.ad1.id, 'ad_receiver_id': self.ad2.id, 'comment': "Ещё раз",
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['comment'], "Ещё раз")
+
+
+class ProposalBatchTests(APITestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='batman', password='1234')
+        self.sender = User.objects.create_user(username='genji', password='5678')
+        self.wanted = self.make_ad(self.owner)
+        self.offers = [self.make_ad(self.sender) for _ in range(3)]
+        self.proposals = [self.propose(ad, self.wanted) for ad in self.offers]
+        self.client.force_authenticate(self.owner)
+
+    def make_ad(self, user):
+        return Ad.objects.create(user=user, title="Вещь", description="Описание", category="разное", condition="used")
+
+    def propose(self, sender, receiver):
+        return ExchangeProposal.objects.create(ad_sender=sender, ad_receiver=receiver, comment="Обмен")
+
+    def batch(self, actions=(), create=()):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/proposals/batch/', {'actions': actions, 'create': create}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_actions_report_per_item(self):
+        first, second, third = self.proposals
+        foreign = self.propose(self.wanted, self.offers[0])
+        data = self.batch([
+            {'id': second.id, 'action': 'decline'},
+            {'id': first.id, 'action': 'accept'},
+            # уже отклонено принятием first: конкурирует за то же объявление
+            {'id': third.id, 'action': 'decline'},
+            {'id': first.id, 'action': 'decline'},
+            {'id': foreign.id, 'action': 'accept'},
+            {'id': 10 ** 9, 'action': 'accept'},
+        ])
+        self.assertEqual(
+            [item.get('status') or item['error'] for item in data['actions']],
+            ['declined', 'accepted', 'conflict', 'conflict', 'forbidden', 'not_found'],
+        )
+        self.assertEqual(
+            list(ExchangeProposal.objects.filter(pk__in=[first.id, second.id, third.id]).order_by('pk')
+                 .values_list('status', flat=True)),
+            ['accepted', 'declined', 'declined'],
+        )
+        # foreign тоже про wanted: отклонён принятием first, хотя принять его самому нельзя
+        self.assertEqual(ExchangeProposal.objects.get(pk=foreign.id).status, 'declined')
+        self.assertEqual(FacetCount.objects.totals(['status']), {'status': {'declined': 3, 'accepted': 1}})
+
+    def test_query_count_does_not_grow_with_batch(self):
+        def run(size):
+            senders = [self.make_ad(self.sender) for _ in range(size)]
+            pending = [self.propose(ad, self.make_ad(self.owner)) for ad in senders]
+            actions = [{'id': proposal.id, 'action': ('accept', 'decline')[i % 2]} for i, proposal in enumerate(pending)]
+            create = [{'ad_sender_id': ad.id, 'ad_receiver_id': self.wanted.id, 'comment': "Ещё"} for ad in senders]
+            self.client.force_authenticate(self.owner)
+            with CaptureQueriesContext(connection) as queries:
+                data = self.batch(actions)
+            self.client.force_authenticate(self.sender)
+            with CaptureQueriesContext(connection) as created:
+                self.batch(create=create)
+            self.assertTrue(all('status' in item for item in data['actions']))
+            return len(queries), len(created)
+
+        self.assertEqual(run(2), run(20))
+
+    def test_create_validates_and_finds_cycles(self):
+        self.client.force_authenticate(self.sender)
+        back = self.propose(self.wanted, self.offers[1])
+        third_party = User.objects.create_user(username='mercy', password='1234')
+        other = self.make_ad(third_party)
+        data = self.batch(create=[
+            {'ad_sender_id': self.offers[1].id, 'ad_receiver_id': other.id, 'comment': "Обмен"},
+            {'ad_sender_id': self.wanted.id, 'ad_receiver_id': other.id, 'comment': "Чужое"},
+            {'ad_sender_id': self.offers[1].id, 'ad_receiver_id': 10 ** 9, 'comment': "Нет такого"},
+            {'ad_sender_id': self.offers[1].id},
+        ])
+        results = data['create']
+        self.assertEqual([sorted(item.get('errors', {})) for item in results],
+                         [[], ['ad_sender_id'], ['ad_receiver_id'], ['ad_receiver_id', 'comment']])
+        created = ExchangeProposal.objects.get(pk=results[0]['id'])
+        self.assertEqual(
+            set(created.participants.values_list('user_id', flat=True)), {self.sender.id, third_party.id}
+        )
+        run_pending()
+        self.assertFalse(TradeCycle.objects.exists())
+
+        # замыкаем цикл other → wanted → offers[1] → other
+        self.client.force_authenticate(third_party)
+        data = self.batch(create=[{'ad_sender_id': other.id, 'ad_receiver_id': self.wanted.id, 'comment': "Круг"}])
+        self.assertEqual(run_pending(), (1, 0))
+        self.assertEqual(TradeCycle.objects.get().proposals, [back.id, created.id, data['create'][0]['id']])
+        self.assertEqual(FacetCount.objects.totals(['status']), {'status': {'pending': 6}})
+
+
+class ConcurrentAcceptTests(TransactionTestCase):
+    def test_only_one_competing_accept_wins(self):
+        owner = User.objects.create_user(username='genji', password='5678')
+        wanted = Ad.objects.create(user=owner, title="Книга", description="Фантастика", category="книги", condition="new")
+        proposals = []
+        for i in range(8):
+            sender = User.objects.create_user(username=f'sender{i}', password='1234')
+            ad = Ad.objects.create(user=sender, title=f"Вещь {i}", description="Описание", category="разное", condition="used")
+            proposals.append(ExchangeProposal.objects.create(ad_sender=ad, ad_receiver=wanted, comment="Обмен"))
+
+        barrier = threading.Barrier(len(proposals))
+        statuses = []
+
+        def accept(proposal):
+            client = APIClient()
+            client.force_authenticate(owner)
+            try:
+                barrier.wait()
+                statuses.append(client.post(f'/api/proposals/{proposal.id}/accept/').status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=accept, args=(proposal,)) for proposal in proposals]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(statuses), [200] + [409] * (len(proposals) - 1))
+        self.assertEqual(ExchangeProposal.objects.filter(status='accepted').count(), 1)
+        self.assertEqual(ExchangeProposal.objects.filter(status='declined').count(), len(proposals) - 1)
+        self.assertEqual(FacetCount.objects.totals(['status'])['status'], {'declined': len(proposals) - 1, 'accepted': 1})
+
+
+class ReplicaRoutingTests(TransactionTestCase):
+    # replica в тестах — зеркало default, поэтому проверяем, через какое соединение шли запросы
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='batman', password='1234')
+        self.ad = Ad.objects.create(user=self.user, title="Книга", description="Фантастика", category="книги", condition="new")
+        self.client = APIClient()
+
+    def request(self, method, url, data=None):
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = getattr(self.client, method)(url, data, format='json')
+        return response, len(primary), len(replica)
+
+    def test_reads_go_to_replica_until_client_writes(self):
+        # с токеном ответы не кэшируются, и чтения идут на реплику
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        response, primary, replica = self.request('get', '/api/ads/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((primary, bool(replica)), (0, True))
+        self.assertNotIn('ads_primary', response.cookies)
+
+        response, primary, replica = self.request('patch', f'/api/ads/{self.ad.id}/', {'title': "Другая книга"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((bool(primary), replica), (True, 0))
+        self.assertEqual(response.cookies['ads_primary']['max-age'], 10)
+
+        # cookie закрепляет клиента за primary: он сразу видит свою правку
+        response, primary, replica = self.request('get', f'/api/ads/{self.ad.id}/')
+        self.assertEqual(response.data['title'], "Другая книга")
+        self.assertEqual((bool(primary), replica), (True, 0))
+
+    def test_response_cache_is_filled_from_primary(self):
+        cache.clear()
+        # промах анонимного кэша читает с primary, попадание не ходит в БД, некэшируемый GET — на реплику
+        response, primary, replica = self.request('get', '/api/ads/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual((bool(primary), replica), (True, 0))
+        self.assertNotIn('ads_primary', response.cookies)
+        response, primary, replica = self.request('get', '/api/ads/')
+        self.assertEqual((response['X-Cache'], primary, replica), ('HIT', 0, 0))
+        response, primary, replica = self.request('get', '/api/ads/?format=json')
+        self.assertEqual((primary, bool(replica)), (0, True))
+
+    def test_transactions_and_locks_stay_on_primary(self):
+        router = PrimaryReplicaRouter()
+        state, token = enter_request(pinned=False)
+        try:
+            self.assertEqual(router.db_for_read(Ad), 'replica')
+            with transaction.atomic():
+                self.assertEqual(router.db_for_read(Ad), 'default')
+            self.assertFalse(state.wrote)
+            # блокировка — намерение писать: она и всё после неё идут на primary
+            self.assertEqual(Ad.objects.select_for_update().db, 'default')
+            self.assertEqual(router.db_for_read(Ad), 'default')
+        finally:
+            exit_request(token)
+        # вне HTTP-запроса (команды, shell) чтения идут на primary
+        self.assertEqual(router.db_for_read(Ad), 'default')
+
+
+class TradeCycleTests(APITestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f'user{i}', password='1234') for i in range(3)]
+        self.ads = [
+            Ad.objects.create(user=user, title=f"Вещь {i}", description="Описание", category="разное", condition="used")
+            for i, user in enumerate(self.users)
+        ]
+
+    def propose(self, sender, receiver):
+        proposal = ExchangeProposal.objects.create(ad_sender=self.ads[sender], ad_receiver=self.ads[receiver], comment="Обмен")
+        # циклы ищет фоновая задача
+        run_pending()
+        return proposal
+
+    def test_cycle_is_found_incrementally_and_listed(self):
+        first = self.propose(0, 1)
+        self.propose(1, 2)
+        self.assertFalse(TradeCycle.objects.exists())
+        last = self.propose(2, 0)
+
+        cycle = TradeCycle.objects.get()
+        self.assertEqual(cycle.ads, [ad.id for ad in self.ads])
+        self.assertEqual(cycle.proposals[0], first.id)
+        self.assertEqual(cycle.proposals[2], last.id)
+
+        self.client.force_authenticate(self.users[1])
+        response = self.client.get('/api/proposals/cycles/')
+        self.assertEqual([item['id'] for item in response.data['results']], [cycle.id])
+
+        self.client.force_authenticate(self.users[0])
+        self.client.post(f'/api/proposals/{last.id}/accept/')
+        self.assertFalse(TradeCycle.objects.exists())
+
+    def test_rebuild_matches_incremental(self):
+        self.propose(0, 1)
+        self.propose(1, 2)
+        self.propose(2, 0)
+        incremental = list(TradeCycle.objects.values_list('key', flat=True))
+        rebuild_cycles()
+        self.assertEqual(list(TradeCycle.objects.values_list('key', flat=True)), incremental)
+
+    def test_incremental_search_finds_every_new_cycle(self):
+        rnd = random.Random(7)
+        graph = ProposalGraph()
+        found = set()
+        for proposal_id in range(400):
+            sender, receiver = rnd.randrange(60), rnd.randrange(60)
+            graph.add(proposal_id, sender, receiver)
+            found.update(tuple(ads) for ads, _ in graph.cycles_through(sender, receiver, 4))
+        self.assertEqual(found, {tuple(ads) for ads, _ in graph.all_cycles(4)})
+
+
+class SyntheticDataTests(APITestCase):
+    def test_generate_data(self):
+        call_command('generate_data', users=5, ads=40, proposals=30, batch_size=7, prefix='gen_', stdout=StringIO())
+
+        self.assertEqual(User.objects.filter(username__startswith='gen_').count(), 5)
+        self.assertEqual(Ad.objects.count(), 40)
+        self.assertEqual(ExchangeProposal.objects.count(), 30)
+        self.assertFalse(ExchangeProposal.objects.filter(ad_sender__user=F('ad_receiver__user')).exists())
+        self.assertEqual(ProposalParticipant.objects.values('proposal').distinct().count(), 30)
+        self.assertEqual(ProposalParticipant.objects.count(), 60)
+
+
+class PerformanceMiddlewareTests(APITestCase):
+    def setUp(self):
+        registry.reset()
+        self.user = User.objects.create_user(username='batman', password='1234')
+        Ad.objects.create(user=self.user, title="Футболка", description="Черная", category="одежда", condition="used")
+
+    def test_server_timing_and_metrics(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get('/api/proposals/my/')
+        self.assertRegex(response['Server-Timing'], r'app;dur=[\d.]+, db;dur=[\d.]+;desc="1 queries"')
+
+        response = self.client.get('/metrics', REMOTE_ADDR='127.0.0.1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = response.content.decode()
+        self.assertIn('barter_request_duration_seconds_count{route="proposal-my-proposals",method="GET"} 1', body)
+        self.assertIn('barter_request_queries_total{route="proposal-my-proposals",method="GET"} 1', body)
+
+        response = self.client.get('/metrics', REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    @override_settings(PERFORMANCE_SLOW_REQUEST_MS=0, PERFORMANCE_SLOW_QUERY_MS=0)
+    def test_slow_requests_are_logged(self):
+        with self.assertLogs('ads.performance', level='WARNING') as logs:
+            self.client.get('/api/ads/', {'category': "одежда"})
+        self.assertTrue(any('Медленный запрос GET /api/ads/' in line for line in logs.output))
+        self.assertTrue(any('SELECT' in line for line in logs.output))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class AsyncReadPathTests(APITestCase):
+    # AsyncClient идёт через ASGI-хендлер, то есть через ADS_ASGI_URLCONF
+    def setUp(self):
+        self.user = User.objects.create_user(username='batman', password='1234')
+        self.other = User.objects.create_user(username='joker', password='1234')
+        self.ads = [
+            Ad.objects.create(user=self.user, title=f"Книга {i}", description="Описание", category="книги", condition="new")
+            for i in range(12)
+        ]
+        other_ad = Ad.objects.create(user=self.other, title="Шляпа", description="Фетр", category="одежда", condition="used")
+        ExchangeProposal.objects.create(ad_sender=other_ad, ad_receiver=self.ads[0], comment="Меняю")
+        self.auth = {'Authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+
+    async def test_async_views_answer_like_sync(self):
+        pk = self.ads[0].pk
+        requests = [
+            ('/api/ads/', {}), ('/api/ads/?page=2', {}), ('/api/ads/?pagination=cursor', {}),
+            (f'/api/ads/{pk}/?fields=id,title', {}), ('/api/ads/0/', {}),
+            ('/api/proposals/my/', self.auth), ('/api/proposals/my/', {}),
+            ('/', {}), (f'/ad/{pk}/', {}),
+        ]
+        expected = [await sync_to_async(self.client.get)(path, headers=headers) for path, headers in requests]
+
+        # синхронные обработчики под ASGI вызываться не должны
+        with patch.object(AdViewSet, 'list', side_effect=AssertionError), \
+                patch.object(AdViewSet, 'retrieve', side_effect=AssertionError), \
+                patch.object(ExchangeProposalViewSet, 'my_proposals', side_effect=AssertionError), \
+                patch.object(AdListView, 'get', side_effect=AssertionError), \
+                patch.object(AdDetailView, 'get', side_effect=AssertionError):
+            for (path, headers), sync_response in zip(requests, expected):
+                response = await self.async_client.get(path, headers=headers)
+                self.assertEqual(
+                    (response.status_code, response.content, response.get('ETag')),
+                    (sync_response.status_code, sync_response.content, sync_response.get('ETag')),
+                    path,
+                )
+            response = await self.async_client.get('/api/proposals/my/', headers={**self.auth, 'If-None-Match': expected[5]['ETag']})
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    async def test_other_requests_fall_back_to_sync_views(self):
+        response = await self.async_client.post('/api/ads/', {
+            'title': "Лампа", 'description': "Настольная", 'category': "дом", 'condition': "used",
+        }, headers=self.auth)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = await self.async_client.get('/api/ads/', {'search': 'лампа'})
+        self.assertEqual([ad['title'] for ad in response.json()['results']], ["Лампа"])
+
+
+class ProposalStreamTests(TransactionTestCase):
+    # события уходят подписчикам после коммита, а стрим читает БД из своего потока — нужны настоящие транзакции
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        self.sender = User.objects.create_user(username='batman', password='1234')
+        self.receiver = User.objects.create_user(username='genji', password='5678')
+        self.ad1 = Ad.objects.create(user=self.sender, title="Футболка", description="Черная", category="одежда", condition="used")
+        self.ad2 = Ad.objects.create(user=self.receiver, title="Книга", description="Фантастика", category="книги", condition="new")
+        self.app = ProposalStreamApp(get_asgi_application())
+
+    def open(self, user=None, last_event_id=None):
+        headers = [(b'host', b'testserver')]
+        if user is not None:
+            headers.append((b'authorization', f'Bearer {AccessToken.for_user(user)}'.encode()))
+        if last_event_id is not None:
+            headers.append((b'last-event-id', str(last_event_id).encode()))
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': '/api/proposals/stream/', 'raw_path': b'/api/proposals/stream/', 'query_string': b'',
+            'root_path': '', 'headers': headers, 'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+        }
+        messages, disconnected = asyncio.Queue(), asyncio.Event()
+
+        async def receive():
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        task = asyncio.ensure_future(self.app(scope, receive, messages.put))
+        return messages, disconnected, task
+
+    async def read(self, messages):
+        message = await asyncio.wait_for(messages.get(), 5)
+        return message.get('body', message.get('status'))
+
+    async def test_events_are_pushed_and_resumed(self):
+        messages, disconnected, task = self.open(self.receiver)
+        self.assertEqual(await self.read(messages), 200)
+        self.assertEqual(await self.read(messages), b'retry: 5000\n\n')
+
+        proposal = await ExchangeProposal.objects.acreate(ad_sender=self.ad1, ad_receiver=self.ad2, comment="Обмен")
+        created = await self.read(messages)
+        self.assertIn(b'event: proposal.created\n', created)
+        self.assertIn(f'"id": {proposal.pk}, "status": "pending"'.encode(), created)
+
+        client = APIClient()
+        client.force_authenticate(self.receiver)
+        response = await sync_to_async(client.post)(f'/api/proposals/{proposal.pk}/accept/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        accepted = await self.read(messages)
+        self.assertIn(b'event: proposal.accepted\n', accepted)
+        disconnected.set()
+        await asyncio.wait_for(task, 5)
+        self.assertEqual(broker.count(), 0)
+
+        # переподключение с Last-Event-ID отдаёт пропущенное
+        created_id = created.split(b'\n')[0].removeprefix(b'id: ').decode()
+        messages, disconnected, task = self.open(self.receiver, created_id)
+        self.assertEqual(await self.read(messages), 200)
+        self.assertEqual(await self.read(messages), f'retry: 5000\nid: {created_id}\n\n'.encode())
+        self.assertEqual(await self.read(messages), accepted)
+        disconnected.set()
+        await asyncio.wait_for(task, 5)
+
+    async def test_event_committed_out_of_id_order_is_delivered(self):
+        slow = await ExchangeProposal.objects.acreate(ad_sender=self.ad1, ad_receiver=self.ad2, comment="Долгая")
+        fast = await ExchangeProposal.objects.acreate(ad_sender=self.ad1, ad_receiver=self.ad2, comment="Быстрая")
+        messages, disconnected, task = self.open(self.receiver)
+        self.assertEqual(await self.read(messages), 200)
+        await self.read(messages)
+
+        inserted, release = threading.Event(), threading.Event()
+
+        def slow_transaction():
+            # событие получает меньший id, но коммитится позже
+            try:
+                with transaction.atomic():
+                    ProposalEvent.objects.record([slow.pk])
+                    inserted.set()
+                    release.wait(5)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=slow_transaction)
+        thread.start()
+        await sync_to_async(inserted.wait)(5)
+        await outside_request(ProposalEvent.objects.record)([fast.pk])
+        first = await self.read(messages)
+        self.assertIn(f'"id": {fast.pk}'.encode(), first)
+        release.set()
+        await sync_to_async(thread.join)()
+        second = await self.read(messages)
+        self.assertIn(f'"id": {slow.pk}'.encode(), second)
+        disconnected.set()
+        await asyncio.wait_for(task, 5)
+
+        # клиент, видевший только быстрое событие, при докачке получает и запоздавшее
+        fast_id = int(first.split(b'\n')[0].removeprefix(b'id: '))
+        slow_id = int(second.split(b'\n')[0].removeprefix(b'id: '))
+        self.assertLess(slow_id, fast_id)
+        messages, disconnected, task = self.open(self.receiver, fast_id)
+        self.assertEqual(await self.read(messages), 200)
+        await self.read(messages)
+        # окно докачки отдаёт повторно и более ранние события — они снимки статуса, повтор безвреден
+        backlog = await self.read(messages)
+        self.assertIn(second, backlog)
+        self.assertNotIn(f'id: {fast_id}\n'.encode(), backlog)
+        disconnected.set()
+        await asyncio.wait_for(task, 5)
+
+    @override_settings(ADS_EVENTS_NOTIFY=True)
+    async def test_events_arrive_through_notify(self):
+        messages, disconnected, task = self.open(self.sender)
+        try:
+            self.assertEqual(await self.read(messages), 200)
+            await self.read(messages)
+            # с NOTIFY запись не публикует в брокер сама: событие приходит через LISTEN
+            await ExchangeProposal.objects.acreate(ad_sender=self.ad1, ad_receiver=self.ad2, comment="Обмен")
+            self.assertIn(b'event: proposal.created\n', await self.read(messages))
+            self.assertIsNotNone(listener.connection)
+            disconnected.set()
+            await asyncio.wait_for(task, 5)
+        finally:
+            listener.close()
+
+    async def test_anonymous_stream_is_rejected(self):
+        messages, disconnected, task = self.open()
+        self.assertEqual(await self.read(messages), 401)
+        self.assertIn(b'credentials', await self.read(messages))
+        await asyncio.wait_for(task, 5)
+        self.assertEqual(broker.count(), 0)
+
+    def test_sync_stream_returns_backlog(self):
+        first = ExchangeProposal.objects.create(ad_sender=self.ad1, ad_receiver=self.ad2, comment="Обмен")
+        second = ExchangeProposal.objects.create(ad_sender=self.ad1, ad_receiver=self.ad2, comment="Ещё")
+        self.client.force_login(self.receiver)
+        response = self.client.get('/api/proposals/stream/', HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        latest = ProposalEvent.objects.filter(user=self.receiver).latest('pk').pk
+        self.assertEqual(response.content, f'retry: 5000\nid: {latest}\n\n'.encode())
+
+        first_id = ProposalEvent.objects.get(user=self.receiver, proposal_id=first.pk).pk
+        response = self.client.get('/api/proposals/stream/', HTTP_LAST_EVENT_ID=str(first_id))
+        self.assertEqual(response.content.count(b'event: proposal.created'), 1)
+        self.assertIn(f'"id": {second.pk}'.encode(), response.content)
+
+        self.client.logout()
+        response = self.client.get('/api/proposals/stream/', HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class JobQueueTests(APITestCase):
+    def setUp(self):
+        self.calls = []
+        patcher = patch.dict(HANDLERS)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        @handler('flaky')
+        def flaky(value, failures):
+            self.calls.append(value)
+            if len(self.calls) <= failures:
+                raise RuntimeError(f'сбой {len(self.calls)}')
+
+    def test_enqueue_follows_transaction(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            enqueue('flaky', value=1, failures=0)
+            raise RuntimeError
+        self.assertFalse(Job.objects.exists())
+        with self.assertRaises(ValueError):
+            enqueue('missing')
+
+        user = User.objects.create_user(username='batman', password='1234')
+        other = User.objects.create_user(username='genji', password='5678')
+        ad1 = Ad.objects.create(user=user, title="Футболка", description="Черная", category="одежда", condition="used")
+        ad2 = Ad.objects.create(user=other, title="Книга", description="Фантастика", category="книги", condition="new")
+        proposal = ExchangeProposal.objects.create(ad_sender=ad1, ad_receiver=ad2, comment="Обмен")
+        self.assertEqual(list(Job.objects.values_list('name', 'payload')),
+                         [('discover_cycles', {'proposal_ids': [proposal.pk]})])
+        self.assertEqual(run_pending(), (1, 0))
+        self.assertFalse(Job.objects.exists())
+
+    def test_failed_job_backs_off_and_gives_up(self):
+        job = enqueue('flaky', value=7, failures=2)
+        self.assertEqual(run_pending(), (0, 1))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.locked_by), ('queued', 1, ''))
+        self.assertIn('сбой 1', job.last_error)
+        self.assertAlmostEqual((job.run_at - timezone.now()).total_seconds(), 10, delta=2)
+        # пока пауза не вышла, задачу никто не берёт
+        self.assertEqual(run_pending(), (0, 0))
+
+        Job.objects.update(run_at=timezone.now())
+        self.assertEqual(run_pending(), (0, 1))
+        job.refresh_from_db()
+        self.assertAlmostEqual((job.run_at - timezone.now()).total_seconds(), 20, delta=2)
+
+        with override_settings(ADS_JOBS_MAX_ATTEMPTS=3):
+            Job.objects.update(run_at=timezone.now())
+            self.assertEqual(run_pending(), (1, 0))
+            self.assertEqual(self.calls, [7, 7, 7])
+            self.assertFalse(Job.objects.exists())
+
+            enqueue('flaky', value=8, failures=10)
+            for _ in range(3):
+                Job.objects.update(run_at=timezone.now())
+                run_pending()
+        self.assertEqual(Job.objects.get().status, 'failed')
+
+    def test_abandoned_job_is_requeued(self):
+        enqueue('flaky', value=1, failures=0)
+        self.assertEqual(len(Job.objects.claim(10, 'crashed')), 1)
+        self.assertEqual(Job.objects.requeue_stale(60, 5), 0)
+        Job.objects.update(locked_at=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(Job.objects.requeue_stale(60, 5), 1)
+        self.assertEqual(run_pending(), (1, 0))
+
+
+class JobWorkerTests(TransactionTestCase):
+    def setUp(self):
+        self.calls = []
+        patcher = patch.dict(HANDLERS)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        handler('record')(lambda value: self.calls.append(value))
+
+    def test_concurrent_claims_never_overlap(self):
+        for value in range(60):
+            enqueue('record', value=value)
+        barrier = threading.Barrier(4)
+        claimed = []
+
+        def claim(worker):
+            try:
+                barrier.wait()
+                while jobs := Job.objects.claim(3, worker):
+                    claimed.extend(pk for pk, *_ in jobs)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=claim, args=(f'worker{i}',)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(claimed), list(Job.objects.order_by('pk').values_list('pk', flat=True)))
+
+    def test_worker_drains_queue(self):
+        for value in range(20):
+            enqueue('record', value=value)
+        out = StringIO()
+        call_command('run_jobs', '--once', '--concurrency', '4', stdout=out)
+        self.assertEqual(sorted(self.calls), list(range(20)))
+        self.assertFalse(Job.objects.exists())
+        self.assertIn('Выполнено задач: 20, упало: 0', out.getvalue())
+
+    def test_worker_survives_failed_bookkeeping(self):
+        @handler('boom')
+        def boom():
+            raise ValueError('сломалось')
+
+        def update(queryset, **kwargs):
+            # итог упавшей задачи в БД не записывается
+            if 'last_error' in kwargs:
+                raise DatabaseError('соединение потеряно')
+            return original(queryset, **kwargs)
+
+        original = QuerySet.update
+        failing = enqueue('boom')
+        for value in range(5):
+            enqueue('record', value=value)
+        out, err = StringIO(), StringIO()
+        with patch.object(QuerySet, 'update', update):
+            call_command('run_jobs', '--once', '--concurrency', '2', stdout=out, stderr=err)
+        self.assertEqual(sorted(self.calls), list(range(5)))
+        self.assertIn('Выполнено задач: 5, упало: 1', out.getvalue())
+        self.assertIn('соединение потеряно', err.getvalue())
+        # строка осталась захваченной — её вернёт requeue_stale
+        self.assertEqual(list(Job.objects.values_list('pk', 'status')), [(failing.pk, 'running')])
+
+
+def photo(size=(1600, 1200), color=(200, 80, 40, 255)):
+    output = BytesIO()
+    Image.new('RGBA', size, color).save(output, 'PNG')
+    return SimpleUploadedFile('photo.png', output.getvalue(), content_type='image/png')
+
+
+class AdImageTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create_user(username='batman', password='1234')
+        self.client.force_authenticate(self.user)
+
+    def create(self, upload, title="Велосипед"):
+        return self.client.post('/api/ads/', {
+            'title': title, 'description': "Горный", 'category': "спорт", 'condition': "used", 'upload': upload,
+        }, format='multipart')
+
+    def test_upload_then_thumbnails_by_job(self):
+        response = self.create(photo())
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        ad = Ad.objects.get()
+        self.assertEqual(response.data['image'], AdImage.urls(ad.image_id, False))
+        self.assertIsNone(response.data['image']['small'])
+        self.assertNotIn('upload', response.data)
+        self.assertTrue(default_storage.exists(original_path(ad.image_id)))
+        self.assertEqual((ad.image.width, ad.image.height), (1600, 1200))
+
+        self.assertEqual(run_pending(), (1, 0))
+        ad.refresh_from_db()
+        self.assertTrue(ad.image_ready and ad.image.ready)
+        image = self.client.get(f'/api/ads/{ad.pk}/').data['image']
+        self.assertEqual(image['small']['webp'], default_storage.url(thumbnail_path(ad.image_id, 'small', 'webp')))
+        for size, box in (('small', 320), ('medium', 640), ('large', 1280)):
+            for fmt in ('webp', 'jpeg'):
+                with default_storage.open(thumbnail_path(ad.image_id, size, fmt)) as thumbnail:
+                    self.assertEqual(Image.open(thumbnail).size, (box, box * 3 // 4))
+
+        # повтор задачи (доставка «хотя бы один раз») ничего не ломает и не плодит файлов
+        generate_thumbnails(ad.image_id)
+        self.assertEqual(len(default_storage.listdir(Path(thumbnail_path(ad.image_id, 'small', 'webp')).parent)[1]), 6)
+
+        self.client.force_authenticate(None)
+        rows = self.client.get('/api/ads/', {'format': 'json'}).data['results']
+        self.assertEqual(json.loads(JSONRenderer().render(rows)),
+                         json.loads(JSONRenderer().render(AdSerializer(Ad.objects.all(), many=True).data)))
+        html = self.client.get(reverse('ad_list')).content.decode()
+        self.assertIn('<picture>', html)
+        self.assertIn(image['small']['webp'], html)
+        self.assertNotIn(image['original'], html)
+
+    def test_same_bytes_stored_once(self):
+        self.create(photo())
+        run_pending()
+        # второе объявление с тем же фото — из формы сайта: файл не пишется заново, превью уже готовы
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('ad_create'), {
+            'title': "Велосипед", 'description': "Тот же", 'category': "спорт", 'condition': "used", 'upload': photo(),
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(AdImage.objects.count(), 1)
+        self.assertEqual(set(Ad.objects.values_list('image_ready', flat=True)), {True})
+        self.assertFalse(Job.objects.exists())
+
+        self.create(photo(color=(10, 120, 200, 128)))
+        self.assertEqual(AdImage.objects.count(), 2)
+
+    def test_rejects_non_images(self):
+        response = self.create(SimpleUploadedFile('photo.png', b'not an image', content_type='image/png'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('upload', response.data)
+        with override_settings(ADS_IMAGE_MAX_BYTES=100):
+            self.assertEqual(self.create(photo()).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Ad.objects.exists())
@@ -0,0 +1,50 @@
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+# формат превью -> (формат Pillow, расширение, параметры сохранения сверх quality)
+FORMATS = {
+    'webp': ('WEBP', 'webp', {'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'optimize': True, 'progressive': True}),
+}
+
+
+def to_rgb(image):
+    # прозрачность — на белый фон: у JPEG альфа-канала нет, а WebP без него заметно меньше
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def render_thumbnails(data, sizes, quality):
+    """Байты оригинала -> {(имя размера, формат): байты превью}; sizes — {имя: сторона рамки в пикселях}.
+
+    Без Django: вызывается и в воркере задач, и в пуле процессов бенчмарка. Крупные превью считаются первыми,
+    каждое следующее уменьшается из предыдущего, а не из оригинала. Больше оригинала превью не бывает.
+    """
+    boxes = sorted(sizes.items(), key=lambda item: -item[1])
+    with Image.open(BytesIO(data)) as image:
+        # JPEG декодируется сразу в уменьшенном масштабе (1/2…1/8) — на больших фото это основная экономия
+        image.draft('RGB', (boxes[0][1], boxes[0][1]))
+        image = to_rgb(ImageOps.exif_transpose(image))
+    thumbnails = {}
+    for name, box in boxes:
+        image.thumbnail((box, box), Image.Resampling.LANCZOS)
+        for fmt, (pil_format, _, options) in FORMATS.items():
+            output = BytesIO()
+            image.save(output, pil_format, quality=quality, **options)
+            thumbnails[name, fmt] = output.getvalue()
+    return thumbnails
+
+
+def original_path(name):
+    # раскладка по первым символам хеша, чтобы каталоги не разрастались
+    return f'ads/images/{name[:2]}/{name}'
+
+
+def thumbnail_path(name, size, fmt):
+    digest = name.rsplit('.', 1)[0]
+    return f'ads/thumbs/{digest[:2]}/{digest}-{size}.{FORMATS[fmt][1]}'
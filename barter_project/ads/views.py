@@ -1,30 +1,53 @@
+import csv
+from operator import attrgetter
+
 from django.contrib import messages
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from django.db.models.functions import Lower
-from django.http import HttpResponseForbidden
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseForbidden, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse_lazy
 from django.views import View
 from django.views.decorators.http import require_POST
 from django.views.generic import ListView, CreateView, DetailView, UpdateView, DeleteView
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.parsers import MultiPartParser
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAuthenticated
 from rest_framework import filters
 from rest_framework import status
 from django.contrib.auth.models import User
+from django.db import transaction
 from django_filters.rest_framework import DjangoFilterBackend
-from django.db import models
-from django.db.models import Q
 
-from .serializer import AdSerializer, UserSerializer, ExchangeProposalSerializer
-from .models import Ad, ExchangeProposal
+from .archive import ArchiveMixin
+from .asynchronous import AsyncGetMixin, AsyncViewSetMixin
+from .authentication import CachedJWTAuthentication
+from .autocomplete import title_index
+from .batch import change_statuses, create_proposals
+from .bulk import MEDIA_TYPES, detect_type, export_ads, import_ads, read_rows
+from .cache import AnonymousResponseCacheMixin
+from .conditional import ConditionalGetMixin, make_etag, not_modified, set_validators
+from .events import format_event, parse_event_id
+from .facets import FacetsMixin
+from .fieldsets import SparseFieldsMixin
+from .serializer import (
+    AdSerializer, UserSerializer, ExchangeProposalSerializer, ProposalBatchSerializer, TradeCycleSerializer,
+)
+from .models import Ad, ExchangeProposal, ProposalParticipant, TradeCycle
 from .permissions import IsOwnerOrReadOnly, IsSenderOrReadOnly
-from .forms import ExchangeProposalForm
+from .forms import AdForm, ExchangeProposalForm
+from .metrics import registry
+from .pagination import HybridPagination, decode_cursor, encode_cursor, get_keyset_values, keyset_filter
+from .search import AdSearchFilter
+from .stream import EventStreamRenderer, missed_events, preamble
 
 
 class UserViewSet(ReadOnlyModelViewSet):
@@ -32,106 +55,259 @@ class UserViewSet(ReadOnlyModelViewSet):
     serializer_class = UserSerializer
 
 
-class AdViewSet(ModelViewSet):
-    queryset = Ad.objects.all()
+class AdViewSet(SparseFieldsMixin, ConditionalGetMixin, FacetsMixin, AnonymousResponseCacheMixin, AsyncViewSetMixin,
+                ModelViewSet):
+    queryset = Ad.objects.select_related('user').order_by('-created_at', '-id')
     serializer_class = AdSerializer
     permission_classes = [IsAuthenticatedOrReadOnly, IsOwnerOrReadOnly]
+    pagination_class = HybridPagination
 
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter]
+    filter_backends = [DjangoFilterBackend, AdSearchFilter]
     filterset_fields = ['category', 'condition']
-    search_fields = ['title', 'description']
+    facet_fields = Ad.FACETS
+    list_from_values = True
+    cache_query_params = ('search', 'category', 'condition', 'page', 'pagination', 'cursor', 'fields', 'expand')
+    # поиск может досчитывать совпадения для триграммного фолбэка — он остаётся синхронным
+    async_actions = {
+        'list': ('category', 'condition', 'page', 'pagination', 'cursor', 'fields', 'expand'),
+        'retrieve': ('fields', 'expand'),
+    }
 
     def list(self, request, *args, **kwargs):
-        response = super().list(request, *args, **kwargs)
-        if response.data['count'] == 0:
+        return self.with_empty_message(super().list(request, *args, **kwargs))
+
+    async def alist(self, request, *args, **kwargs):
+        return self.with_empty_message(await super().alist(request, *args, **kwargs))
+
+    def with_empty_message(self, response):
+        if response.status_code == status.HTTP_200_OK and not response.data['results']:
             response.data['message'] = 'По вашему запросы ничего не найдено ('
         return response
 
+    @action(detail=False, methods=['get'], pagination_class=None)
+    def autocomplete(self, request):
+        # индекс в памяти процесса, в БД идём только за изменениями раз в несколько секунд
+        try:
+            limit = min(int(request.query_params.get('limit', settings.ADS_AUTOCOMPLETE_LIMIT)), 50)
+        except ValueError:
+            limit = settings.ADS_AUTOCOMPLETE_LIMIT
+        return Response({'results': title_index.suggest(request.query_params.get('q', ''), max(limit, 1))})
+
+    @action(detail=False, methods=['post'], url_path='import', parser_classes=[MultiPartParser],
+            permission_classes=[IsAuthenticated])
+    def bulk_import(self, request):
+        # файл в multipart (поле file) или сырое тело application/x-ndjson / text/csv
+        upload = request.FILES.get('file') if request.content_type.startswith('multipart/') else None
+        kind = detect_type(request.query_params.get('type'), request.content_type, upload.name if upload else '')
+        if kind is None:
+            return Response({'detail': 'Укажите type=ndjson или type=csv'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            report = import_ads(request.user, read_rows(upload or request.stream or (), kind),
+                                settings.ADS_IMPORT_CHUNK_SIZE)
+        except (UnicodeDecodeError, csv.Error) as error:
+            return Response({'detail': f'Файл не разобран: {error}'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(report, status=status.HTTP_201_CREATED if report['created'] else status.HTTP_400_BAD_REQUEST)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        kind = request.query_params.get('type', 'ndjson')
+        if kind not in MEDIA_TYPES:
+            return Response({'detail': 'Укажите type=ndjson или type=csv'}, status=status.HTTP_400_BAD_REQUEST)
+        queryset = self.filter_queryset(self.get_queryset())
+        response = StreamingHttpResponse(
+            export_ads(queryset, kind, settings.ADS_EXPORT_CHUNK_SIZE),
+            content_type=f'{MEDIA_TYPES[kind]}; charset=utf-8',
+        )
+        response['Content-Disposition'] = f'attachment; filename="ads.{kind}"'
+        return response
 
-class ExchangeProposalViewSet(ModelViewSet):
-    queryset = ExchangeProposal.objects.all()
+
+class ExchangeProposalViewSet(SparseFieldsMixin, ConditionalGetMixin, FacetsMixin, ArchiveMixin, AsyncViewSetMixin,
+                              ModelViewSet):
+    queryset = ExchangeProposal.objects.with_ads()
     serializer_class = ExchangeProposalSerializer
     permission_classes = [IsAuthenticatedOrReadOnly, IsSenderOrReadOnly]
+    pagination_class = HybridPagination
 
     filter_backends = [DjangoFilterBackend, filters.SearchFilter]
     filterset_fields = ['status', 'ad_sender', 'ad_receiver']
+    facet_fields = ExchangeProposal.FACETS
+    list_from_values = True
     search_fields = ['comment']
+    async_actions = {'my_proposals': ('page', 'pagination', 'cursor', 'fields', 'expand')}
 
     def get_permissions(self):
-        if self.action in ['accept', 'decline', 'my_proposals']:
+        if self.action in ['accept', 'decline', 'my_proposals', 'cycles', 'batch', 'stream']:
             return [IsAuthenticated()]
         return super().get_permissions()
 
+    @property
+    def keyset_ordering(self):
+        if self.action == 'my_proposals':
+            return ('-created_at', '-proposal_id')
+        return ('-created_at', '-id')
+
     @action(detail=False, methods=['get'], url_path='my')
     def my_proposals(self, request):
-        user = request.user
-        user_ads = Ad.objects.filter(user=user)
-        proposals = ExchangeProposal.objects.filter(models.Q(ad_sender__in=user_ads) |
-                                                    models.Q(ad_receiver__in=user_ads)).distinct()
-
-        page = self.paginate_queryset(proposals)
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-        serializer = self.get_serializer(proposals, many=True)
-        return Response(serializer.data)
+        inbox = ProposalParticipant.objects.inbox(request.user)
+        return self.conditional_list(request, inbox, prefix='proposal__', unwrap=attrgetter('proposal'))
+
+    async def amy_proposals(self, request):
+        inbox = ProposalParticipant.objects.inbox(request.user)
+        return await self.aconditional_list(request, inbox, prefix='proposal__', unwrap=attrgetter('proposal'))
+
+    @action(detail=False, methods=['get'], renderer_classes=[JSONRenderer, EventStreamRenderer],
+            authentication_classes=[CachedJWTAuthentication, SessionAuthentication])
+    def stream(self, request):
+        # под ASGI запрос перехватывает ProposalStreamApp и держит поток открытым; здесь, без свободного
+        # потока на каждого клиента, отдаём пропущенное и закрываем, а переподключение — через retry
+        last_id = (parse_event_id(request.headers.get('Last-Event-ID'))
+                   or parse_event_id(request.query_params.get('last_event_id')))
+        events, last_id = missed_events(request.user.pk, last_id)
+        body = preamble(last_id) + b''.join(map(format_event, events))
+        return HttpResponse(body, content_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    @action(detail=False, methods=['get'], serializer_class=TradeCycleSerializer)
+    def cycles(self, request):
+        user_ads = list(Ad.objects.filter(user=request.user).values_list('id', flat=True))
+        cycles = TradeCycle.objects.filter(ads__overlap=user_ads).order_by('-created_at', '-id')
+        max_length = request.query_params.get('max_length')
+        if max_length and max_length.isdigit():
+            cycles = cycles.filter(length__lte=int(max_length))
+
+        page = self.paginate_queryset(cycles)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
     @action(detail=True, methods=['post'])
     def accept(self, request, pk=None):
         proposal = self.get_object()
-        if proposal.ad_receiver.user != request.user:
+        if proposal.ad_receiver.user_id != request.user.id:
             return Response({'detail': 'Вы не можете принят это предложение'}, status=status.HTTP_403_FORBIDDEN)
 
-        proposal.status = 'accepted'
-        proposal.save()
+        if not proposal.accept():
+            return Response({'detail': 'Предложение уже обработано'}, status=status.HTTP_409_CONFLICT)
         return Response({'status': 'accepted'}, status=status.HTTP_200_OK)
 
     @action(detail=True, methods=['post'])
     def decline(self, request, pk=None):
         proposal = self.get_object()
-        if proposal.ad_receiver.user != request.user:
+        if proposal.ad_receiver.user_id != request.user.id:
             return Response({'detail': 'Вы не можете отклонить это предложение'}, status=status.HTTP_403_FORBIDDEN)
 
-        proposal.status = 'declined'
-        proposal.save()
+        if not proposal.decline():
+            return Response({'detail': 'Предложение уже обработано'}, status=status.HTTP_409_CONFLICT)
         return Response({'status': 'declined'}, status=status.HTTP_200_OK)
 
-
-class AdListView(ListView):
+    @action(detail=False, methods=['post'], serializer_class=ProposalBatchSerializer)
+    def batch(self, request):
+        # {"actions": [{"id", "action"}], "create": [{...}]} — всё в одной транзакции,
+        # ошибки отдельных элементов возвращаются в их результатах, а не кодом ответа
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            actions = change_statuses(request.user, serializer.validated_data.get('actions', []))
+            created = create_proposals(request.user, serializer.validated_data.get('create', []))
+        return Response({'actions': actions, 'create': created}, status=status.HTTP_200_OK)
+
+
+class AdListView(AnonymousResponseCacheMixin, AsyncGetMixin, ListView):
+    # страницы по курсору (created_at, id) — или (rank, created_at, id) при поиске — без COUNT и OFFSET:
+    # первая страница стоит одинаково при любом размере каталога
     model = Ad
     template_name = 'ads/ad_list.html'
     context_object_name = 'ads'
+    search_param = 'q'
+    cursor_param = 'cursor'
+    cache_query_params = ('q', 'cursor')
+    cache_content_types = ('text/html',)
+    async_query_params = ('cursor', 'mine')
+    card_fields = ('id', 'title', 'description', 'category', 'condition', 'image', 'image_ready', 'created_at',
+                   'updated_at')
 
     def get_queryset(self):
-        queryset = Ad.objects.all().order_by('-created_at')
-        q = self.request.GET.get('q')
+        queryset = Ad.objects.only(*self.card_fields).order_by('-created_at', '-id')
         mine = self.request.GET.get('mine')
 
-        if q:
-            queryset = queryset.annotate(
-                title_lower=Lower('title'),
-                description_lower=Lower('description')
-
-            ).filter(
-                Q(title_lower__icontains=q.lower()) |
-                Q(description_lower__icontains=q.lower())
-            )
+        queryset = AdSearchFilter().filter_queryset(self.request, queryset, self)
 
         if mine == '1' and self.request.user.is_authenticated:
             queryset = queryset.filter(user=self.request.user)
 
         return queryset
 
-
-class AdDetailView(DetailView):
-    model = Ad
+    @property
+    def keyset_ordering(self):
+        return self.object_list.query.order_by
+
+    async def aget(self, request, *args, **kwargs):
+        self.object_list = self.get_queryset()
+        ads = [ad async for ad in self.get_page_queryset()]
+        return self.render_to_response(self.get_context_data(ads=ads))
+
+    def get_page_queryset(self):
+        queryset = self.object_list
+        cursor = self.request.GET.get(self.cursor_param)
+        if cursor:
+            try:
+                values, _ = decode_cursor(cursor, self.keyset_ordering)
+            except NotFound:
+                raise Http404('Некорректный курсор')
+            queryset = queryset.filter(keyset_filter(self.keyset_ordering, values))
+        return queryset[:settings.ADS_HTML_PAGE_SIZE + 1]
+
+    def get_context_data(self, ads=None, **kwargs):
+        ordering, size = self.keyset_ordering, settings.ADS_HTML_PAGE_SIZE
+        if ads is None:
+            ads = list(self.get_page_queryset())
+        next_query = None
+        if len(ads) > size:
+            ads = ads[:size]
+            next_query = self.request.GET.copy()
+            next_query[self.cursor_param] = encode_cursor(get_keyset_values(ads[-1], ordering))
+            next_query = next_query.urlencode()
+        return super().get_context_data(
+            object_list=ads, next_query=next_query, card_cache_timeout=settings.ADS_CARD_CACHE_TIMEOUT, **kwargs
+        )
+
+
+class AdCardsView(AdListView):
+    # следующая пачка карточек для бесконечной прокрутки — тот же список без обвязки страницы
+    template_name = 'ads/ad_cards.html'
+
+
+class AdDetailView(AnonymousResponseCacheMixin, AsyncGetMixin, DetailView):
+    queryset = Ad.objects.select_related('user').order_by('-created_at', '-id')
+    cache_content_types = ('text/html',)
     template_name = 'ads/ad_detail.html'
     context_object_name = 'ad'
 
+    def get(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        return self.detail_response(request)
+
+    async def aget(self, request, *args, **kwargs):
+        try:
+            self.object = await self.get_queryset().aget(pk=self.kwargs[self.pk_url_kwarg])
+        except Ad.DoesNotExist:
+            raise Http404(f'No {Ad._meta.verbose_name} found matching the query')
+        return self.detail_response(request)
+
+    def detail_response(self, request):
+        # страница зависит от пользователя (кнопки владельца), а флеш-сообщение нельзя потерять за 304
+        etag = make_etag(self.object.pk, self.object.updated_at, request.user.pk)
+        if not messages.get_messages(request):
+            response = not_modified(request, etag, self.object.updated_at)
+            if response is not None:
+                return response
+        response = self.render_to_response(self.get_context_data(object=self.object))
+        return set_validators(response, etag, self.object.updated_at)
+
 
 class AdCreateView(LoginRequiredMixin, CreateView):
     model = Ad
-    fields = ['title', 'description', 'image_url', 'category', 'condition']
+    form_class = AdForm
     template_name = 'ads/ad_form.html'
     success_url = reverse_lazy('ad_list')
 
@@ -142,13 +318,13 @@ class AdCreateView(LoginRequiredMixin, CreateView):
 
 class AdUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
     model = Ad
-    fields = ['title', 'description', 'image_url', 'category', 'condition']
+    form_class = AdForm
     template_name = 'ads/ad_form.html'
     success_url = reverse_lazy('ad_list')
 
     def test_func(self):
         ad = self.get_object()
-        return self.request.user == ad.user
+        return self.request.user.id == ad.user_id
 
 
 class AdDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
@@ -158,7 +334,7 @@ class AdDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
 
     def test_func(self):
         ad = self.get_object()
-        return self.request.user == ad.user
+        return self.request.user.id == ad.user_id
 
 
 class CreateExchangeProposalView(LoginRequiredMixin, View):
@@ -166,7 +342,7 @@ class CreateExchangeProposalView(LoginRequiredMixin, View):
         ad_receiver = get_object_or_404(Ad, id=ad_id)
 
         # нельзя предложить обмен на своё же объявление
-        if ad_receiver.user == request.user:
+        if ad_receiver.user_id == request.user.id:
             messages.error(request, "Нельзя предложить обмен на своё объявление.")
             return redirect('ad_detail', pk=ad_id)
 
@@ -189,10 +365,7 @@ class CreateExchangeProposalView(LoginRequiredMixin, View):
 
 class MyExchangeProposalsView(View):
     def get(self, request):
-        user_ads = Ad.objects.filter(user=request.user)
-        proposals = ExchangeProposal.objects.filter(
-            Q(ad_sender__in=user_ads) | Q(ad_receiver__in=user_ads)
-        ).order_by('-created_at')
+        proposals = [participant.proposal for participant in ProposalParticipant.objects.inbox(request.user)]
 
         return render(request, 'ads/my_proposals.html', {
             'proposals': proposals
@@ -202,22 +375,22 @@ class MyExchangeProposalsView(View):
 @require_POST
 @login_required
 def accept_proposal(request, pk):
-    proposal = get_object_or_404(ExchangeProposal, pk=pk)
-    if proposal.ad_receiver.user != request.user:
+    proposal = get_object_or_404(ExchangeProposal.objects.select_related('ad_receiver'), pk=pk)
+    if proposal.ad_receiver.user_id != request.user.id:
         return HttpResponseForbidden()
-    proposal.status = 'accepted'
-    proposal.save()
+    if not proposal.accept():
+        messages.error(request, "Предложение уже обработано.")
     return redirect('my_proposals')
 
 
 @require_POST
 @login_required
 def decline_proposal(request, pk):
-    proposal = get_object_or_404(ExchangeProposal, pk=pk)
-    if proposal.ad_receiver.user != request.user:
+    proposal = get_object_or_404(ExchangeProposal.objects.select_related('ad_receiver'), pk=pk)
+    if proposal.ad_receiver.user_id != request.user.id:
         return HttpResponseForbidden()
-    proposal.status = 'declined'
-    proposal.save()
+    if not proposal.decline():
+        messages.error(request, "Предложение уже обработано.")
     return redirect('my_proposals')
 
 
@@ -231,3 +404,9 @@ def register(request):
     else:
         form = UserCreationForm()
     return render(request, 'ads/login.html', {'form': form})
+
+
+def metrics(request):
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
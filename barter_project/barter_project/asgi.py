@@ -13,4 +13,13 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'barter_project.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# SSE-поток предложений обслуживается в обход Django, чтобы открытое соединение не держало поток
+from ads.autocomplete import title_index  # noqa: E402
+from ads.stream import ProposalStreamApp  # noqa: E402
+
+application = ProposalStreamApp(django_application)
+
+# индекс подсказок строится в фоне сразу при старте, а не первым запросом
+title_index.warm()
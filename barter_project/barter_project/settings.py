@@ -39,6 +39,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 
     'rest_framework',
     'rest_framework.authtoken',
@@ -50,6 +51,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'ads.middleware.PerformanceMiddleware',
+    'ads.middleware.PrimaryReplicaMiddleware',
+    'ads.middleware.AsyncUrlconfMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -78,6 +82,9 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'barter_project.wsgi.application'
 
+# Маршруты, которые под ASGI обслуживаются асинхронными view раньше ROOT_URLCONF; None — как под WSGI
+ADS_ASGI_URLCONF = 'ads.async_urls'
+
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
@@ -90,10 +97,107 @@ DATABASES = {
         'PASSWORD': '1234',
         'HOST': 'localhost',
         'PORT': '5432',
-    }
+    },
+    # реплика только для чтения; локально — отдельная база на том же сервере:
+    # createdb -U postgres -T barterdb barterdb_replica и 'NAME': 'barterdb_replica'
+    # (копия на момент создания, сама за primary не догоняет)
+    'replica': {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': 'barterdb',
+        'USER': 'postgres',
+        'PASSWORD': '1234',
+        'HOST': 'localhost',
+        'PORT': '5432',
+        'TEST': {'MIRROR': 'default'},
+    },
 }
 
+DATABASE_ROUTERS = ['ads.routers.PrimaryReplicaRouter']
+
+# Алиасы реплик для чтения; пустой список — всё идёт на default
+ADS_READ_REPLICAS = ['replica']
+# Сколько секунд после записи клиент читает с primary
+ADS_REPLICA_PIN_SECONDS = 10
+
+# Кэш ответов для анонимных пользователей; в проде достаточно поменять BACKEND
+# (например, на django.core.cache.backends.redis.RedisCache)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
 
+ADS_RESPONSE_CACHE_TIMEOUT = 300
+
+# Поиск: меньше стольких точных совпадений — ищем по триграммам (если есть pg_trgm); 0 — выключено
+ADS_SEARCH_FALLBACK_BELOW = 3
+
+# Автодополнение названий: подсказок по умолчанию и не чаще какого интервала (с) догружать изменения из БД
+ADS_AUTOCOMPLETE_LIMIT = 10
+ADS_AUTOCOMPLETE_REFRESH_SECONDS = 5
+
+# HTML-список объявлений: карточек на странице и время жизни закэшированной карточки
+ADS_HTML_PAGE_SIZE = 24
+ADS_CARD_CACHE_TIMEOUT = 3600
+
+# Порог логирования медленных HTTP- и SQL-запросов (логгер ads.performance)
+PERFORMANCE_SLOW_REQUEST_MS = 500
+PERFORMANCE_SLOW_QUERY_MS = 100
+
+# Кому отдавать /metrics (Prometheus)
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+# Максимальная длина цикла обмена (A→B→C→A — длина 3)
+ADS_CYCLE_MAX_LENGTH = 4
+
+# Массовый импорт/экспорт объявлений: строк на bulk_create и на выборку курсора
+ADS_IMPORT_CHUNK_SIZE = 1000
+ADS_EXPORT_CHUNK_SIZE = 2000
+
+# Архив решённых предложений: старше скольких дней (по времени решения) и строк на транзакцию
+ADS_ARCHIVE_AFTER_DAYS = 180
+ADS_ARCHIVE_BATCH_SIZE = 1000
+
+# OpenAPI-схема: версия кода, под которой она кэшируется (None — хеш исходников), и каталог для файлов
+ADS_SCHEMA_VERSION = None
+ADS_SCHEMA_CACHE_DIR = BASE_DIR / '.schema_cache'
+
+# Сколько секунд пользователь JWT-запроса живёт в кэше без похода в БД
+ADS_AUTH_CACHE_TTL = 60
+
+# Пакетные операции с предложениями: элементов в одном запросе
+ADS_BATCH_MAX_SIZE = 500
+
+# SSE-поток событий по предложениям: NOTIFY доставляет события между процессами (иначе — только внутри
+# процесса, где они записаны), пинг простаивающих соединений, интервал переподключения клиента
+ADS_EVENTS_NOTIFY = False
+ADS_EVENTS_HEARTBEAT_SECONDS = 15
+ADS_EVENTS_RETRY_MS = 5000
+# Очередь подписчика: переполнивший её клиент дочитывает из БД; сколько событий отдаёт синхронный путь
+ADS_EVENTS_QUEUE_SIZE = 100
+ADS_EVENTS_BACKLOG_LIMIT = 1000
+# Транзакции коммитятся не в порядке id: при докачке перечитываются события за столько секунд до Last-Event-ID,
+# а открытый стрим помнит столько последних отданных id, чтобы не слать их повторно
+ADS_EVENTS_RESUME_WINDOW_SECONDS = 60
+ADS_EVENTS_DEDUP_SIZE = 1000
+# Сколько дней хранятся события для докачки по Last-Event-ID
+ADS_EVENTS_RETENTION_DAYS = 7
+
+# Фоновые задачи (manage.py run_jobs): воркеров по умолчанию, как часто опрашивать очередь, сколько попыток
+# и пауза перед повтором (удваивается с каждой попыткой до максимума)
+ADS_JOBS_CONCURRENCY = 4
+ADS_JOBS_POLL_SECONDS = 1
+ADS_JOBS_MAX_ATTEMPTS = 5
+ADS_JOBS_BACKOFF_SECONDS = 10
+ADS_JOBS_BACKOFF_MAX_SECONDS = 3600
+# Задача, которая выполняется дольше, считается брошенной упавшим воркером и возвращается в очередь
+ADS_JOBS_LEASE_SECONDS = 600
+
+# Фото объявлений: предел размера загрузки; превью (сторона рамки в пикселях) в WebP и JPEG
+# строятся задачей make_thumbnails — для неё воркер лучше запускать с --pool process
+ADS_IMAGE_MAX_BYTES = 10 * 1024 * 1024
+ADS_THUMBNAIL_SIZES = {'small': 320, 'medium': 640, 'large': 1280}
+ADS_THUMBNAIL_QUALITY = 80
 
 
 # Password validation
@@ -132,6 +236,10 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Загруженные фото объявлений; в DEBUG их отдаёт сам Django, в проде — веб-сервер из MEDIA_ROOT
+MEDIA_URL = '/media/'
+MEDIA_ROOT = BASE_DIR / 'media'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -142,7 +250,7 @@ REST_FRAMEWORK = {
         'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10,
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'ads.authentication.CachedJWTAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticatedOrReadOnly',
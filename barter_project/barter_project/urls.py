@@ -1,6 +1,11 @@
+from django.conf import settings
+from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
-from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView, SpectacularRedocView
+from drf_spectacular.views import SpectacularSwaggerView, SpectacularRedocView
+
+from ads.schema import CachedSchemaView
+from ads.views import metrics
 
 
 
@@ -12,9 +17,14 @@ urlpatterns = [
     path('auth/', include('djoser.urls')),
     path('auth/', include('djoser.urls.jwt')),
 
-    path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
+    path('api/schema/', CachedSchemaView.as_view(), name='schema'),
     path('api/schema/swagger/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
     path('api/schema/redoc/', SpectacularRedocView.as_view(url_name='schema'), name='redoc-ui'),
 
+    path('metrics', metrics, name='metrics'),
+
 
 ]
+
+# в разработке фото отдаёт сам Django; в продакшене MEDIA_ROOT раздаёт nginx
+urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
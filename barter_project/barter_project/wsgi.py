@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'barter_project.settings')
 
 application = get_wsgi_application()
+
+# индекс подсказок строится в фоне сразу при старте, а не первым запросом
+from ads.autocomplete import title_index  # noqa: E402
+
+title_index.warm()